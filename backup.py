@@ -0,0 +1,275 @@
+"""Резервные копии базы данных.
+
+Все функции блокирующие и вызываются в рабочем потоке; база читается через
+отдельное соединение sqlite3 только для чтения, поэтому цикл событий бота
+не блокируется.
+
+- sqlite: снимок через онлайн-backup API SQLite (постранично, без долгой
+  блокировки), сжатый gzip; из него можно восстановить базу (restore_snapshot)
+- xlsx/csv/jsonl: выгрузка таблиц порциями для просмотра людьми
+
+Запуск вручную (бот должен быть остановлен для restore):
+    python backup.py snapshot
+    python backup.py restore backups/backup_20250101_220000.sqlite3.gz
+"""
+import argparse
+import csv
+import glob
+import gzip
+import io
+import json
+import logging
+import os
+import re
+import shutil
+import sqlite3
+import zipfile
+from datetime import datetime, timedelta
+from pathlib import Path
+
+EXPORT_CHUNK_SIZE = 1000  # Строк, читаемых из таблицы за один раз
+SNAPSHOT_PAGES_PER_STEP = 256  # Страниц, копируемых за один шаг онлайн-backup
+SNAPSHOT_STEP_SLEEP = 0.005  # Пауза между шагами, чтобы писатель успевал захватывать базу
+EXPORT_FORMATS = {
+    "sqlite": ".sqlite3.gz",
+    "xlsx": ".xlsx",
+    "csv": ".csv.zip",  # ZIP-архив, по одному CSV на таблицу
+    "jsonl": ".jsonl.gz",  # Строки вида {"table": ..., "row": {...}}
+}
+
+
+def _open_readonly(db_path):
+    conn = sqlite3.connect(Path(db_path).resolve().as_uri() + "?mode=ro", uri=True)
+    conn.execute("PRAGMA busy_timeout = 5000")
+    return conn
+
+
+def _user_tables(conn):
+    cursor = conn.execute("""
+        SELECT name FROM sqlite_master
+        WHERE type='table'
+        AND name NOT LIKE 'sqlite_%'
+        ORDER BY name
+    """)
+    return [row[0] for row in cursor.fetchall()]
+
+
+def _iter_table(conn, table):
+    """Возвращает (столбцы, итератор порций строк) для таблицы"""
+    cursor = conn.execute(f'SELECT * FROM "{table}"')
+    columns = [desc[0] for desc in cursor.description]
+
+    def chunks():
+        while True:
+            rows = cursor.fetchmany(EXPORT_CHUNK_SIZE)
+            if not rows:
+                break
+            yield rows
+    return columns, chunks()
+
+
+def _write_xlsx(conn, tables, backup_path):
+    try:
+        from openpyxl import Workbook
+    except ImportError:
+        raise RuntimeError("Для выгрузки в xlsx нужен пакет openpyxl (pip install openpyxl)") from None
+
+    # write_only: строки сразу уходят во временный файл, а не копятся в памяти
+    workbook = Workbook(write_only=True)
+    for table in tables:
+        columns, chunks = _iter_table(conn, table)
+        sheet = workbook.create_sheet(title=table[:31])  # Максимум 31 символ для имени листа
+        sheet.append(columns)
+        for rows in chunks:
+            for row in rows:
+                sheet.append(row)
+    if not tables:
+        workbook.create_sheet("Информация").append(["Нет данных для экспорта"])
+    workbook.save(backup_path)
+
+
+def _write_csv(conn, tables, backup_path):
+    with zipfile.ZipFile(backup_path, "w", compression=zipfile.ZIP_DEFLATED) as archive:
+        for table in tables:
+            columns, chunks = _iter_table(conn, table)
+            with archive.open(f"{table}.csv", "w") as raw:
+                with io.TextIOWrapper(raw, encoding="utf-8-sig", newline="") as text:
+                    writer = csv.writer(text)
+                    writer.writerow(columns)
+                    for rows in chunks:
+                        writer.writerows(rows)
+
+
+def _write_jsonl(conn, tables, backup_path):
+    with gzip.open(backup_path, "wt", encoding="utf-8") as out:
+        for table in tables:
+            columns, chunks = _iter_table(conn, table)
+            for rows in chunks:
+                for row in rows:
+                    out.write(json.dumps({"table": table, "row": dict(zip(columns, row))}, ensure_ascii=False))
+                    out.write("\n")
+
+
+def _check_integrity(path):
+    conn = sqlite3.connect(Path(path).resolve().as_uri() + "?mode=ro", uri=True)
+    try:
+        result = [row[0] for row in conn.execute("PRAGMA integrity_check").fetchall()]
+        tables = _user_tables(conn)
+    finally:
+        conn.close()
+    if result != ["ok"]:
+        raise ValueError(f"Снимок повреждён: {'; '.join(result[:5])}")
+    if "users" not in tables:
+        raise ValueError("В снимке нет таблицы users")
+
+
+def create_snapshot(db_path, backup_path):
+    """Копирует базу онлайн-backup API SQLite и сжимает копию gzip"""
+    raw_path = backup_path + ".part"
+    source = _open_readonly(db_path)
+    try:
+        target = sqlite3.connect(raw_path)
+        try:
+            source.backup(target, pages=SNAPSHOT_PAGES_PER_STEP, sleep=SNAPSHOT_STEP_SLEEP)
+            # Снимок - самостоятельный файл без -wal/-shm; бот снова включит WAL при подключении
+            target.execute("PRAGMA journal_mode = DELETE")
+        finally:
+            target.close()
+        _check_integrity(raw_path)
+        with open(raw_path, "rb") as src, gzip.open(backup_path, "wb") as dst:
+            shutil.copyfileobj(src, dst)
+    except Exception:
+        if os.path.exists(backup_path):
+            os.remove(backup_path)
+        raise
+    finally:
+        source.close()
+        if os.path.exists(raw_path):
+            os.remove(raw_path)
+    return backup_path
+
+
+def restore_snapshot(snapshot_path, db_path, backup_dir=None):
+    """Восстанавливает базу из снимка после проверки целостности.
+
+    Соединения с db_path должны быть закрыты. Текущая база предварительно
+    сохраняется снимком в backup_dir (если указан).
+    """
+    restored_path = f"{db_path}.restore"
+    try:
+        with gzip.open(snapshot_path, "rb") as src, open(restored_path, "wb") as dst:
+            shutil.copyfileobj(src, dst)
+        _check_integrity(restored_path)
+
+        if backup_dir and os.path.exists(db_path):
+            os.makedirs(backup_dir, exist_ok=True)
+            timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+            create_snapshot(db_path, os.path.join(backup_dir, f"pre_restore_{timestamp}.sqlite3.gz"))
+
+        # Старый WAL относится к заменяемой базе и не должен примениться к новой
+        for suffix in ("-wal", "-shm"):
+            if os.path.exists(db_path + suffix):
+                os.remove(db_path + suffix)
+        os.replace(restored_path, db_path)
+    finally:
+        if os.path.exists(restored_path):
+            os.remove(restored_path)
+    logging.info(f"База {db_path} восстановлена из {snapshot_path}")
+
+
+_BACKUP_NAME = re.compile(r"backup_(\d{8}_\d{6})")
+
+
+def prune_backups(backup_dir, keep_last, keep_days):
+    """Политика хранения: keep_last последних копий плюс последняя копия каждого дня за keep_days дней.
+
+    Применяется к каждому формату отдельно, чтобы выгрузки xlsx/csv/jsonl не
+    вытесняли снимки sqlite, из которых восстанавливается база.
+    """
+    removed = []
+    for suffix in EXPORT_FORMATS.values():
+        removed.extend(_prune_format(backup_dir, suffix, keep_last, keep_days))
+    return removed
+
+
+def _prune_format(backup_dir, suffix, keep_last, keep_days):
+    dated = []
+    for path in glob.glob(os.path.join(backup_dir, f"backup_*{suffix}")):
+        match = _BACKUP_NAME.search(os.path.basename(path))
+        if match:
+            dated.append((datetime.strptime(match.group(1), "%Y%m%d_%H%M%S"), path))
+    dated.sort(reverse=True)
+
+    cutoff = datetime.now() - timedelta(days=keep_days)
+    keep = {path for _, path in dated[:keep_last]}
+    seen_days = set()
+    for created, path in dated:
+        if created >= cutoff and created.date() not in seen_days:
+            seen_days.add(created.date())
+            keep.add(path)
+
+    removed = []
+    for _, path in dated:
+        if path not in keep:
+            try:
+                os.remove(path)
+                removed.append(path)
+            except OSError as e:
+                logging.error(f"Не удалось удалить старую резервную копию {path}: {e}")
+    return removed
+
+
+_WRITERS = {
+    "xlsx": _write_xlsx,
+    "csv": _write_csv,
+    "jsonl": _write_jsonl,
+}
+
+
+def export_tables(db_path, backup_path, fmt="xlsx"):
+    """Выгружает все пользовательские таблицы в файл. Блокирующая функция для рабочего потока."""
+    if fmt not in _WRITERS:
+        raise ValueError(f"Неизвестный формат резервной копии: {fmt}")
+    conn = _open_readonly(db_path)
+    try:
+        tables = _user_tables(conn)
+        _WRITERS[fmt](conn, tables, backup_path)
+    except Exception:
+        # Удаляем частично созданный файл при ошибке
+        if os.path.exists(backup_path):
+            os.remove(backup_path)
+        raise
+    finally:
+        conn.close()
+    logging.info(f"Резервная копия {backup_path}: таблиц {len(tables)}")
+    return backup_path
+
+
+def make_backup(db_path, backup_path, fmt):
+    """Создаёт резервную копию в формате fmt (см. EXPORT_FORMATS)"""
+    if fmt == "sqlite":
+        return create_snapshot(db_path, backup_path)
+    return export_tables(db_path, backup_path, fmt)
+
+
+def main():
+    from db import BACKUP_DIR, DB_PATH
+
+    parser = argparse.ArgumentParser(description="Резервные копии базы бота")
+    commands = parser.add_subparsers(dest="command", required=True)
+    commands.add_parser("snapshot", help="создать сжатый снимок базы")
+    restore = commands.add_parser("restore", help="восстановить базу из снимка (бот должен быть остановлен)")
+    restore.add_argument("snapshot")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    if args.command == "snapshot":
+        os.makedirs(BACKUP_DIR, exist_ok=True)
+        timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+        print(create_snapshot(DB_PATH, os.path.join(BACKUP_DIR, f"backup_{timestamp}{EXPORT_FORMATS['sqlite']}")))
+    else:
+        restore_snapshot(args.snapshot, DB_PATH, backup_dir=BACKUP_DIR)
+
+
+if __name__ == "__main__":
+    main()
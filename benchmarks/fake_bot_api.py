@@ -0,0 +1,349 @@
+"""Локальная замена Telegram Bot API для интеграционных и нагрузочных тестов.
+
+Реализует методы, которыми пользуется бот: getMe, getUpdates, deleteWebhook,
+setWebhook, sendMessage, editMessageText, editMessageReplyMarkup,
+answerCallbackQuery, sendDocument, deleteMessage. Ответы имеют тот же вид,
+что у настоящего API, поэтому python-telegram-bot работает с сервером без
+изменений - достаточно указать в config.py
+
+    BOT_API_BASE_URL = "http://127.0.0.1:8081/bot"
+
+Возможности:
+- latency/jitter: задержка перед каждым ответом (кроме getUpdates)
+- retry_after_rate: доля запросов на отправку, получающих 429 с retry_after
+- все исходящие сообщения сохраняются в FakeBotAPI.sent
+- обновления для бота добавляются через send_text()/press_button() или
+  POST /fake/updates; захваченные сообщения - GET /fake/messages
+
+    python benchmarks/fake_bot_api.py --port 8081 --latency 0.05 --retry-after-rate 0.01
+"""
+import argparse
+import asyncio
+import json
+import logging
+import random
+import time
+
+from aiohttp import web
+
+BOT_USER = {"id": 1, "is_bot": True, "first_name": "FakeBot", "username": "fake_bot"}
+RETRY_AFTER_METHODS = {"sendMessage", "editMessageText", "editMessageReplyMarkup", "sendDocument"}
+MAX_UPDATES_PER_REQUEST = 100
+
+logger = logging.getLogger(__name__)
+
+
+class BotAPIError(Exception):
+    def __init__(self, code, description, parameters=None):
+        super().__init__(description)
+        self.code = code
+        self.description = description
+        self.parameters = parameters
+
+
+def _int(params, name, default=None):
+    value = params.get(name)
+    return default if value in (None, "") else int(value)
+
+
+def _markup(params):
+    value = params.get("reply_markup")
+    if not value:
+        return None
+    return json.loads(value) if isinstance(value, str) else value
+
+
+class FakeBotAPI:
+    """Сервер Bot API в памяти: очередь обновлений и журнал отправленного"""
+
+    def __init__(self, latency=0.0, jitter=0.0, retry_after_rate=0.0, retry_after=1, seed=None):
+        self.latency = latency
+        self.jitter = jitter
+        self.retry_after_rate = retry_after_rate
+        self.retry_after = retry_after
+        self._random = random.Random(seed)
+        self.sent = []  # Исходящие действия бота по порядку
+        self._sent_by_chat = {}  # chat_id -> исходящие действия в этот чат
+        self.calls = {}  # Метод -> количество вызовов
+        self.retry_after_injected = 0
+        self._messages = {}  # (chat_id, message_id) -> сообщение
+        self._next_message_id = {}
+        self._updates = []
+        self._next_update_id = 1
+        self._next_callback_id = 0
+        self._updates_changed = asyncio.Condition()
+        self._runner = None
+        self._handlers = {
+            "getMe": self._get_me,
+            "getUpdates": self._get_updates,
+            "deleteWebhook": self._true,
+            "setWebhook": self._true,
+            "sendMessage": self._send_message,
+            "editMessageText": self._edit_message_text,
+            "editMessageReplyMarkup": self._edit_message_reply_markup,
+            "answerCallbackQuery": self._answer_callback_query,
+            "sendDocument": self._send_document,
+            "deleteMessage": self._delete_message,
+        }
+
+    # --- Сервер ---
+    def make_app(self):
+        app = web.Application()
+        app.router.add_route("*", "/bot{token}/{method}", self._handle)
+        app.router.add_post("/fake/updates", self._handle_push_update)
+        app.router.add_get("/fake/messages", self._handle_messages)
+        return app
+
+    async def start(self, host="127.0.0.1", port=8081):
+        self._runner = web.AppRunner(self.make_app(), access_log=None)
+        await self._runner.setup()
+        await web.TCPSite(self._runner, host, port).start()
+        logger.info(f"Fake Bot API: http://{host}:{port}/bot")
+
+    async def stop(self):
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
+
+    async def _handle(self, request):
+        method = request.match_info["method"]
+        self.calls[method] = self.calls.get(method, 0) + 1
+        handler = self._handlers.get(method)
+        if handler is None:
+            return self._error(BotAPIError(404, "Not Found: method not found"))
+        params = dict(await request.post())
+        if not params and request.can_read_body:
+            params = await request.json()
+        try:
+            if method != "getUpdates":
+                await self._delay()
+                self._maybe_retry_after(method)
+            result = await handler(params)
+        except BotAPIError as e:
+            return self._error(e)
+        return web.json_response({"ok": True, "result": result})
+
+    @staticmethod
+    def _error(e):
+        body = {"ok": False, "error_code": e.code, "description": e.description}
+        if e.parameters:
+            body["parameters"] = e.parameters
+        return web.json_response(body, status=e.code)
+
+    async def _delay(self):
+        delay = self.latency + (self._random.uniform(0, self.jitter) if self.jitter else 0)
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+    def _maybe_retry_after(self, method):
+        if method in RETRY_AFTER_METHODS and self.retry_after_rate \
+                and self._random.random() < self.retry_after_rate:
+            self.retry_after_injected += 1
+            raise BotAPIError(429, f"Too Many Requests: retry after {self.retry_after}",
+                              {"retry_after": self.retry_after})
+
+    # --- Обновления для бота ---
+    async def push_update(self, update):
+        """Добавляет обновление (dict без update_id) в очередь getUpdates"""
+        async with self._updates_changed:
+            update = dict(update, update_id=self._next_update_id)
+            self._next_update_id += 1
+            self._updates.append(update)
+            self._updates_changed.notify_all()
+        return update
+
+    def make_text_update(self, user_id, text, first_name="Сотрудник"):
+        """Обновление (без update_id): сообщение пользователя боту в личном чате"""
+        message = {
+            "message_id": self._new_message_id(user_id),
+            "date": int(time.time()),
+            "chat": {"id": user_id, "type": "private"},
+            "from": {"id": user_id, "is_bot": False, "first_name": first_name},
+            "text": text,
+        }
+        if text.startswith("/"):
+            command = text.split()[0]
+            message["entities"] = [{"type": "bot_command", "offset": 0, "length": len(command)}]
+        return {"message": message}
+
+    def make_callback_update(self, user_id, message_id, data, first_name="Сотрудник"):
+        """Обновление (без update_id): нажатие inline-кнопки под сообщением бота"""
+        message = dict(self._messages.get((user_id, message_id)) or {
+            "message_id": message_id,
+            "date": int(time.time()),
+            "chat": {"id": user_id, "type": "private"},
+            "from": BOT_USER,
+        })
+        self._next_callback_id += 1
+        return {"callback_query": {
+            "id": str(self._next_callback_id),
+            "from": {"id": user_id, "is_bot": False, "first_name": first_name},
+            "chat_instance": str(user_id),
+            "message": message,
+            "data": data,
+        }}
+
+    async def send_text(self, user_id, text, first_name="Сотрудник"):
+        """Сообщение пользователя в очередь getUpdates"""
+        return await self.push_update(self.make_text_update(user_id, text, first_name))
+
+    async def press_button(self, user_id, message_id, data, first_name="Сотрудник"):
+        """Нажатие кнопки в очередь getUpdates"""
+        return await self.push_update(self.make_callback_update(user_id, message_id, data, first_name))
+
+    async def _get_updates(self, params):
+        offset = _int(params, "offset", 0)
+        limit = _int(params, "limit", MAX_UPDATES_PER_REQUEST)
+        timeout = float(params.get("timeout") or 0)
+        async with self._updates_changed:
+            # Обновления до offset подтверждены ботом
+            self._updates = [u for u in self._updates if u["update_id"] >= offset]
+            if not self._updates and timeout:
+                try:
+                    await asyncio.wait_for(self._updates_changed.wait(), timeout)
+                except asyncio.TimeoutError:
+                    pass
+            return self._updates[:limit]
+
+    # --- Методы ---
+    async def _get_me(self, params):
+        return BOT_USER
+
+    async def _true(self, params):
+        return True
+
+    def _new_message_id(self, chat_id):
+        message_id = self._next_message_id.get(chat_id, 0) + 1
+        self._next_message_id[chat_id] = message_id
+        return message_id
+
+    def _record(self, method, chat_id, **fields):
+        action = {"method": method, "chat_id": chat_id, "time": time.time(), **fields}
+        self.sent.append(action)
+        self._sent_by_chat.setdefault(chat_id, []).append(action)
+
+    def _find_message(self, params):
+        chat_id = _int(params, "chat_id")
+        message = self._messages.get((chat_id, _int(params, "message_id")))
+        if message is None:
+            raise BotAPIError(400, "Bad Request: message to edit not found")
+        return chat_id, message
+
+    async def _send_message(self, params):
+        chat_id = _int(params, "chat_id")
+        message = {
+            "message_id": self._new_message_id(chat_id),
+            "date": int(time.time()),
+            "chat": {"id": chat_id, "type": "private"},
+            "from": BOT_USER,
+            "text": params.get("text", ""),
+        }
+        markup = _markup(params)
+        if markup and "inline_keyboard" in markup:
+            message["reply_markup"] = markup
+        self._messages[(chat_id, message["message_id"])] = message
+        self._record("sendMessage", chat_id, message_id=message["message_id"], text=message["text"],
+                     reply_markup=markup)
+        return message
+
+    async def _edit_message_text(self, params):
+        chat_id, message = self._find_message(params)
+        text = params.get("text", "")
+        markup = _markup(params)
+        if text == message.get("text") and markup == message.get("reply_markup"):
+            raise BotAPIError(400, "Bad Request: message is not modified")
+        message["text"] = text
+        if markup:
+            message["reply_markup"] = markup
+        else:
+            message.pop("reply_markup", None)
+        self._record("editMessageText", chat_id, message_id=message["message_id"], text=text, reply_markup=markup)
+        return message
+
+    async def _edit_message_reply_markup(self, params):
+        chat_id, message = self._find_message(params)
+        markup = _markup(params)
+        if markup == message.get("reply_markup"):
+            raise BotAPIError(400, "Bad Request: message is not modified")
+        if markup:
+            message["reply_markup"] = markup
+        else:
+            message.pop("reply_markup", None)
+        self._record("editMessageReplyMarkup", chat_id, message_id=message["message_id"], reply_markup=markup)
+        return message
+
+    async def _answer_callback_query(self, params):
+        self._record("answerCallbackQuery", None, callback_query_id=params.get("callback_query_id"),
+                     text=params.get("text"), show_alert=params.get("show_alert") in ("true", True))
+        return True
+
+    async def _send_document(self, params):
+        chat_id = _int(params, "chat_id")
+        document = params.get("document")
+        file_name = getattr(document, "filename", None) or str(document)
+        size = len(document.file.read()) if hasattr(document, "file") else 0
+        message_id = self._new_message_id(chat_id)
+        message = {
+            "message_id": message_id,
+            "date": int(time.time()),
+            "chat": {"id": chat_id, "type": "private"},
+            "from": BOT_USER,
+            "document": {"file_id": f"doc{chat_id}_{message_id}", "file_unique_id": f"u{chat_id}_{message_id}",
+                         "file_name": file_name, "file_size": size},
+        }
+        if params.get("caption"):
+            message["caption"] = params["caption"]
+        self._messages[(chat_id, message_id)] = message
+        self._record("sendDocument", chat_id, message_id=message_id, file_name=file_name, size=size,
+                     caption=params.get("caption"))
+        return message
+
+    async def _delete_message(self, params):
+        chat_id = _int(params, "chat_id")
+        message_id = _int(params, "message_id")
+        if self._messages.pop((chat_id, message_id), None) is None:
+            raise BotAPIError(400, "Bad Request: message to delete not found")
+        self._record("deleteMessage", chat_id, message_id=message_id)
+        return True
+
+    # --- Управление из тестов по HTTP ---
+    async def _handle_push_update(self, request):
+        update = await self.push_update(await request.json())
+        return web.json_response({"ok": True, "update_id": update["update_id"]})
+
+    async def _handle_messages(self, request):
+        chat_id = request.query.get("chat_id")
+        sent = [m for m in self.sent if chat_id is None or str(m["chat_id"]) == chat_id]
+        return web.json_response(sent)
+
+    def messages_for(self, chat_id):
+        """Исходящие действия в чат (список пополняется, не изменять)"""
+        return self._sent_by_chat.get(chat_id, [])
+
+    def get_message(self, chat_id, message_id):
+        """Текущее состояние сообщения бота (после правок) или None"""
+        return self._messages.get((chat_id, message_id))
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8081)
+    parser.add_argument("--latency", type=float, default=0.0, help="задержка ответа, с")
+    parser.add_argument("--jitter", type=float, default=0.0, help="случайная добавка к задержке, до, с")
+    parser.add_argument("--retry-after-rate", type=float, default=0.0, help="доля отправок с ответом 429")
+    parser.add_argument("--retry-after", type=int, default=1, help="retry_after в ответе 429, с")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    api = FakeBotAPI(args.latency, args.jitter, args.retry_after_rate, args.retry_after)
+    await api.start(args.host, args.port)
+    try:
+        while True:
+            await asyncio.sleep(3600)
+    finally:
+        await api.stop()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
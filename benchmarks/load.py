@@ -0,0 +1,358 @@
+"""Сквозной нагрузочный тест: рои сотрудников и админов против обработчиков bot.py.
+
+Собирает Application из bot.build_application() с FakeBotAPI вместо Telegram
+и временной базой. Обновления подаются в app.update_queue (как в режиме
+webhook); каждый симулированный пользователь ждёт обработки своего
+обновления и только потом делает следующее действие.
+
+Сценарии:
+- регистрация: /start -> ФИО -> роль (админы - только /start)
+- сотрудник: баланс, история, "Использовать баллы" -> календарь -> дата ->
+  подтверждение, мои заявки
+- админ: проверка заявок -> одобрить/отклонить каждую, начисление баллов
+  сотруднику, история сотрудника
+
+Время обработки обновления - от первого до последнего обработчика
+Application (включая вызовы Bot API и базы). Время работы с базой (включая
+фоновые outbox и persistence) считается подклассом TimedDatabase и делится
+на число обновлений: выполнение запросов отдельно от ожидания соединения
+из пула, очереди писателя и коммита пачки. Результат сохраняется в JSON
+для сравнения прогонов.
+
+Админы берутся из config (ADMINS, SUPERADMINS).
+
+    python benchmarks/load.py --employees 200 --rounds 3 --api-latency 0.03 --output load.json
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+from contextlib import asynccontextmanager
+from datetime import datetime
+
+from telegram import Update
+from telegram.ext import TypeHandler
+
+from fake_bot_api import FakeBotAPI
+from webhook_replay import percentile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import bot  # noqa: E402
+from db import SETTING_CONSULTANT_SCORES, SETTING_USM_SCORES, Database, db  # noqa: E402
+from outbox import OutboxWorker  # noqa: E402
+
+FAKE_API_PORT = 18082
+ROLES = ("Консультант", "УСМ")
+START_POINTS = 1000  # Начисляются сотрудникам перед смешанной фазой, чтобы было что тратить
+APPROVE_SHARE = 0.8  # Доля заявок, которые админ одобряет
+
+
+class TimedDatabase(Database):
+    """Database со счётчиками времени для нагрузочного теста.
+
+    Чтение: ожидание соединения из пула и время, пока соединение занято.
+    Запись: выполнение самой операции и всё остальное (очередь писателя,
+    другие операции пачки, коммит).
+    """
+
+    def reset_timing(self):
+        self.timing = dict.fromkeys(("reads", "read_wait", "read_exec", "writes", "write_wait", "write_exec"), 0)
+
+    @asynccontextmanager
+    async def _acquire(self):
+        started = time.perf_counter()
+        async with super()._acquire() as conn:
+            acquired = time.perf_counter()
+            try:
+                yield conn
+            finally:
+                self.timing["reads"] += 1
+                self.timing["read_wait"] += acquired - started
+                self.timing["read_exec"] += time.perf_counter() - acquired
+
+    async def _write(self, op):
+        executed = 0.0
+
+        async def timed_op(conn):
+            nonlocal executed
+            op_started = time.perf_counter()
+            try:
+                return await op(conn)
+            finally:
+                executed = time.perf_counter() - op_started
+
+        started = time.perf_counter()
+        try:
+            return await super()._write(timed_op)
+        finally:
+            self.timing["writes"] += 1
+            self.timing["write_exec"] += executed
+            self.timing["write_wait"] += time.perf_counter() - started - executed
+
+
+def latency_summary(values):
+    ms = [v * 1000 for v in values]
+    return {
+        "count": len(ms),
+        "p50_ms": round(percentile(ms, 50), 2),
+        "p95_ms": round(percentile(ms, 95), 2),
+        "p99_ms": round(percentile(ms, 99), 2),
+        "max_ms": round(max(ms, default=0), 2),
+    }
+
+
+def per_update_ms(seconds, updates):
+    return round(seconds / updates * 1000, 3) if updates else 0
+
+
+class Swarm:
+    """Подаёт обновления в Application и измеряет время их обработки"""
+
+    def __init__(self, app, api, think):
+        self.app = app
+        self.api = api
+        self.think = think
+        self.samples = []  # (действие, время обработки, время от постановки в очередь)
+        self._update_id = 0
+        self._pending = {}  # update_id -> (действие, время постановки, future)
+        self._started = {}
+        app.add_handler(TypeHandler(Update, self._on_start), group=-100)
+        app.add_handler(TypeHandler(Update, self._on_end), group=100)
+
+    async def _on_start(self, update, context):
+        self._started[update.update_id] = time.perf_counter()
+
+    async def _on_end(self, update, context):
+        finished = time.perf_counter()
+        pending = self._pending.pop(update.update_id, None)
+        started = self._started.pop(update.update_id, finished)
+        if pending is None:
+            return
+        action, queued, future = pending
+        self.samples.append((action, finished - started, finished - queued))
+        future.set_result(None)
+
+    async def _send(self, action, payload):
+        if self.think:
+            await asyncio.sleep(random.uniform(0, self.think))
+        self._update_id += 1
+        payload = dict(payload, update_id=self._update_id)
+        future = asyncio.get_running_loop().create_future()
+        self._pending[self._update_id] = (action, time.perf_counter(), future)
+        await self.app.update_queue.put(Update.de_json(payload, self.app.bot))
+        await future
+
+    async def text(self, user_id, text, action=None):
+        await self._send(action or text, self.api.make_text_update(user_id, text))
+
+    async def press(self, user_id, message_id, data, action):
+        await self._send(action, self.api.make_callback_update(user_id, message_id, data))
+
+    def last_inline_message(self, chat_id, since=0):
+        """Последнее сообщение бота с inline-кнопками в чате (в текущем состоянии)"""
+        for sent in reversed(self.api.messages_for(chat_id)[since:]):
+            message = self.api.get_message(chat_id, sent.get("message_id"))
+            if message and message.get("reply_markup"):
+                return message
+        return None
+
+
+def inline_buttons(message, prefix):
+    return [
+        button["callback_data"]
+        for row in message["reply_markup"]["inline_keyboard"]
+        for button in row
+        if button.get("callback_data", "").startswith(prefix)
+    ]
+
+
+async def register(swarm, user_id, name, role):
+    await swarm.text(user_id, "/start")
+    await swarm.text(user_id, name, action="Регистрация: ФИО")
+    await swarm.text(user_id, role, action="Регистрация: роль")
+
+
+async def employee_round(swarm, user_id, rng):
+    await swarm.text(user_id, "Мой баланс")
+    await swarm.text(user_id, "История")
+    await swarm.text(user_id, "Использовать баллы")
+    since = len(swarm.api.messages_for(user_id))
+    choice = rng.choice(("Уйти на 1 час раньше", "Уйти на 2 часа раньше"))
+    await swarm.text(user_id, choice, action="Тип использования")
+    calendar = swarm.last_inline_message(user_id, since)
+    dates = inline_buttons(calendar, "date_") if calendar else []
+    if not dates:
+        await swarm.text(user_id, "Отмена", action="Отмена календаря")
+        return
+    await swarm.press(user_id, calendar["message_id"], rng.choice(dates), "Календарь: дата")
+    message = swarm.api.get_message(user_id, calendar["message_id"])
+    if message and inline_buttons(message, "confirm_request"):
+        await swarm.press(user_id, calendar["message_id"], "confirm_request", "Подтверждение заявки")
+    else:
+        await swarm.text(user_id, "Отмена", action="Отмена календаря")
+    await swarm.text(user_id, "Мои заявки")
+
+
+async def admin_round(swarm, admin_id, employees, rng):
+    since = len(swarm.api.messages_for(admin_id))
+    await swarm.text(admin_id, "Проверка заявок на использование")
+    for sent in swarm.api.messages_for(admin_id)[since:]:
+        message = swarm.api.get_message(admin_id, sent.get("message_id"))
+        if not message or not message.get("reply_markup"):
+            continue
+        approve = inline_buttons(message, "approve_")
+        reject = inline_buttons(message, "reject_")
+        if approve and rng.random() < APPROVE_SHARE:
+            await swarm.press(admin_id, message["message_id"], approve[0], "Одобрение заявки")
+        elif reject:
+            await swarm.press(admin_id, message["message_id"], reject[0], "Отклонение заявки")
+
+    user_id, name, role = rng.choice(employees)
+    await swarm.text(admin_id, "Начислить/Списать баллы")
+    await swarm.text(admin_id, "Начислить баллы")
+    await swarm.text(admin_id, f"{name} ({user_id})", action="Выбор сотрудника")
+    scores = db.get_setting(SETTING_USM_SCORES if role == "УСМ" else SETTING_CONSULTANT_SCORES)
+    await swarm.text(admin_id, rng.choice(list(scores)), action="Причина начисления")
+
+    user_id, name, _ = rng.choice(employees)
+    await swarm.text(admin_id, "История сотрудника")
+    await swarm.text(admin_id, f"{name} ({user_id})", action="История: выбор сотрудника")
+
+
+async def run_phase(name, swarm, api, coroutines):
+    """Прогоняет сценарии одновременно и возвращает метрики фазы"""
+    samples_before = len(swarm.samples)
+    db_before = dict(db.timing)
+    calls_before = sum(api.calls.values())
+    started = time.perf_counter()
+    results = await asyncio.gather(*coroutines, return_exceptions=True)
+    elapsed = time.perf_counter() - started
+    errors = [r for r in results if isinstance(r, Exception)]
+    for error in errors[:3]:
+        print(f"Ошибка сценария ({name}): {error!r}")
+
+    samples = swarm.samples[samples_before:]
+    db_delta = {key: value - db_before[key] for key, value in db.timing.items()}
+    updates = len(samples)
+    by_action = {}
+    for action, handled, _ in samples:
+        by_action.setdefault(action, []).append(handled)
+    return {
+        "updates": updates,
+        "elapsed_s": round(elapsed, 3),
+        "updates_per_s": round(updates / elapsed, 1) if elapsed else 0,
+        "failed_scenarios": len(errors),
+        "handler_latency": latency_summary([s[1] for s in samples]),
+        "queue_to_done_latency": latency_summary([s[2] for s in samples]),
+        "db": {
+            "reads": db_delta["reads"],
+            "writes": db_delta["writes"],
+            "exec_ms_per_update": per_update_ms(db_delta["read_exec"] + db_delta["write_exec"], updates),
+            "wait_ms_per_update": per_update_ms(db_delta["read_wait"] + db_delta["write_wait"], updates),
+            "read_wait_ms_per_update": per_update_ms(db_delta["read_wait"], updates),
+            "write_wait_ms_per_update": per_update_ms(db_delta["write_wait"], updates),
+        },
+        "bot_api_calls": sum(api.calls.values()) - calls_before,
+        "by_action": {action: latency_summary(values) for action, values in sorted(by_action.items())},
+    }
+
+
+def print_phase(name, result):
+    latency = result["handler_latency"]
+    print(f"{name}: {result['updates']} обновл. за {result['elapsed_s']} с ({result['updates_per_s']} обновл./с), "
+          f"p50 {latency['p50_ms']} мс, p95 {latency['p95_ms']} мс, p99 {latency['p99_ms']} мс, "
+          f"база {result['db']['exec_ms_per_update']} мс/обновл. (+ ожидание {result['db']['wait_ms_per_update']} мс), "
+          f"ошибок сценариев: {result['failed_scenarios']}")
+
+
+async def run(args):
+    rng = random.Random(args.seed)
+    api = FakeBotAPI(latency=args.api_latency, jitter=args.api_jitter,
+                     retry_after_rate=args.retry_after_rate, seed=args.seed)
+    await api.start(port=FAKE_API_PORT)
+
+    workdir = tempfile.mkdtemp(prefix="bot-load-")
+    db.db_path = os.path.join(workdir, "load.sqlite3")
+    # Глобальный экземпляр уже импортирован bot, outbox и persistence - меняем ему класс
+    db.__class__ = TimedDatabase
+    db.reset_timing()
+    await db.connect()
+    await db.init_settings(bot.SETTINGS_DEFAULTS)
+
+    app = bot.build_application(base_url=f"http://127.0.0.1:{FAKE_API_PORT}/bot")
+    swarm = Swarm(app, api, args.think)
+    await app.initialize()
+    await app.start()
+    outbox_worker = OutboxWorker(app.bot)
+    outbox_worker.start()
+
+    employees = [(100000 + i, f"Сотрудник{i}", ROLES[i % len(ROLES)]) for i in range(args.employees)]
+    admins = sorted(bot.admins_list)
+    report = {
+        "started_at": datetime.now().isoformat(timespec="seconds"),
+        "params": vars(args),
+        "admins": len(admins),
+        "phases": {},
+    }
+    try:
+        report["phases"]["registration"] = await run_phase(
+            "registration", swarm, api,
+            [register(swarm, *employee) for employee in employees]
+            + [swarm.text(admin_id, "/start") for admin_id in admins],
+        )
+        print_phase("Регистрация", report["phases"]["registration"])
+
+        await db.bulk_add_points(admins[0], [(user_id, START_POINTS, "Стартовые баллы") for user_id, _, _ in employees],
+                                 silent=True)
+
+        async def employee_loop(user_id):
+            for _ in range(args.rounds):
+                await employee_round(swarm, user_id, rng)
+
+        async def admin_loop(admin_id):
+            for _ in range(args.rounds):
+                await admin_round(swarm, admin_id, employees, rng)
+
+        report["phases"]["mixed"] = await run_phase(
+            "mixed", swarm, api,
+            [employee_loop(user_id) for user_id, _, _ in employees] + [admin_loop(admin_id) for admin_id in admins],
+        )
+        print_phase("Смешанная нагрузка", report["phases"]["mixed"])
+        report["retry_after_injected"] = api.retry_after_injected
+        report["user_cache"] = db.user_cache_stats()
+    finally:
+        await outbox_worker.stop()
+        await app.stop()
+        await app.shutdown()
+        await db.close()
+        await api.stop()
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+        print(f"Результат сохранён в {args.output}")
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--employees", type=int, default=100, help="симулированных сотрудников")
+    parser.add_argument("--rounds", type=int, default=3, help="повторов сценария на пользователя")
+    parser.add_argument("--think", type=float, default=0.0, help="пауза пользователя перед действием, до, с")
+    parser.add_argument("--api-latency", type=float, default=0.03, help="задержка ответа Bot API, с")
+    parser.add_argument("--api-jitter", type=float, default=0.0)
+    parser.add_argument("--retry-after-rate", type=float, default=0.0, help="доля отправок с ответом 429")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--output", help="файл для результата в JSON")
+    args = parser.parse_args()
+    asyncio.run(run(args))
+
+
+if __name__ == "__main__":
+    main()
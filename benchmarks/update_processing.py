@@ -0,0 +1,89 @@
+"""Нагрузочный тест обработки обновлений.
+
+Сравнивает обработку по одному обновлению (поведение Application по умолчанию)
+с PerChatUpdateProcessor: много чатов присылают обновления одновременно,
+обработчик имитирует ожидание сети/базы. Проверяет, что внутри чата порядок
+сохраняется.
+
+    python benchmarks/update_processing.py --chats 50 --per-chat 10 --latency 0.05
+"""
+import argparse
+import asyncio
+import os
+import sys
+import time
+from datetime import datetime
+
+from telegram import Chat, Message, Update, User
+from telegram.ext import SimpleUpdateProcessor
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from update_processor import PerChatUpdateProcessor  # noqa: E402
+
+
+def make_updates(chats, per_chat):
+    """Обновления вперемешку: по одному от каждого чата по кругу"""
+    updates = []
+    update_id = 0
+    for seq in range(per_chat):
+        for chat_id in range(1, chats + 1):
+            update_id += 1
+            message = Message(
+                message_id=seq,
+                date=datetime.now(),
+                chat=Chat(chat_id, Chat.PRIVATE),
+                from_user=User(chat_id, f"user{chat_id}", False),
+                text=str(seq),
+            )
+            updates.append(Update(update_id, message=message))
+    return updates
+
+
+async def run(processor, updates, latency):
+    """Прогоняет обновления так же, как цикл получения обновлений в Application"""
+    seen = {}
+    finished = []
+
+    async def handle(update):
+        await asyncio.sleep(latency)
+        seen.setdefault(update.effective_chat.id, []).append(int(update.message.text))
+        finished.append(time.perf_counter())
+
+    await processor.initialize()
+    started = time.perf_counter()
+    tasks = []
+    for update in updates:
+        coroutine = processor.process_update(update, handle(update))
+        if processor.max_concurrent_updates > 1:
+            tasks.append(asyncio.create_task(coroutine))
+        else:
+            await coroutine
+    await asyncio.gather(*tasks)
+    elapsed = time.perf_counter() - started
+    await processor.shutdown()
+
+    ordered = all(seq == sorted(seq) for seq in seen.values())
+    return elapsed, ordered
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--chats", type=int, default=50)
+    parser.add_argument("--per-chat", type=int, default=10)
+    parser.add_argument("--latency", type=float, default=0.05, help="время обработки одного обновления, с")
+    parser.add_argument("--concurrency", type=int, default=16)
+    args = parser.parse_args()
+
+    updates = make_updates(args.chats, args.per_chat)
+    print(f"Обновлений: {len(updates)} ({args.chats} чатов x {args.per_chat}), обработка {args.latency * 1000:.0f} мс")
+    for name, processor in (
+        ("по одному", SimpleUpdateProcessor(1)),
+        (f"по чатам, {args.concurrency} параллельно", PerChatUpdateProcessor(args.concurrency)),
+    ):
+        elapsed, ordered = await run(processor, updates, args.latency)
+        print(f"{name:>28}: {elapsed:7.2f} с, {len(updates) / elapsed:8.1f} обновл./с, "
+              f"порядок в чатах {'сохранён' if ordered else 'НАРУШЕН'}")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
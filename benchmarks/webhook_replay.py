@@ -0,0 +1,179 @@
+"""Нагрузочный тест webhook: отправка записанных обновлений POST-запросами.
+
+Обновления берутся из файла JSONL (по одному JSON-объекту Update в строке,
+как их присылает Telegram) или генерируются: текстовые сообщения от --chats
+чатов по кругу. Запросы отправляются с заданной частотой (--rate, 0 - без
+ограничения), не больше --concurrency одновременно.
+
+Без --url поднимается локальный WebhookServer; обновления из его очереди
+обрабатываются через PerChatUpdateProcessor с задержкой --latency, и кроме
+времени ответа сервера измеряется время до конца обработки. С --url запросы
+уходят на запущенного бота (USE_WEBHOOK = True), измеряется только ответ.
+
+    python benchmarks/webhook_replay.py --chats 50 --per-chat 20 --rate 500
+    python benchmarks/webhook_replay.py --updates updates.jsonl --url http://127.0.0.1:8443/telegram --secret ...
+"""
+import argparse
+import asyncio
+import json
+import os
+import sys
+import time
+
+import aiohttp
+from telegram import Bot
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from update_processor import PerChatUpdateProcessor  # noqa: E402
+from webhook import SECRET_TOKEN_HEADER, WebhookServer  # noqa: E402
+
+LOCAL_PORT = 18443
+LOCAL_PATH = "/telegram"
+
+
+def load_updates(path):
+    with open(path, encoding="utf-8") as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def make_updates(chats, per_chat):
+    """Текстовые сообщения вперемешку: по одному от каждого чата по кругу"""
+    updates = []
+    update_id = 0
+    for seq in range(per_chat):
+        for chat_id in range(1, chats + 1):
+            update_id += 1
+            user = {"id": chat_id, "is_bot": False, "first_name": f"user{chat_id}"}
+            updates.append({
+                "update_id": update_id,
+                "message": {
+                    "message_id": seq,
+                    "date": int(time.time()),
+                    "chat": {"id": chat_id, "type": "private"},
+                    "from": user,
+                    "text": str(seq),
+                },
+            })
+    return updates
+
+
+def percentile(values, p):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * p / 100))]
+
+
+def latency_line(name, values):
+    ms = [v * 1000 for v in values]
+    return (f"{name}: p50 {percentile(ms, 50):.1f} мс, p95 {percentile(ms, 95):.1f} мс, "
+            f"p99 {percentile(ms, 99):.1f} мс, макс {max(ms, default=0):.1f} мс")
+
+
+async def post_all(url, updates, rate, concurrency, secret):
+    """Отправляет обновления; возвращает (время отправки по update_id, время ответа, ошибки)"""
+    headers = {SECRET_TOKEN_HEADER: secret} if secret else {}
+    sent_at = {}
+    acks = []
+    errors = 0
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def post(session, update):
+        nonlocal errors
+        async with semaphore:
+            started = time.perf_counter()
+            sent_at[update["update_id"]] = started
+            try:
+                async with session.post(url, json=update, headers=headers) as response:
+                    await response.read()
+                    if response.status != 200:
+                        errors += 1
+                        return
+            except aiohttp.ClientError:
+                errors += 1
+                return
+            acks.append(time.perf_counter() - started)
+
+    connector = aiohttp.TCPConnector(limit=concurrency)
+    async with aiohttp.ClientSession(connector=connector) as session:
+        started = time.perf_counter()
+        tasks = []
+        for i, update in enumerate(updates):
+            if rate:
+                delay = started + i / rate - time.perf_counter()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+            tasks.append(asyncio.create_task(post(session, update)))
+        await asyncio.gather(*tasks)
+    return sent_at, acks, errors
+
+
+async def run_local(updates, args):
+    """Локальный сервер + обработка очереди; время от отправки до конца обработки"""
+    queue = asyncio.Queue()
+    server = WebhookServer(queue, Bot("1:benchmark"), "127.0.0.1", LOCAL_PORT, LOCAL_PATH,
+                           secret_token=args.secret)
+    processor = PerChatUpdateProcessor(args.processing_concurrency)
+    handled_at = {}
+
+    async def handle(update):
+        await asyncio.sleep(args.latency)
+        handled_at[update.update_id] = time.perf_counter()
+
+    async def consume():
+        # Как цикл получения обновлений в Application
+        while True:
+            update = await queue.get()
+            asyncio.create_task(processor.process_update(update, handle(update)))
+
+    await server.start()
+    await processor.initialize()
+    consumer = asyncio.create_task(consume())
+    try:
+        started = time.perf_counter()
+        sent_at, acks, errors = await post_all(
+            f"http://127.0.0.1:{LOCAL_PORT}{LOCAL_PATH}", updates, args.rate, args.concurrency, args.secret
+        )
+        expected = len(updates) - errors
+        while len(handled_at) < expected:
+            await asyncio.sleep(0.01)
+        elapsed = time.perf_counter() - started
+    finally:
+        consumer.cancel()
+        await processor.shutdown()
+        await server.stop()
+    end_to_end = [handled_at[uid] - sent_at[uid] for uid in handled_at]
+    return elapsed, acks, errors, end_to_end
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--updates", help="файл JSONL с записанными обновлениями")
+    parser.add_argument("--chats", type=int, default=50)
+    parser.add_argument("--per-chat", type=int, default=20)
+    parser.add_argument("--rate", type=float, default=0, help="обновлений в секунду, 0 - без ограничения")
+    parser.add_argument("--concurrency", type=int, default=64, help="одновременных HTTP-запросов")
+    parser.add_argument("--url", help="адрес webhook запущенного бота; без него - локальный сервер")
+    parser.add_argument("--secret", default="benchmark-secret", help="секретный токен webhook")
+    parser.add_argument("--latency", type=float, default=0.02, help="время обработки обновления (локально), с")
+    parser.add_argument("--processing-concurrency", type=int, default=16)
+    args = parser.parse_args()
+
+    updates = load_updates(args.updates) if args.updates else make_updates(args.chats, args.per_chat)
+    print(f"Обновлений: {len(updates)}, частота: {args.rate or 'без ограничения'}")
+    if args.url:
+        started = time.perf_counter()
+        _, acks, errors = await post_all(args.url, updates, args.rate, args.concurrency, args.secret)
+        elapsed = time.perf_counter() - started
+        end_to_end = None
+    else:
+        elapsed, acks, errors, end_to_end = await run_local(updates, args)
+
+    print(f"Время: {elapsed:.2f} с, {(len(updates) - errors) / elapsed:.1f} обновл./с, ошибок: {errors}")
+    print(latency_line("Ответ webhook", acks))
+    if end_to_end is not None:
+        print(latency_line("До конца обработки", end_to_end))
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -2,7 +2,8 @@ import logging
 import asyncio
 from telegram.ext import Application  
 from telegram.error import BadRequest
-from datetime import datetime
+from collections import OrderedDict
+from datetime import datetime, timedelta
 from telegram import Update, KeyboardButton, ReplyKeyboardMarkup, InlineKeyboardButton, InlineKeyboardMarkup
 from telegram.ext import (
     ApplicationBuilder,
@@ -13,20 +14,33 @@ from telegram.ext import (
     CallbackContext,
     CallbackQueryHandler
 )
-from db import db
-import re
-import json
-from config import BOT_TOKEN, ADMINS, ADMIN_INFO, USM_SCORES, CONSULTANT_SCORES, price_text, rules_text, SUPERADMINS
+from db import (
+    DAY_SLOT_CAPACITY, REQUEST_KIND_EARLY_LEAVE, SETTING_CONSULTANT_SCORES, SETTING_PRICE_TEXT,
+    SETTING_RULES_TEXT, SETTING_USM_SCORES, available_points, db,
+)
+from broadcast import broadcaster
+from outbox import OutboxWorker
+from persistence import SQLitePersistence
+from scheduler import CATCHUP_ONCE, Scheduler
+from update_processor import PerChatUpdateProcessor
+from webhook import WebhookServer
+from router import NUMBER, CallbackRouter, TextRouter
+from keyboards import employee_picker, main_menu_markup
+from config import BOT_TOKEN, ADMINS, ADMIN_INFO, USM_SCORES, CONSULTANT_SCORES, price_text, rules_text, SUPERADMINS, MAX_CONCURRENT_UPDATES
+from config import USE_WEBHOOK, WEBHOOK_URL, WEBHOOK_LISTEN, WEBHOOK_PORT, WEBHOOK_PATH, WEBHOOK_SECRET_TOKEN
+from config import BOT_API_BASE_URL
 from calendar import monthrange, month_name
 import locale
 import os
+import uuid
 # Состояния ConversationHandler
 (
     MAIN_MENU, CHOOSE_ACTION, ENTER_DESCRIPTION, SELECT_USER,
     SELECT_REASON, CONFIRM_POINTS, SELECT_EMPLOYEE_FOR_HISTORY, SELECT_ACTION,
     ENTER_CUSTOM_POINTS, ENTER_DEDUCT_POINTS, REGISTRATION_FIO, REGISTRATION_ROLE, EDIT_TEXT_INPUT,
-    SELECT_USAGE_TYPE, SELECT_DATE, CONFIRM_REQUEST, CANCEL_REQUEST, EDIT_PRICE_LIST, SELECT_PRICE_ITEM, ENTER_NEW_POINTS    # Добавленные состояния
-) = range(20)
+    SELECT_USAGE_TYPE, SELECT_DATE, CONFIRM_REQUEST, CANCEL_REQUEST, EDIT_PRICE_LIST, SELECT_PRICE_ITEM, ENTER_NEW_POINTS,    # Добавленные состояния
+    BULK_SELECT_ROLE, BULK_SELECT_REASON
+) = range(22)
 
 locale.setlocale(locale.LC_ALL, 'ru_RU.UTF-8')
 admins_list = set(ADMINS + SUPERADMINS)
@@ -37,6 +51,18 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+HISTORY_PAGE_SIZE = 15  # Записей истории на одной странице
+CALENDAR_CACHE_SIZE = 64  # Сколько готовых клавиатур календаря держать в памяти
+EARLY_LEAVE_HOUR_COST = 150  # Стоимость одного часа ухода раньше, баллов
+# Значения из config.py - только начальные, дальше настройки меняются из бота
+SETTINGS_DEFAULTS = {
+    SETTING_USM_SCORES: USM_SCORES,
+    SETTING_CONSULTANT_SCORES: CONSULTANT_SCORES,
+    SETTING_PRICE_TEXT: price_text,
+    SETTING_RULES_TEXT: rules_text,
+}
+
+
 async def handle_main_menu_button(update: Update, context: CallbackContext):
     """Обработчик кнопки 'Главное меню'."""
     await show_main_menu(update)  # Отправляем главное меню
@@ -72,51 +98,16 @@ async def start(update: Update, context: CallbackContext):
 
 async def show_main_menu(update: Update):
     """Отображение главного меню."""
-    user_id = update.effective_user.id
-    if user_id in ADMINS:
-        buttons = [
-            [KeyboardButton("Начислить/Списать баллы")],
-            [KeyboardButton("Очередь использования баллов")],
-            [KeyboardButton("Заявки на сегодня")],  # Новая кнопка
-            [KeyboardButton("Проверка заявок на использование")],
-            [KeyboardButton("История сотрудника")],
-            [KeyboardButton("Сотрудники")],
-            [KeyboardButton("Создать резервную копию")],
-            [KeyboardButton("Изменения")],
-        ]
-    elif user_id in SUPERADMINS:
-        buttons = [
-            [KeyboardButton("Начислить/Списать баллы")],
-            [KeyboardButton("Начислить/Списать баллы (silent)")],
-            [KeyboardButton("Очередь использования баллов")],
-            [KeyboardButton("Заявки на сегодня")],  # Новая кнопка
-            [KeyboardButton("Проверка заявок на использование")],
-            [KeyboardButton("История сотрудника")],
-            [KeyboardButton("Сотрудники")],
-            [KeyboardButton("Создать резервную копию")],
-            [KeyboardButton("Изменения")],
-        ]
-    else:
-        buttons = [
-            [KeyboardButton("Мой баланс")],
-            [KeyboardButton("История")],
-            [KeyboardButton("Использовать баллы")],         
-            [KeyboardButton("Мои заявки")], 
-            [KeyboardButton("Заявки на сегодня")],  # Новая кнопка
-            [KeyboardButton("Сотрудники")],
-            [KeyboardButton("Прайс-лист")],
-            [KeyboardButton("Правила")],
-        ]
-    markup = ReplyKeyboardMarkup(buttons, resize_keyboard=True)
+    markup = main_menu_markup(update.effective_user.id)
     await update.message.reply_text("Выберите действие:", reply_markup=markup)
 
 async def send_price(update: Update, context: CallbackContext):
     """Отправка прайс-листа."""
-    await update.message.reply_text(price_text)
+    await update.message.reply_text(db.get_setting(SETTING_PRICE_TEXT))
 
 async def send_rules(update: Update, context: CallbackContext):
     """Отправка правил."""
-    await update.message.reply_text(rules_text)
+    await update.message.reply_text(db.get_setting(SETTING_RULES_TEXT))
 
 async def registration_fio(update: Update, context: CallbackContext):
     """Регистрация ФИО пользователя."""
@@ -145,6 +136,10 @@ async def registration_role(update: Update, context: CallbackContext):
 
 
 #------------------------------Начисление баллов---------------------------------#
+def score_table_for_role(role: str) -> dict:
+    """Баллы за причины для роли (из кэша настроек, не изменять на месте)."""
+    return db.get_setting(SETTING_USM_SCORES if role == "УСМ" else SETTING_CONSULTANT_SCORES)
+
 async def edit_price_lists(update: Update, context: CallbackContext):
     """Меню выбора прайс-листа для редактирования"""
     buttons = [
@@ -163,9 +158,9 @@ async def select_price_list(update: Update, context: CallbackContext):
         await show_main_menu(update)
         return MAIN_MENU
     
-    price_list = USM_SCORES if "УСМ" in choice else CONSULTANT_SCORES
-    context.user_data['current_price_list'] = price_list
-    context.user_data['price_list_name'] = "USM_SCORES" if "УСМ" in choice else "CONSULTANT_SCORES"
+    price_list_key = SETTING_USM_SCORES if "УСМ" in choice else SETTING_CONSULTANT_SCORES
+    price_list = db.get_setting(price_list_key)
+    context.user_data['price_list_key'] = price_list_key
     
     # Создаем клавиатуру с пунктами прайса
     buttons = [[KeyboardButton(item)] for item in price_list.keys()]
@@ -186,7 +181,7 @@ async def select_price_item(update: Update, context: CallbackContext):
     if item == "Назад":
         return await edit_price_lists(update, context)
     
-    price_list = context.user_data['current_price_list']
+    price_list = db.get_setting(context.user_data['price_list_key'])
     if item not in price_list:
         await update.message.reply_text("Пожалуйста, выберите пункт из списка.")
         return SELECT_PRICE_ITEM
@@ -208,29 +203,8 @@ async def save_new_points(update: Update, context: CallbackContext):
         await update.message.reply_text("Пожалуйста, введите положительное целое число.")
         return ENTER_NEW_POINTS
     
-    price_list = context.user_data['current_price_list']
     item = context.user_data['selected_item']
-    price_list[item] = new_points
-    
-    # Сохраняем изменения в config.py
-    price_list_name = context.user_data['price_list_name']
-    with open('config.py', 'r+', encoding='utf-8') as f:
-        content = f.read()
-        if price_list_name == "USM_SCORES":
-            content = re.sub(
-                r'USM_SCORES = {[^}]*}',
-                f'USM_SCORES = {json.dumps(USM_SCORES, ensure_ascii=False, indent=4)}',
-                content
-            )
-        else:
-            content = re.sub(
-                r'CONSULTANT_SCORES = {[^}]*}',
-                f'CONSULTANT_SCORES = {json.dumps(CONSULTANT_SCORES, ensure_ascii=False, indent=4)}',
-                content
-            )
-        f.seek(0)
-        f.write(content)
-        f.truncate()
+    price_list = await db.set_setting_item(context.user_data['price_list_key'], item, new_points)
     
     await update.message.reply_text(
         f"✅ Значение для '{item}' изменено на {new_points} баллов.\n\n"
@@ -272,12 +246,10 @@ async def edit_text_input(update: Update, context: CallbackContext):
     new_text = update.message.text.strip()
 
     if mode == 'rules':
-        global rules_text
-        rules_text = new_text
+        await db.set_setting(SETTING_RULES_TEXT, new_text)
         await update.message.reply_text("✅ Правила обновлены.")
     elif mode == 'price':
-        global price_text
-        price_text = new_text
+        await db.set_setting(SETTING_PRICE_TEXT, new_text)
         await update.message.reply_text("✅ Прайс-лист обновлён.")
     else:
         await update.message.reply_text("⚠️ Неизвестный режим редактирования.")
@@ -344,26 +316,50 @@ async def show_employees_by_role(update: Update, context: CallbackContext):
 
     await query.edit_message_text(msg)
 
-async def notify_user_points_change(context: CallbackContext, user_id: int, points: int, reason: str):
-    """Уведомление пользователя об изменении баллов."""
-    user = await db.get_user(user_id)
-    if not user:
-        return
+def points_change_notification(points: int, reason: str):
+    """Уведомление пользователя об изменении баллов.
+
+    Возвращает функцию для db.add_points: текст строится по обновлённой строке
+    пользователя и доставляется через outbox.
+    """
     sign = '+' if points > 0 else ''
-    text = (
-        f"{user[1]}, вам {'начислено' if points > 0 else 'списано'} {sign}{points} баллов за: {reason}.\n"
-        f"Текущий баланс: {user[3]} баллов."
-    )
-    try:
-        await context.bot.send_message(chat_id=user_id, text=text)
-    except Exception as e:
-        logger.error(f"Не удалось отправить уведомление пользователю {user_id}: {e}")
+
+    def build(user):
+        return (
+            f"{user[1]}, вам {'начислено' if points > 0 else 'списано'} {sign}{points} баллов за: {reason}.\n"
+            f"Текущий баланс: {user[3]} баллов."
+        )
+    return build
+
+
+def admin_notifications(text: str, reply_markup=None):
+    """Одно и то же уведомление каждому администратору - для outbox в db."""
+    markup = reply_markup.to_json() if reply_markup is not None else None
+    return [(admin_id, text, markup) for admin_id in admins_list]
+
+
+def approved_today_text(today_requests) -> str:
+    """Список одобренных на сегодня заявок для уведомления администраторов."""
+    today_text = "\n\n📅 Сегодня одобрены:\n"
+    if today_requests:
+        for req in today_requests:
+            today_text += f"• {req['full_name']} ({req['role']}) — {req['description']}\n"
+    else:
+        today_text += "Нет одобренных заявок"
+    return today_text
+
+
+def new_request_markup(req_id: int):
+    return InlineKeyboardMarkup([
+        [
+            InlineKeyboardButton("✅ Одобрить", callback_data=f"approve_{req_id}"),
+            InlineKeyboardButton("❌ Отклонить", callback_data=f"reject_{req_id}")
+        ]
+    ])
 
 async def begin_employee_history(update: Update, context: CallbackContext):
     """Начало просмотра истории сотрудника."""
-    users = await db.get_all_users()
-    buttons = [[KeyboardButton(f"{u[1]} ({u[0]})")] for u in users]
-    markup = ReplyKeyboardMarkup(buttons, resize_keyboard=True, one_time_keyboard=True)
+    markup = await employee_picker.markup()
     await update.message.reply_text("Выберите сотрудника для просмотра истории:", reply_markup=markup)
     return SELECT_EMPLOYEE_FOR_HISTORY
 
@@ -376,27 +372,13 @@ async def show_employee_history(update: Update, context: CallbackContext):
         await update.message.reply_text("Неверный формат. Попробуйте снова.")
         return SELECT_EMPLOYEE_FOR_HISTORY
 
-    history = await db.get_employee_history(user_id)
     user = await db.get_user(user_id)
     if not user:
         await update.message.reply_text("Сотрудник не найден.")
         return SELECT_EMPLOYEE_FOR_HISTORY
 
-    if not history:
-        text = f"История операций для {user[1]} пуста.\nТекущий баланс: {user[3]} баллов."
-    else:
-        text = f"Последние операции для {user[1]} (текущий баланс: {user[3]} баллов):\n\n"
-        for record in history:
-            admin_id = record['admin_id']
-            points = record['points']
-            reason = record['reason']
-            timestamp = datetime.strptime(record['timestamp'], "%Y-%m-%d %H:%M:%S")
-            timestamp = timestamp.strftime("%Y-%m-%d %H:%M")
-            admin_name = ADMIN_INFO.get(admin_id, ("Неизвестный",))[0]
-            sign = "+" if points > 0 else ""
-            text += f"{timestamp}: {sign}{points} за {reason} (от {admin_name})\n"
-
-    await update.message.reply_text(text)
+    text, markup = await build_history_page(user_id, update.effective_user.id)
+    await update.message.reply_text(text, reply_markup=markup)
     await show_main_menu(update)
     return MAIN_MENU
 
@@ -404,29 +386,87 @@ async def show_employee_history(update: Update, context: CallbackContext):
 async def handle_balance(update: Update, context: CallbackContext):
     """Показать баланс пользователя."""
     user = await db.get_user(update.effective_user.id)
-    if user:
+    if user and user['held']:
+        await update.message.reply_text(
+            f"{user[1]}, ваш баланс: {user[3]} баллов\n"
+            f"Доступно: {available_points(user)} (в резерве по заявкам: {user['held']})"
+        )
+    elif user:
         await update.message.reply_text(f"{user[1]}, ваш баланс: {user[3]} баллов")
     else:
         await update.message.reply_text("Вы не зарегистрированы в системе.")
 
 async def handle_history(update: Update, context: CallbackContext):
-    history = await db.get_employee_history(update.effective_user.id)
-    if not history:
-        await update.message.reply_text("История пуста.")
-        return
+    user_id = update.effective_user.id
+    text, markup = await build_history_page(user_id, user_id)
+    await update.message.reply_text(text, reply_markup=markup)
+
+
+def format_history_record(record) -> str:
+    points = record['points']
+    timestamp = datetime.strptime(record['timestamp'], "%Y-%m-%d %H:%M:%S")
+    timestamp = timestamp.strftime("%Y-%m-%d %H:%M")
+    admin_name = ADMIN_INFO.get(record['admin_id'], ("Неизвестный",))[0]
+    sign = "+" if points > 0 else ""
+    return f"{timestamp}: {sign}{points} за {record['reason']} (от {admin_name})"
+
+
+def history_callback_data(user_id: int, direction: str, record) -> str:
+    """callback_data кнопки навигации: hist_<user_id>_<o|n>_<ГГГГММДДччммсс>_<id записи>"""
+    timestamp = datetime.strptime(record['timestamp'], "%Y-%m-%d %H:%M:%S").strftime("%Y%m%d%H%M%S")
+    return f"hist_{user_id}_{direction}_{timestamp}_{record['id']}"
+
+
+async def build_history_page(user_id: int, viewer_id: int, cursor=None, newer: bool = False):
+    """Текст и клавиатура навигации для одной страницы истории."""
+    rows, has_more = await db.get_history_page(user_id, HISTORY_PAGE_SIZE, cursor=cursor, newer=newer)
+
+    if viewer_id == user_id:
+        title = "История операций:"
+        empty = "История пуста."
+    else:
+        user = await db.get_user(user_id)
+        name, balance = (user[1], user[3]) if user else (f"ID {user_id}", 0)
+        title = f"Последние операции для {name} (текущий баланс: {balance} баллов):\n"
+        empty = f"История операций для {name} пуста.\nТекущий баланс: {balance} баллов."
 
-    text = "История операций:\n"
-    for record in history:
-        admin_id = record['admin_id']
-        points = record['points']
-        reason = record['reason']
-        timestamp = datetime.strptime(record['timestamp'], "%Y-%m-%d %H:%M:%S")
-        timestamp = timestamp.strftime("%Y-%m-%d %H:%M")
-        admin_name = ADMIN_INFO.get(admin_id, ("Неизвестный",))[0]
-        sign = "+" if points > 0 else ""
-        text += f"{timestamp}: {sign}{points} за {reason} (от {admin_name})\n"
+    if not rows:
+        return empty, None
 
-    await update.message.reply_text(text)
+    text = title + "\n" + "\n".join(format_history_record(record) for record in rows)
+
+    # Новее - если пришли со страницы новее или их нашлось больше страницы;
+    # старше - аналогично в обратную сторону
+    has_newer = has_more if newer else cursor is not None
+    has_older = cursor is not None if newer else has_more
+    buttons = []
+    if has_newer:
+        buttons.append(InlineKeyboardButton("◀️", callback_data=history_callback_data(user_id, "n", rows[0])))
+    if has_older:
+        buttons.append(InlineKeyboardButton("▶️", callback_data=history_callback_data(user_id, "o", rows[-1])))
+    return text, InlineKeyboardMarkup([buttons]) if buttons else None
+
+
+async def handle_history_page(update: Update, context: CallbackContext):
+    """Переключение страниц истории."""
+    query = update.callback_query
+    _, user_id, direction, timestamp, record_id = query.data.split("_")
+    user_id = int(user_id)
+    viewer_id = query.from_user.id
+    if viewer_id != user_id and viewer_id not in admins_list:
+        await query.answer("⛔️ Нет доступа к этой истории.", show_alert=True)
+        return
+    await query.answer()
+
+    cursor = (
+        datetime.strptime(timestamp, "%Y%m%d%H%M%S").strftime("%Y-%m-%d %H:%M:%S"),
+        int(record_id),
+    )
+    text, markup = await build_history_page(user_id, viewer_id, cursor=cursor, newer=direction == "n")
+    try:
+        await query.edit_message_text(text, reply_markup=markup)
+    except BadRequest:
+        pass
 
 
 
@@ -448,6 +488,7 @@ async def begin_point_change(update: Update, context: CallbackContext):
     buttons = [
         [KeyboardButton("Начислить баллы")],
         [KeyboardButton("Списать баллы")],
+        [KeyboardButton("Массовое начисление")],
         [KeyboardButton("Главное меню")]
     ]
     markup = ReplyKeyboardMarkup(buttons, resize_keyboard=True, one_time_keyboard=True)
@@ -460,15 +501,15 @@ async def select_action(update: Update, context: CallbackContext):
         await show_main_menu(update)  # Возвращаем в главное меню
         return MAIN_MENU
     
+    if action == "Массовое начисление":
+        return await begin_bulk_award(update, context)
+
     if action not in ["Начислить баллы", "Списать баллы"]:
         await update.message.reply_text("Пожалуйста, выберите из вариантов.")
         return SELECT_ACTION
 
     context.user_data['action'] = action
-    users = await db.get_all_users()
-    buttons = [[KeyboardButton(f"{u[1]} ({u[0]})")] for u in users]
-    buttons.append([KeyboardButton("Главное меню")])
-    markup = ReplyKeyboardMarkup(buttons, resize_keyboard=True, one_time_keyboard=True)
+    markup = await employee_picker.markup(with_menu_button=True)
     await update.message.reply_text("Выберите сотрудника:", reply_markup=markup)
     return SELECT_USER
 
@@ -487,6 +528,8 @@ async def select_user(update: Update, context: CallbackContext):
         return SELECT_USER
 
     context.user_data['selected_user_id'] = user_id
+    # Ключ операции: повторная отправка той же формы не начислит баллы дважды
+    context.user_data['op_key'] = uuid.uuid4().hex
     action = context.user_data['action']
 
     
@@ -502,8 +545,9 @@ async def select_user(update: Update, context: CallbackContext):
             await update.message.reply_text("Сотрудник не найден.")
             return SELECT_USER
 
-        score_table = USM_SCORES if user[2] == "УСМ" else CONSULTANT_SCORES
-        context.user_data['score_table'] = score_table
+        # Храним роль, а не таблицу: правки баллов во время диалога видны сразу
+        context.user_data['score_role'] = user[2]
+        score_table = score_table_for_role(user[2])
 
         buttons = [[KeyboardButton(reason)] for reason in score_table.keys()]
         buttons.append([KeyboardButton("Другое")])
@@ -529,22 +573,35 @@ async def enter_deduct_points(update: Update, context: CallbackContext):
         return ENTER_DEDUCT_POINTS
 
     points = -abs(points)
-    admin_id = update.effective_user.id
-    user_id = context.user_data['selected_user_id']
-    silent = context.user_data.get('silent', False)
-
-    await db.add_points(admin_id, user_id, points, reason, silent=silent)
-    await notify_user_points_change(context, user_id, points, reason)
-    await update.message.reply_text(f"Списано {abs(points)} баллов за '{reason}'.")
+    return await apply_points_change(update, context, points, reason,
+                                     f"Списано {abs(points)} баллов за '{reason}'.")
+
+
+async def apply_points_change(update: Update, context: CallbackContext, points: int, reason: str, done_text: str):
+    """Проводит начисление/списание по данным формы и возвращает в главное меню."""
+    entry = await db.add_points(
+        update.effective_user.id,
+        context.user_data['selected_user_id'],
+        points,
+        reason,
+        silent=context.user_data.get('silent', False),
+        notify=points_change_notification(points, reason),
+        op_key=context.user_data.get('op_key'),
+    )
+    if entry.duplicate:
+        done_text = "⚠️ Эта операция уже проведена, баллы повторно не изменены."
+    elif entry.user is None:
+        done_text = "Сотрудник не найден."
+    await update.message.reply_text(done_text)
     await show_main_menu(update)
     return MAIN_MENU
 
 
 async def select_reason(update: Update, context: CallbackContext):
     reason = update.message.text
-    score_table = context.user_data.get('score_table', {})
+    role = context.user_data.get('score_role')
+    score_table = score_table_for_role(role) if role else {}
     action = context.user_data.get('action', 'Начислить баллы')
-    user_id = context.user_data['selected_user_id']
 
     if reason == "Другое":
         await update.message.reply_text("Введите количество баллов (целое число):")
@@ -562,14 +619,8 @@ async def select_reason(update: Update, context: CallbackContext):
     if action == "Списать баллы":
         points = -abs(points)
 
-    admin_id = update.effective_user.id
-    silent = context.user_data.get('silent', False)
-
-    await db.add_points(admin_id, user_id, points, reason, silent=silent)
-    await notify_user_points_change(context, user_id, points, reason)
-    await update.message.reply_text(f"{'Начислено' if points > 0 else 'Списано'} {abs(points)} баллов за '{reason}'")
-    await show_main_menu(update)
-    return MAIN_MENU
+    return await apply_points_change(update, context, points, reason,
+                                     f"{'Начислено' if points > 0 else 'Списано'} {abs(points)} баллов за '{reason}'")
 
 
 async def enter_custom_points(update: Update, context: CallbackContext):
@@ -583,14 +634,159 @@ async def enter_custom_points(update: Update, context: CallbackContext):
     if action == "Списать баллы":
         points = -abs(points)
 
-    admin_id = update.effective_user.id
-    user_id = context.user_data['selected_user_id']
     reason = "Другое (вручную)"
-    silent = context.user_data.get('silent', False)
+    return await apply_points_change(update, context, points, reason,
+                                     f"{'Начислено' if points > 0 else 'Списано'} {abs(points)} баллов.")
+
+
+#------------------------------Массовое начисление---------------------------------#
+BULK_APPLY = "✅ Провести начисления"
+
+
+def bulk_award_notification(user, items):
+    """Одно уведомление на сотрудника по всем его начислениям из пачки."""
+    lines = "\n".join(f"+{points} за: {reason}" for points, reason in items)
+    return f"{user[1]}, вам начислены баллы:\n{lines}\nТекущий баланс: {user[3]} баллов."
+
+
+def bulk_score_table(bulk):
+    return score_table_for_role(bulk['role'])
+
+
+def bulk_users_markup(bulk, reason_index: int) -> InlineKeyboardMarkup:
+    """Список сотрудников роли с отметками для одной причины."""
+    reason = list(bulk_score_table(bulk))[reason_index]
+    selected = bulk['awards'].get(reason, [])
+    buttons = [
+        [InlineKeyboardButton(f"{'✅' if user_id in selected else '▫️'} {name}",
+                              callback_data=f"bulk_{reason_index}_{user_id}")]
+        for user_id, name in bulk['users']
+    ]
+    buttons.append([InlineKeyboardButton("Готово", callback_data=f"bulk_{reason_index}_done")])
+    return InlineKeyboardMarkup(buttons)
+
+
+async def begin_bulk_award(update: Update, context: CallbackContext):
+    """Массовое начисление: роль -> причины с отметкой сотрудников -> одна транзакция."""
+    buttons = [[KeyboardButton("УСМ")], [KeyboardButton("Консультант")], [KeyboardButton("Главное меню")]]
+    markup = ReplyKeyboardMarkup(buttons, resize_keyboard=True, one_time_keyboard=True)
+    await update.message.reply_text("Выберите роль сотрудников:", reply_markup=markup)
+    return BULK_SELECT_ROLE
+
+
+async def bulk_select_role(update: Update, context: CallbackContext):
+    role = update.message.text
+    if role == "Главное меню":
+        await show_main_menu(update)
+        return MAIN_MENU
+    if role not in ("УСМ", "Консультант"):
+        await update.message.reply_text("Пожалуйста, выберите роль из кнопок.")
+        return BULK_SELECT_ROLE
+
+    users = [u for u in await db.get_all_users() if u[2] == role]
+    if not users:
+        await update.message.reply_text(f"Сотрудники с ролью {role} не найдены.")
+        return BULK_SELECT_ROLE
+
+    context.user_data['bulk'] = {
+        'role': role,
+        'users': [(u[0], u[1]) for u in users],
+        'awards': {},  # причина -> список user_id
+        'op_key': uuid.uuid4().hex,
+    }
+    buttons = [[KeyboardButton(reason)] for reason in bulk_score_table(context.user_data['bulk'])]
+    buttons.append([KeyboardButton(BULK_APPLY)])
+    buttons.append([KeyboardButton("Главное меню")])
+    markup = ReplyKeyboardMarkup(buttons, resize_keyboard=True)
+    await update.message.reply_text(
+        "Выберите причину и отметьте сотрудников. Когда все причины заполнены, "
+        f"нажмите «{BULK_APPLY}».",
+        reply_markup=markup
+    )
+    return BULK_SELECT_REASON
+
+
+async def bulk_select_reason(update: Update, context: CallbackContext):
+    text = update.message.text
+    bulk = context.user_data.get('bulk')
+    if text == "Главное меню" or bulk is None:
+        context.user_data.pop('bulk', None)
+        await show_main_menu(update)
+        return MAIN_MENU
+    if text == BULK_APPLY:
+        return await apply_bulk_award(update, context)
+
+    reasons = list(bulk_score_table(bulk))
+    if text not in reasons:
+        await update.message.reply_text("Неверная причина. Попробуйте снова.")
+        return BULK_SELECT_REASON
+
+    await update.message.reply_text(
+        f"{text} ({bulk_score_table(bulk)[text]} баллов). Отметьте сотрудников:",
+        reply_markup=bulk_users_markup(bulk, reasons.index(text))
+    )
+    return BULK_SELECT_REASON
+
+
+async def handle_bulk_toggle(update: Update, context: CallbackContext):
+    """Отметка сотрудника для причины (bulk_<причина>_<user_id>) и завершение выбора (bulk_<причина>_done)."""
+    query = update.callback_query
+    bulk = context.user_data.get('bulk')
+    if bulk is None:
+        await query.answer("Массовое начисление уже завершено.", show_alert=True)
+        return MAIN_MENU
 
-    await db.add_points(admin_id, user_id, points, reason, silent=silent)
-    await notify_user_points_change(context, user_id, points, reason)
-    await update.message.reply_text(f"{'Начислено' if points > 0 else 'Списано'} {abs(points)} баллов.")
+    _, reason_index, target = query.data.split("_")
+    reason_index = int(reason_index)
+    reasons = list(bulk_score_table(bulk))
+    if reason_index >= len(reasons):
+        await query.answer("Список причин изменился, выберите причину заново.", show_alert=True)
+        return BULK_SELECT_REASON
+    reason = reasons[reason_index]
+    selected = bulk['awards'].setdefault(reason, [])
+    await query.answer()
+
+    if target == "done":
+        names = dict(bulk['users'])
+        names = ", ".join(names[user_id] for user_id in selected if user_id in names) or "никто не отмечен"
+        await query.edit_message_text(f"{reason}: {names}")
+        return BULK_SELECT_REASON
+
+    user_id = int(target)
+    if user_id in selected:
+        selected.remove(user_id)
+    elif user_id in dict(bulk['users']):
+        selected.append(user_id)
+    await query.edit_message_reply_markup(reply_markup=bulk_users_markup(bulk, reason_index))
+    return BULK_SELECT_REASON
+
+
+async def apply_bulk_award(update: Update, context: CallbackContext):
+    bulk = context.user_data['bulk']
+    score_table = bulk_score_table(bulk)
+    awards = [
+        (user_id, score_table[reason], reason)
+        for reason, user_ids in bulk['awards'].items() if reason in score_table
+        for user_id in user_ids
+    ]
+    if not awards:
+        await update.message.reply_text("Не отмечено ни одного сотрудника.")
+        return BULK_SELECT_REASON
+
+    result = await db.bulk_add_points(
+        update.effective_user.id,
+        awards,
+        silent=context.user_data.get('silent', False),
+        notify=bulk_award_notification,
+        op_key=bulk['op_key'],
+    )
+    context.user_data.pop('bulk', None)
+    if result.duplicate:
+        await update.message.reply_text("⚠️ Эти начисления уже проведены, баллы повторно не изменены.")
+    else:
+        await update.message.reply_text(
+            f"Проведено начислений: {result.applied}, сотрудников: {len(result.users)}."
+        )
     await show_main_menu(update)
     return MAIN_MENU
 
@@ -662,29 +858,43 @@ async def handle_queue_buttons(update, context):
 async def handle_admin_action(update: Update, context: CallbackContext):
     """Обработка действий администратора."""
     query = update.callback_query
-    await query.answer()
     action, req_id = query.data.split("_")
     req_id = int(req_id)
 
     request_data = await db.get_request(req_id)
     if not request_data:
+        await query.answer()
         await query.edit_message_text("❌ Заявка не найдена.")
         return
 
     user_id, desc, status, ts = request_data
 
     if status != "pending":
+        await query.answer()
         await query.edit_message_text(f"⚠️ Заявка уже была обработана ({status}).")
         return
 
     if action == "approve":
-        await db.approve_request(req_id)
-        await context.bot.send_message(chat_id=user_id, text="✅ Ваша заявка была одобрена!")
-        await query.edit_message_text("✅ Заявка одобрена.")
+        result = await db.approve_request(req_id, notify_text="✅ Ваша заявка была одобрена!",
+                                          admin_id=query.from_user.id)
+        if result == 'full':
+            # Заявка остаётся на рассмотрении - её можно отклонить
+            await query.answer(
+                "⛔️ На эту дату уже нет свободных мест для роли сотрудника.",
+                show_alert=True
+            )
+            return
+        await query.answer()
+        if result == 'approved':
+            await query.edit_message_text("✅ Заявка одобрена.")
+        else:
+            await query.edit_message_text("⚠️ Заявка уже была обработана.")
     elif action == "reject":
-        await db.reject_request(req_id)
-        await context.bot.send_message(chat_id=user_id, text="❌ Ваша заявка была отклонена.")
-        await query.edit_message_text("❌ Заявка отклонена.")
+        await query.answer()
+        if await db.reject_request(req_id, notify_text="❌ Ваша заявка была отклонена."):
+            await query.edit_message_text("❌ Заявка отклонена.")
+        else:
+            await query.edit_message_text("⚠️ Заявка уже была обработана.")
 
 #-------------------------------------------------------------------------------------------------------------#
 async def show_my_requests(update: Update, context: CallbackContext):
@@ -723,22 +933,18 @@ async def handle_request_deletion(update: Update, context: CallbackContext):
         await query.edit_message_text("Заявка не найдена")
         return
 
-    success = await db.delete_request(req_id, user_id)
+    # Уведомления админам уходят через outbox той же транзакцией, что и удаление
+    def notify(request, user):
+        return admin_notifications(
+            f"❌ Сотрудник {user[1]} удалил свою заявку:\n"
+            f"ID: {req_id}\n"
+            f"Описание: {request['description']}\n"
+        )
+
+    success = await db.delete_request(req_id, user_id, notify=notify)
 
     if success:
         await query.edit_message_text("✅ Заявка удалена")
-
-        user = await db.get_user(user_id)
-        for admin_id in admins_list :
-            try:
-                await context.bot.send_message(
-                    chat_id=admin_id,
-                    text=f"❌ Сотрудник {user[1]} удалил свою заявку:\n"
-                         f"ID: {req_id}\n"
-                         f"Описание: {request['description']}\n"
-                )
-            except Exception as e:
-                logging.error(f"Не удалось уведомить админа {admin_id}: {e}")
     else: 
         await query.edit_message_text("❌ Не удалось удалить заявку или она вам не принадлежит.")
 
@@ -750,8 +956,11 @@ async def use_points(update: Update, context: CallbackContext):
         await update.message.reply_text("Вы не зарегистрированы.")
         return MAIN_MENU
 
-    if user[3] <= 0:
-        await update.message.reply_text(f"Заявка не может быть отправлена. \nВаш баланс: {user[3]}")
+    # Баллы в резерве по необработанным заявкам потратить нельзя
+    if available_points(user) <= 0:
+        await update.message.reply_text(
+            f"Заявка не может быть отправлена. \nДоступно: {available_points(user)} (в резерве по заявкам: {user['held']})"
+        )
         return MAIN_MENU
 
     # Перенаправляем в новое состояние выбора типа использования
@@ -773,11 +982,14 @@ async def back_to_main_menu(update: Update, context: CallbackContext):
     return MAIN_MENU
 #--------------------------ебучий календарь------------------------------------------------#
 
-def generate_calendar_keyboard(year: int, month: int, min_date: datetime = None) -> InlineKeyboardMarkup:
+def generate_calendar_keyboard(year: int, month: int, min_date: datetime = None,
+                               occupancy: dict = None) -> InlineKeyboardMarkup:
     """
     Генерирует инлайн-клавиатуру календаря для указанного месяца и года.
     min_date - минимальная доступная дата (сегодня или позже)
+    occupancy - занятость дней из db.get_month_occupancy; заполненные дни помечаются ✖
     """
+    occupancy = occupancy or {}
     # Если min_date не указана, используем сегодня
     if min_date is None:
         min_date = datetime.now().date()
@@ -825,6 +1037,9 @@ def generate_calendar_keyboard(year: int, month: int, min_date: datetime = None)
         if date_obj < min_date:
             # Прошедшие даты - неактивны
             current_row.append(InlineKeyboardButton(" ", callback_data="ignore"))
+        elif occupancy.get(date_obj.isoformat(), 0) >= DAY_SLOT_CAPACITY:
+            # Все места на этот день заняты
+            current_row.append(InlineKeyboardButton(f"✖{day}", callback_data="full"))
         else:
             # Активные даты
             current_row.append(InlineKeyboardButton(str(day), callback_data=f"date_{year}-{month}-{day}"))
@@ -848,6 +1063,29 @@ def generate_calendar_keyboard(year: int, month: int, min_date: datetime = None)
     
     return InlineKeyboardMarkup(keyboard)
 
+
+# Готовые клавиатуры календаря: (год, месяц, min_date, роль, db.occupancy_version) -> разметка.
+# Смена дня или любое изменение одобренных заявок даёт новый ключ, старые записи вытесняются LRU.
+_calendar_cache = OrderedDict()
+
+
+async def build_calendar(user_id: int, year: int, month: int) -> InlineKeyboardMarkup:
+    """Календарь месяца с учётом занятости дней для роли пользователя (один запрос на месяц)."""
+    user = await db.get_user(user_id)
+    role = user['role'] if user else None
+    key = (year, month, datetime.now().date(), role, db.occupancy_version)
+    markup = _calendar_cache.get(key)
+    if markup is not None:
+        _calendar_cache.move_to_end(key)
+        return markup
+
+    occupancy = await db.get_month_occupancy(year, month, role) if role else {}
+    markup = generate_calendar_keyboard(year, month, min_date=key[2], occupancy=occupancy)
+    _calendar_cache[key] = markup
+    while len(_calendar_cache) > CALENDAR_CACHE_SIZE:
+        _calendar_cache.popitem(last=False)
+    return markup
+
 async def select_usage_type(update: Update, context: CallbackContext):
     """Обработка выбора типа использования баллов."""
     choice = update.message.text
@@ -861,7 +1099,7 @@ async def select_usage_type(update: Update, context: CallbackContext):
         today = datetime.now().date()
         
         # Генерируем календарь на текущий месяц
-        keyboard = generate_calendar_keyboard(today.year, today.month, min_date=today)
+        keyboard = await build_calendar(update.effective_user.id, today.year, today.month)
         
         await update.message.reply_text(
             "Выберите дату для ухода:",
@@ -879,13 +1117,14 @@ async def select_usage_type(update: Update, context: CallbackContext):
 async def handle_calendar(update: Update, context: CallbackContext):
     """Обработка выбора даты в календаре."""
     query = update.callback_query
-    await query.answer()
+    # Для выбора даты ответ на запрос отправляется ниже (возможно, с предупреждением)
+    if not query.data.startswith("date_"):
+        await query.answer()
     
     # Обработка навигации (переключение месяцев)
     if query.data.startswith("nav_"):
         year, month = map(int, query.data.split("_")[1].split("-"))
-        min_date = datetime.now().date()
-        keyboard = generate_calendar_keyboard(year, month, min_date=min_date)
+        keyboard = await build_calendar(query.from_user.id, year, month)
         try:
             await query.edit_message_text(
                 "Выберите дату для ухода:",
@@ -922,6 +1161,14 @@ async def handle_calendar(update: Update, context: CallbackContext):
                 show_alert=True
             )
             
+            # День заполнился после показа календаря - обновляем отметки
+            try:
+                await query.edit_message_reply_markup(
+                    reply_markup=await build_calendar(query.from_user.id, year, month)
+                )
+            except BadRequest:
+                pass
+
             # Дополнительное сообщение с деталями (если нужно)
             message = (
                 f"На {selected_date.strftime('%d.%m.%Y')} уже запланированы:\n"
@@ -943,9 +1190,10 @@ async def handle_calendar(update: Update, context: CallbackContext):
             return SELECT_DATE
         
         # Если дата доступна - продолжаем
+        await query.answer()
         context.user_data['date'] = selected_date
         hours = context.user_data['hours']
-        cost = 150 * hours
+        cost = EARLY_LEAVE_HOUR_COST * hours
         date_display = selected_date.strftime("%d.%m.%Y")
         description = f"Уйти на {hours} часа раньше {date_display} (стоимость: {cost} баллов)"
         context.user_data['description'] = description
@@ -991,41 +1239,7 @@ async def cancel_date_selection(update: Update, context: CallbackContext):
 async def show_main_menu_for_chat(context: CallbackContext, chat_id: int, user_id: int):
     """Отправка главного меню по chat_id."""
     try:
-        if user_id in ADMINS:
-            buttons = [
-                [KeyboardButton("Начислить/Списать баллы")],
-                [KeyboardButton("Очередь использования баллов")],
-                [KeyboardButton("Заявки на сегодня")], 
-                [KeyboardButton("Проверка заявок на использование")],
-                [KeyboardButton("История сотрудника")],
-                [KeyboardButton("Сотрудники")],
-                [KeyboardButton("Создать резервную копию")],
-                [KeyboardButton("Изменения")],
-            ]
-        elif user_id in SUPERADMINS:
-            buttons = [
-                [KeyboardButton("Начислить/Списать баллы")],
-                [KeyboardButton("Начислить/Списать баллы (silent)")],
-                [KeyboardButton("Очередь использования баллов")],                
-                [KeyboardButton("Заявки на сегодня")], 
-                [KeyboardButton("Проверка заявок на использование")],
-                [KeyboardButton("История сотрудника")],
-                [KeyboardButton("Сотрудники")],                
-                [KeyboardButton("Создать резервную копию")],
-                [KeyboardButton("Изменения")],
-            ]
-        else:
-            buttons = [
-                [KeyboardButton("Мой баланс")],
-                [KeyboardButton("История")],
-                [KeyboardButton("Использовать баллы")],
-                [KeyboardButton("Мои заявки")],
-                [KeyboardButton("Сотрудники")],
-                [KeyboardButton("Прайс-лист")],
-                [KeyboardButton("Правила")],
-            ]
-        
-        markup = ReplyKeyboardMarkup(buttons, resize_keyboard=True)
+        markup = main_menu_markup(user_id)
         await context.bot.send_message(
             chat_id=chat_id,
             text="Выберите действие:",
@@ -1068,7 +1282,7 @@ async def handle_date_selection(update: Update, context: CallbackContext):
             return SELECT_DATE
         
         hours = context.user_data['hours']
-        cost = 150 * hours
+        cost = EARLY_LEAVE_HOUR_COST * hours
         date_display = selected_date.strftime("%d.%m.%Y")
         description = f"Уйти на {hours} часа раньше {date_display} (стоимость: {cost} баллов)"
         
@@ -1098,25 +1312,19 @@ async def handle_date_selection(update: Update, context: CallbackContext):
         await update.message.reply_text("Неверный формат даты. Попробуйте снова.")
         return SELECT_DATE
 
-async def add_usage_request(user_id, description, usage_date=None):
-    # Если это заявка на уход раньше, сохраняем дату использования
-    if "Уйти на" in description:
-        # Извлекаем дату из описания
-        date_str = description.split()[-1].strip('()')
-        usage_date = datetime.strptime(date_str, "%d.%m.%Y").strftime("%Y-%m-%d")
-    
-    return await db.add_usage_request(user_id, description, usage_date)
-
 async def handle_confirmation(update: Update, context: CallbackContext):
     """Обработка подтверждения заявки"""
     query = update.callback_query
     await query.answer()
     
     if query.data == "confirm_request":
+        if 'date' not in context.user_data:
+            await query.edit_message_text("⚠️ Заявка устарела. Начните оформление заново.")
+            return MAIN_MENU
         description = context.user_data.get('description', '')
         user_id = query.from_user.id
         hours = context.user_data.get('hours', 1)
-        cost = 150 * hours
+        cost = EARLY_LEAVE_HOUR_COST * hours
         
         # Проверяем баланс
         user = await db.get_user(user_id)
@@ -1124,66 +1332,48 @@ async def handle_confirmation(update: Update, context: CallbackContext):
             await query.edit_message_text("❌ Ошибка: пользователь не найден.")
             return ConversationHandler.END
             
-        if user[3] < cost:
-            await query.edit_message_text(f"❌ Недостаточно баллов. Ваш баланс: {user[3]}, требуется: {cost}")
+        if available_points(user) < cost:
+            await query.edit_message_text(
+                f"❌ Недостаточно баллов. Доступно: {available_points(user)}, требуется: {cost}"
+            )
             return ConversationHandler.END
         
-        # Извлекаем дату использования
-        usage_date = None
-        if "Уйти на" in description:
-            try:
-                usage_date = context.user_data['date'].strftime("%Y-%m-%d")
-            except:
-                try:
-                    date_str = description.split()[-1].strip('()')
-                    usage_date = datetime.strptime(date_str, "%d.%m.%Y").strftime("%Y-%m-%d")
-                except:
-                    pass
-        
-        # Отправляем заявку
-        req_id = await db.add_usage_request(user_id, description, usage_date)
+        # Сегодняшние одобренные заявки - для уведомления админов
+        today = datetime.now().strftime("%Y-%m-%d")
+        today_text = approved_today_text(await db.get_approved_requests_for_date(today))
+
+        def notify(req_id, user):
+            return admin_notifications(
+                f"📩 Новая заявка на использование баллов\n\n"
+                f"👤 Сотрудник: {user[1]} ({user[2]})\n"
+                f"📌 Описание: {description}\n"
+                f"💰 Баланс: {user[3]} баллов (в резерве: {user['held']})"
+                f"{today_text}",
+                new_request_markup(req_id),
+            )
+
+        # Отправляем заявку (стоимость резервируется до решения администратора);
+        # уведомления админам попадают в outbox той же транзакцией
+        req_id = await db.add_usage_request(
+            user_id,
+            description,
+            context.user_data['date'].strftime("%Y-%m-%d"),
+            kind=REQUEST_KIND_EARLY_LEAVE,
+            hours=hours,
+            cost=cost,
+            notify=notify,
+        )
+        if req_id is None:
+            await query.edit_message_text("❌ Недостаточно баллов: часть баланса уже зарезервирована другими заявками.")
+            return ConversationHandler.END
         
         # Обновляем сообщение с подтверждением
         await query.edit_message_text(
             f"✅ Заявка отправлена!\n\n"
             f"Описание: {description}\n"
-            f"Администраторы получили уведомление."
+            f"Администраторы получат уведомление."
         )
         
-        # Получаем сегодняшние одобренные заявки
-        today = datetime.now().strftime("%Y-%m-%d")
-        today_requests = await db.get_approved_requests_for_date(today)
-        
-        # Формируем текст с сегодняшними заявками
-        today_text = "\n\n📅 Сегодня одобрены:\n"
-        if today_requests:
-            for req in today_requests:
-                today_text += f"• {req['full_name']} ({req['role']}) — {req['description']}\n"
-        else:
-            today_text += "Нет одобренных заявок"
-        
-        # Уведомляем админов
-        for admin_id in admins_list :
-            try:
-                buttons = [
-                    [
-                        InlineKeyboardButton("✅ Одобрить", callback_data=f"approve_{req_id}"),
-                        InlineKeyboardButton("❌ Отклонить", callback_data=f"reject_{req_id}")
-                    ]
-                ]
-                markup = InlineKeyboardMarkup(buttons)
-                await context.bot.send_message(
-                    chat_id=admin_id,
-                    text=f"📩 Новая заявка на использование баллов\n\n"
-                         f"👤 Сотрудник: {user[1]} ({user[2]})\n"
-                         f"📌 Описание: {description}\n"
-                         f"💰 Баланс: {user[3]} баллов"
-                         f"{today_text}",
-                    reply_markup=markup
-                )
-            except Exception as e:
-                logging.error(f"Не удалось отправить сообщение админу {admin_id}: {e}")
-        
         await show_main_menu_for_chat(context, query.message.chat_id, user_id)
         return MAIN_MENU
     
@@ -1215,6 +1405,9 @@ async def handle_cancel_request(update: Update, context: CallbackContext):
 async def ignore_callback(update: Update, context: CallbackContext):
     """Игнорирует нажатия на недоступные даты"""
     query = update.callback_query
+    if query.data == "full":
+        await query.answer("На этот день уже нет свободных мест. Выберите другую дату.", show_alert=True)
+        return
     await query.answer()
 
 #---------ежедневное уведомлени админов------------#
@@ -1234,16 +1427,14 @@ async def send_daily_usage_notifications(context: CallbackContext):
             message = "📅 Запланированные использования баллов на сегодня:\n\n" + \
                      "\n".join(f"• {req['full_name']} — {req['description']}" for req in requests)
 
-        for admin_id in admins_list :
-            try:
-                await context.bot.send_message(
-                    chat_id=admin_id,
-                    text=message,
-                    parse_mode='HTML'
-                )
-                logger.info(f"Сообщение отправлено админу {admin_id}")
-            except Exception as e:
-                logger.error(f"Ошибка отправки админу {admin_id}: {e}")
+        results = await broadcaster.send_many(
+            context.bot,
+            admins_list,
+            text=message,
+            parse_mode='HTML'
+        )
+        sent = sum(result.ok for result in results)
+        logger.info(f"Сообщение отправлено {sent} из {len(results)} админам")
                 
     except Exception as e:
         logger.error(f"Критическая ошибка: {e}", exc_info=True)
@@ -1270,43 +1461,25 @@ async def use_points_description(update: Update, context: CallbackContext):
     """Отправка заявки на использование баллов."""
     desc = update.message.text.strip()
     user_id = update.effective_user.id
-    req_id = await db.add_usage_request(user_id, desc)
-    
-    await update.message.reply_text("Заявка отправлена администраторам.")
-
-    user = await db.get_user(user_id)
-    if not user:
+    if not await db.get_user(user_id):
         await update.message.reply_text("Вы не зарегистрированы.")
         return MAIN_MENU
 
-    # Получаем сегодняшние одобренные заявки
+    # Сегодняшние одобренные заявки - для уведомления админов
     today = datetime.now().strftime("%Y-%m-%d")
-    today_requests = await db.get_approved_requests_for_date(today)
-    
-    # Формируем текст с сегодняшними заявками
-    today_text = "\n\n📅 Сегодня одобрены:\n"
-    if today_requests:
-        for req in today_requests:
-            today_text += f"• {req['full_name']} ({req['role']}) — {req['description']}\n"
-    else:
-        today_text += "Нет одобренных заявок"
-
-    msg = (f"Новая заявка на использование баллов от {user[1]} ({user[2]}) "
-           f"(баланс: {user[3]} баллов):\n\n{desc}"
-           f"{today_text}")
+    today_text = approved_today_text(await db.get_approved_requests_for_date(today))
+
+    def notify(req_id, user):
+        return admin_notifications(
+            f"Новая заявка на использование баллов от {user[1]} ({user[2]}) "
+            f"(баланс: {user[3]} баллов):\n\n{desc}"
+            f"{today_text}",
+            new_request_markup(req_id),
+        )
 
-    for admin_id in admins_list :
-        try:
-            buttons = [
-                [
-                    InlineKeyboardButton("✅ Одобрить", callback_data=f"approve_{req_id}"),
-                    InlineKeyboardButton("❌ Отклонить", callback_data=f"reject_{req_id}")
-                ]
-            ]
-            markup = InlineKeyboardMarkup(buttons)
-            await context.bot.send_message(chat_id=admin_id, text=msg, reply_markup=markup)
-        except Exception as e:
-            logging.error(f"Не удалось отправить сообщение админу: {e}")
+    # Уведомления админам попадают в outbox той же транзакцией, что и заявка
+    await db.add_usage_request(user_id, desc, notify=notify)
+    await update.message.reply_text("Заявка отправлена администраторам.")
 
     await show_main_menu(update)
     return MAIN_MENU
@@ -1339,7 +1512,7 @@ async def handle_backup_confirmation(update: Update, context: CallbackContext):
     if query.data == "confirm_backup":
         try:
             message =  await query.message.reply_text("🔄 Создание резервной копии...")
-            backup_path = await db.create_backup()
+            backup_path = await db.create_backup('xlsx')
 
             file_size = os.path.getsize(backup_path) / (1024 * 1024)
 
@@ -1374,7 +1547,7 @@ async def manual_backups(update: Update, context: CallbackContext):
     
     try:
         msg = await update.message.reply_text("🔄 Создание резервной копии...")
-        backup_path = await db.create_backup()
+        backup_path = await db.create_backup('xlsx')
 
         with open(backup_path, 'rb') as backup_file:
             await update.message.reply_document(
@@ -1388,42 +1561,18 @@ async def manual_backups(update: Update, context: CallbackContext):
         await update.message.reply_text("❌ Ошибка при создании резервной копии")
 
 #------------------------------------------------------------------------------------------#
-async def background_scheduler(app: Application):
-    """Фоновая задача для ежедневных уведомлений"""
-    last_sent_day = None
-    last_backup_day = None
-    
-    while True:
-        now = datetime.now()
-        
-        # Триггер в 15:03 (для теста) и только 1 раз в день
-        if now.hour == 10 and now.minute == 0 and now.day != last_sent_day:
-            try:
-                # Создаем правильный контекст
-                from telegram.ext import CallbackContext
-                context = CallbackContext(app)
-                
-                await send_daily_usage_notifications(context)
-                last_sent_day = now.day
-                logger.info("✅ Уведомления отправлены")
-            except Exception as e:
-                logger.error(f"❌ Ошибка в планировщике: {e}")
-                # При серьезной ошибке делаем паузу перед повторной попыткой
-                await asyncio.sleep(300)
+def register_jobs(scheduler: Scheduler, app: Application):
+    """Регулярные задачи: утренняя сводка админам и ночная резервная копия."""
+    async def daily_usage_summary():
+        await send_daily_usage_notifications(CallbackContext(app))
 
+    async def nightly_backup():
+        await db.create_backup()
 
-        if now.hour == 22 and now.minute == 0 and now.day != last_backup_day:
-            try:
-                await db.create_backup()
-                last_backup_day = now.day
-                
-                logger.info("✅ Резервная копия создана")
-            except Exception as e:
-                
-                logger.error(f"❌ Ошибка создания резервной копии: {e}")
-
-        
-        await asyncio.sleep(60)
+    # Сводку догоняем только в пределах пары часов, иначе она уже неактуальна
+    scheduler.add_job("daily_usage_summary", "0 10 * * *", daily_usage_summary,
+                      catchup=CATCHUP_ONCE, grace=timedelta(hours=2))
+    scheduler.add_job("nightly_backup", "0 22 * * *", nightly_backup, catchup=CATCHUP_ONCE)
 
 
 
@@ -1437,54 +1586,79 @@ async def fallback(update: Update, context: CallbackContext):
     await show_main_menu(update)
     return MAIN_MENU
 
-async def main():
-    """Основная функция запуска бота."""
-    await db.connect()
-
-    app = ApplicationBuilder().token(BOT_TOKEN).build()
+def build_application(base_url=BOT_API_BASE_URL) -> Application:
+    """Application со всеми обработчиками (без запуска)."""
+    builder = (
+        ApplicationBuilder()
+        .token(BOT_TOKEN)
+        .concurrent_updates(PerChatUpdateProcessor(MAX_CONCURRENT_UPDATES))
+        .persistence(SQLitePersistence())
+    )
+    if base_url:
+        builder = builder.base_url(base_url)
+    app = builder.build()
+
+    # Inline-кнопки вне диалога (должны быть ДО conv_handler)
+    app.add_handler(CallbackRouter(
+        exact={
+            "confirm_request": handle_confirmation,
+            "cancel_request": handle_cancel_request,
+            "clear_queue": handle_queue_buttons,
+            "back_to_menu": handle_queue_buttons,
+            "ignore": ignore_callback,
+            "full": ignore_callback,
+            "cancel_calendar": handle_calendar,
+            "confirm_backup": handle_backup_confirmation,
+            "cancel_backup": handle_backup_confirmation,
+        },
+        prefixes={
+            "approve": handle_admin_action,
+            "reject": handle_admin_action,
+            "role": show_employees_by_role,
+            "delete_user": handle_delete_user,
+            "delete_req": handle_request_deletion,
+            "nav": handle_calendar,
+            "date": handle_calendar,
+            "hist": handle_history_page,
+        },
+        # Остаток callback_data, как в прежних шаблонах ^approve_\d+$ и т.п.
+        suffixes={
+            "approve": NUMBER,
+            "reject": NUMBER,
+            "delete_user": NUMBER,
+            "delete_req": NUMBER,
+            "hist": r"\d+_[on]_\d{14}_\d+",
+        },
+    ).handler())
+    # Кнопки главного меню
+    main_menu = TextRouter({
+        "Мой баланс": handle_balance,
+        "История": handle_history,
+        "Начислить/Списать баллы": entry_points_handler,
+        "Начислить/Списать баллы (silent)": entry_points_handler,
+        "Проверка заявок на использование": check_usage_requests,
+        "Использовать баллы": use_points,
+        "Очередь использования баллов": show_approved_requests,
+        "История сотрудника": begin_employee_history,
+        "Сотрудники": choose_role,
+        "Удаление сотрудника": show_employees_for_admin,
+        "Прайс-лист": send_price,
+        "Правила": send_rules,
+        "Изменения": show_admin_changes_menu,
+        "Изменить правила": edit_rules,
+        "Изменить прайс-лист": edit_price,
+        "Заявки на сегодня": check_today_requests,
+        "Главное меню": handle_main_menu_button,
+        "Редактировать начисление баллов": edit_price_lists,
+        "Создать резервную копию": handle_backup_request,
+        "Мои заявки": show_my_requests,
+    }, default=fallback)
 
-    
-    # Замените текущие обработчики на эти (должны быть ДО conv_handler):
-    app.add_handler(CallbackQueryHandler(handle_confirmation, pattern="^confirm_request$"))
-    app.add_handler(CallbackQueryHandler(handle_cancel_request, pattern="^cancel_request$"))
-    # Обработчики inline-кнопок
-    app.add_handler(CallbackQueryHandler(handle_admin_action, pattern="^(approve|reject)_\\d+$"))
-    app.add_handler(CallbackQueryHandler(handle_queue_buttons, pattern="^(clear_queue|back_to_menu)$"))
-    app.add_handler(CallbackQueryHandler(show_employees_by_role, pattern="^role_"))
-    app.add_handler(CallbackQueryHandler(handle_delete_user, pattern=r"^delete_user_\d+$"))
-    # Добавьте этот обработчик в main()
-    app.add_handler(CallbackQueryHandler(ignore_callback, pattern="^ignore$"))
-    app.add_handler(CallbackQueryHandler(handle_calendar, pattern=r"^(nav|date|cancel)_"))
-    app.add_handler(CallbackQueryHandler( handle_backup_confirmation, pattern="^(confirm|cancel)_backup$"))
-    app.add_handler(CallbackQueryHandler(handle_request_deletion, pattern="^delete_req_\\d+$"))
-    # Замените существующую регистрацию на:
-    # Убедитесь, что обработчик зарегистрирован правильно:
     # Основной обработчик диалогов
     conv_handler = ConversationHandler(
         entry_points=[CommandHandler("start", start)],
         states={
-            MAIN_MENU: [
-                MessageHandler(filters.Regex("^Мой баланс$"), handle_balance),
-                MessageHandler(filters.Regex("^История$"), handle_history),
-                MessageHandler(filters.Regex("^(Начислить/Списать баллы|Начислить/Списать баллы \\(silent\\))$"), entry_points_handler),
-                MessageHandler(filters.Regex("^Проверка заявок на использование$"), check_usage_requests),
-                MessageHandler(filters.Regex("^Использовать баллы$"), use_points),
-                MessageHandler(filters.Regex("^Очередь использования баллов$"), show_approved_requests),
-                MessageHandler(filters.Regex("^История сотрудника$"), begin_employee_history),
-                MessageHandler(filters.Regex("^Сотрудники$"), choose_role),
-                MessageHandler(filters.Regex("^Удаление сотрудника$"), show_employees_for_admin),
-                MessageHandler(filters.Regex("^Прайс-лист$"), send_price),
-                MessageHandler(filters.Regex("^Правила$"), send_rules),
-                MessageHandler(filters.Regex("^Изменения$"), show_admin_changes_menu),
-                MessageHandler(filters.Regex("^Изменить правила$"), edit_rules),
-                MessageHandler(filters.Regex("^Изменить прайс-лист$"), edit_price),
-                MessageHandler(filters.Regex("^Заявки на сегодня$"), check_today_requests),
-                MessageHandler(filters.Regex('^Главное меню$'), handle_main_menu_button),
-                MessageHandler(filters.Regex("^Редактировать начисление баллов$"), edit_price_lists),
-                MessageHandler(filters.Regex("^Создать резервную копию$"),handle_backup_request),
-                MessageHandler(filters.Regex("^Мои заявки$"), show_my_requests),
-                MessageHandler(filters.ALL, fallback)
-            ],
+            MAIN_MENU: [main_menu.handler()],
             SELECT_USER: [MessageHandler(filters.TEXT & ~filters.COMMAND, select_user)],
             SELECT_REASON: [MessageHandler(filters.TEXT & ~filters.COMMAND, select_reason)],
             ENTER_DESCRIPTION: [MessageHandler(filters.TEXT & ~filters.COMMAND, use_points_description)],
@@ -1495,6 +1669,9 @@ async def main():
             SELECT_ACTION: [MessageHandler(filters.TEXT & ~filters.COMMAND, select_action)],
             ENTER_CUSTOM_POINTS: [MessageHandler(filters.TEXT & ~filters.COMMAND, enter_custom_points)],
             ENTER_DEDUCT_POINTS: [MessageHandler(filters.TEXT & ~filters.COMMAND, enter_deduct_points)],
+            BULK_SELECT_ROLE: [MessageHandler(filters.TEXT & ~filters.COMMAND, bulk_select_role)],
+            BULK_SELECT_REASON: [CallbackQueryHandler(handle_bulk_toggle, pattern=r"^bulk_\d+_(\d+|done)$"),
+                MessageHandler(filters.TEXT & ~filters.COMMAND, bulk_select_reason)],
             REGISTRATION_FIO: [MessageHandler(filters.TEXT & ~filters.COMMAND, registration_fio)],
             REGISTRATION_ROLE: [MessageHandler(filters.TEXT & ~filters.COMMAND, registration_role)],
             EDIT_TEXT_INPUT: [MessageHandler(filters.TEXT & ~filters.COMMAND, edit_text_input)],
@@ -1502,19 +1679,54 @@ async def main():
             SELECT_PRICE_ITEM: [MessageHandler(filters.TEXT & ~filters.COMMAND, select_price_item)],
         ENTER_NEW_POINTS: [MessageHandler(filters.TEXT & ~filters.COMMAND, save_new_points)],
         },
-        fallbacks=[MessageHandler(filters.ALL, fallback)]
+        fallbacks=[MessageHandler(filters.ALL, fallback)],
+        # Состояние диалога и user_data переживают перезапуск бота
+        name="main",
+        persistent=True,
     )
 
 
     app.add_handler(conv_handler)
+    return app
+
+
+async def main():
+    """Основная функция запуска бота."""
+    if USE_WEBHOOK and not WEBHOOK_SECRET_TOKEN:
+        # Без секрета любой, кто знает адрес, может присылать поддельные обновления
+        raise RuntimeError("Для режима webhook задайте WEBHOOK_SECRET_TOKEN в config.py")
+    await db.connect()
+    await db.init_settings(SETTINGS_DEFAULTS)
+
+    app = build_application()
     await app.initialize()
     await app.start()
-    await app.updater.start_polling()
-    asyncio.create_task(background_scheduler(app))
+    if USE_WEBHOOK:
+        webhook = WebhookServer(app.update_queue, app.bot, WEBHOOK_LISTEN, WEBHOOK_PORT, WEBHOOK_PATH,
+                                secret_token=WEBHOOK_SECRET_TOKEN)
+        await webhook.start(url=WEBHOOK_URL)
+    else:
+        await app.updater.start_polling()
+    scheduler = Scheduler()
+    register_jobs(scheduler, app)
+    await scheduler.start()
+    outbox_worker = OutboxWorker(app.bot)
+    outbox_worker.start()
 
+    try:
         # Бесконечный цикл работы бота
-    while True:
-        await asyncio.sleep(3600)
+        while True:
+            await asyncio.sleep(3600)
+    finally:
+        await scheduler.stop()
+        await outbox_worker.stop()
+        if USE_WEBHOOK:
+            await webhook.stop()
+        else:
+            await app.updater.stop()
+        await app.stop()
+        await app.shutdown()
+        await db.close()
 
 if __name__ == '__main__':
     asyncio.run(main())
\ No newline at end of file
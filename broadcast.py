@@ -0,0 +1,138 @@
+"""Параллельная рассылка сообщений с учётом лимитов Telegram."""
+import asyncio
+import logging
+import time
+from typing import NamedTuple, Optional
+
+from telegram.error import BadRequest, Forbidden, NetworkError, RetryAfter, TelegramError, TimedOut
+
+GLOBAL_RATE = 30  # Сообщений в секунду на бота (лимит Telegram)
+CHAT_RATE = 1  # Сообщений в секунду в один чат
+CHAT_BURST = 3  # Сколько сообщений подряд можно отправить в чат без ожидания
+MAX_RETRIES = 3  # Повторы после RetryAfter или сетевой ошибки (кроме таймаута)
+BACKOFF_BASE = 1.0  # Первая пауза при сетевой ошибке, дальше удваивается
+MAX_CHAT_BUCKETS = 1000  # После этого простаивающие ведра чатов удаляются
+
+logger = logging.getLogger(__name__)
+
+
+class TokenBucket:
+    """Ведро токенов: не больше rate операций в секунду, пачкой до capacity"""
+
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity or rate
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.blocked_until = 0.0
+        self._lock = asyncio.Lock()
+
+    def _refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    async def acquire(self):
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                if now < self.blocked_until:
+                    await asyncio.sleep(self.blocked_until - now)
+                    continue
+                self._refill(now)
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+    def block(self, seconds):
+        """Запрещает отправку на seconds секунд (после RetryAfter)"""
+        self.blocked_until = max(self.blocked_until, time.monotonic() + seconds)
+
+    def idle(self):
+        self._refill(time.monotonic())
+        return self.tokens >= self.capacity and not self._lock.locked()
+
+
+class SendResult(NamedTuple):
+    chat_id: int
+    message: Optional[object] = None  # telegram.Message при успехе
+    error: Optional[Exception] = None
+
+    @property
+    def ok(self):
+        return self.error is None
+
+
+def _retry_delay(error):
+    delay = error.retry_after
+    return delay.total_seconds() if hasattr(delay, "total_seconds") else float(delay)
+
+
+class Broadcaster:
+    """Отправляет сообщения во много чатов сразу, соблюдая общий лимит и лимит на чат"""
+
+    def __init__(self, global_rate=GLOBAL_RATE, chat_rate=CHAT_RATE, chat_burst=CHAT_BURST,
+                 max_retries=MAX_RETRIES):
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.max_retries = max_retries
+        self._global = TokenBucket(global_rate)
+        self._chats = {}
+
+    def _chat_bucket(self, chat_id):
+        bucket = self._chats.get(chat_id)
+        if bucket is None:
+            if len(self._chats) >= MAX_CHAT_BUCKETS:
+                for idle_chat in [c for c, b in self._chats.items() if b.idle()]:
+                    del self._chats[idle_chat]
+            bucket = self._chats[chat_id] = TokenBucket(self.chat_rate, self.chat_burst)
+        return bucket
+
+    async def send(self, bot, chat_id, text, **kwargs):
+        """Отправляет одно сообщение с повторами. Никогда не бросает исключение."""
+        chat_bucket = self._chat_bucket(chat_id)
+        error = None
+        for attempt in range(self.max_retries + 1):
+            await chat_bucket.acquire()
+            await self._global.acquire()
+            try:
+                message = await bot.send_message(chat_id=chat_id, text=text, **kwargs)
+                return SendResult(chat_id, message)
+            except RetryAfter as e:
+                error = e
+                delay = _retry_delay(e)
+                # Лимит мог быть превышен и общий, а не только для этого чата
+                chat_bucket.block(delay)
+                self._global.block(delay)
+            except (BadRequest, Forbidden) as e:
+                # Чат недоступен или запрос неверный - повтор не поможет
+                error = e
+                break
+            except TimedOut as e:
+                # Запрос мог дойти до Telegram - повтор может отправить сообщение дважды
+                error = e
+                logger.warning(f"Таймаут отправки в чат {chat_id}, доставка неизвестна: {e}")
+                break
+            except NetworkError as e:
+                error = e
+                delay = BACKOFF_BASE * 2 ** attempt
+            except TelegramError as e:
+                error = e
+                break
+            if attempt < self.max_retries:
+                logger.warning(f"Повтор отправки в чат {chat_id} через {delay:.1f} с: {error}")
+                await asyncio.sleep(delay)
+
+        logger.error(f"Не удалось отправить сообщение в чат {chat_id}: {error}")
+        return SendResult(chat_id, error=error)
+
+    async def send_many(self, bot, chat_ids, text, **kwargs):
+        """Отправляет одно и то же сообщение во все чаты параллельно.
+
+        Возвращает список SendResult в порядке chat_ids.
+        """
+        return await asyncio.gather(*(self.send(bot, chat_id, text, **kwargs) for chat_id in chat_ids))
+
+
+# --- Глобальный экземпляр ---
+broadcaster = Broadcaster()
@@ -8,6 +8,22 @@ ADMIN_INFO = {
 SUPERADMINS = [777]  # user_id суперадмина
 ADMINS = [777, 777]       # обычные админы
 
+# Сколько обновлений разных чатов бот обрабатывает одновременно
+# (обновления одного чата всегда идут по порядку)
+MAX_CONCURRENT_UPDATES = 16
+
+# Webhook вместо polling: Telegram присылает обновления на встроенный HTTP-сервер
+USE_WEBHOOK = False
+WEBHOOK_URL = ""  # Публичный https-адрес; пусто - не регистрировать webhook при запуске
+WEBHOOK_LISTEN = "0.0.0.0"
+WEBHOOK_PORT = 8443
+WEBHOOK_PATH = "/telegram"
+WEBHOOK_SECRET_TOKEN = ""  # Обязателен для webhook: проверяется в заголовке каждого запроса; задайте случайную строку
+
+# Адрес Bot API; пусто - api.telegram.org. Для тестов: "http://127.0.0.1:8081/bot"
+# (benchmarks/fake_bot_api.py) или собственный сервер telegram-bot-api
+BOT_API_BASE_URL = ""
+
 
 
 # Прайс-лист баллов для УСМ
@@ -1,120 +1,493 @@
 import aiosqlite
+import asyncio
+import json
 import logging
 import os
+import time
+from collections import OrderedDict
+from contextlib import asynccontextmanager
 from datetime import datetime
-import pandas as pd
-import glob
+from pathlib import Path
+from typing import NamedTuple, Optional
+from migrations import run_migrations
+from backup import EXPORT_FORMATS, make_backup, prune_backups, restore_snapshot
 
 DB_PATH = 'database.sqlite3'
+POOL_SIZE = 4  # Количество постоянных соединений для чтения
+WRITE_BATCH_WINDOW = 0.005  # Сколько секунд писатель ждёт, собирая записи в одну транзакцию
+WRITE_BATCH_MAX = 64  # Максимум операций записи в одной транзакции
+USER_CACHE_SIZE = 1024  # Сколько пользователей держать в памяти (LRU)
+LEDGER_KEY_CACHE_SIZE = 4096  # Сколько последних ключей операций с баллами помнить в памяти
+DAY_SLOT_CAPACITY = 3  # Сколько сотрудников одной роли могут уйти раньше в один день
+REQUEST_KIND_EARLY_LEAVE = 'early_leave'  # Уйти раньше: есть hours, cost и usage_date
+REQUEST_KIND_OTHER = 'other'  # Свободное описание
+SETTING_USM_SCORES = 'usm_scores'  # Баллы за причины для УСМ
+SETTING_CONSULTANT_SCORES = 'consultant_scores'  # Баллы за причины для консультантов
+SETTING_PRICE_TEXT = 'price_text'
+SETTING_RULES_TEXT = 'rules_text'
+BACKUP_DIR = 'backups'
+BACKUP_FORMAT = 'sqlite'  # sqlite (снимок для восстановления), xlsx, csv или jsonl
+BACKUP_KEEP_LAST = 10  # Сколько последних копий хранить всегда
+BACKUP_KEEP_DAYS = 30  # Плюс по одной копии за каждый из последних дней
+
+# Прагмы выставляются один раз при открытии соединения
+PRAGMAS = (
+    "PRAGMA busy_timeout = 5000",
+    "PRAGMA temp_store = MEMORY",
+    "PRAGMA cache_size = -8000",
+)
+WRITER_PRAGMAS = (
+    "PRAGMA journal_mode = WAL",
+    "PRAGMA synchronous = NORMAL",
+)
+
+def available_points(user):
+    """Баллы, которые можно потратить: баланс за вычетом резерва по заявкам"""
+    return user['points'] - user['held']
+
+
+class LedgerEntry(NamedTuple):
+    """Результат операции с баллами"""
+    entry_id: Optional[int]  # id записи в history (None, если пользователя нет)
+    user: object  # Строка users после операции
+    duplicate: bool = False  # Операция с этим ключом уже была проведена раньше
+
+
+class BulkLedgerResult(NamedTuple):
+    """Результат массового начисления"""
+    applied: int  # Сколько начислений проведено
+    users: dict  # user_id -> строка users после операции
+    duplicate: bool = False
+
 
 class Database:
-    def __init__(self):
-        self.db_path = DB_PATH
+    def __init__(self, db_path=DB_PATH, pool_size=POOL_SIZE):
+        self.db_path = db_path
+        self.pool_size = pool_size
+        self._connections = []
+        self._pool = None
+        self._writer_conn = None
+        self._write_queue = None
+        self._writer_task = None
+        # Выставляется в close(): новые операции отклоняются, уже поставленные дописываются
+        self._closing = False
+        # Кэш пользователей: id -> строка users (или None, если не зарегистрирован)
+        self._user_cache = OrderedDict()
+        self._user_cache_epoch = 0
+        self.user_cache_hits = 0
+        self.user_cache_misses = 0
+        # Ключ операции -> LedgerEntry для уже проведённых начислений
+        self._ledger_results = OrderedDict()
+        # Выставляется после коммита, добавившего уведомления в outbox
+        self.outbox_event = asyncio.Event()
+        self._outbox_dirty = False
+        # Растёт после каждого изменения одобренных заявок (для кэшей календаря)
+        self.occupancy_version = 0
+        # Растёт при добавлении и удалении пользователей (для кэша списка сотрудников)
+        self.users_version = 0
+        # Настройки: ключ -> значение из JSON; значения только читать, не изменять на месте
+        self._settings = {}
+        self._settings_defaults = {}
 
     async def connect(self):
-        """Создание таблиц при первом запуске"""
+        """Открытие соединений, создание таблиц и запуск писателя"""
         try:
-            async with aiosqlite.connect(self.db_path) as db:
-                await self._create_tables(db)
+            # Единственное пишущее соединение; транзакциями управляет _writer_loop
+            self._writer_conn = await aiosqlite.connect(self.db_path, isolation_level=None)
+            await self._apply_pragmas(self._writer_conn, PRAGMAS + WRITER_PRAGMAS)
+            await run_migrations(self._writer_conn)
+
+            read_uri = Path(self.db_path).resolve().as_uri() + "?mode=ro"
+            for _ in range(self.pool_size):
+                conn = await aiosqlite.connect(read_uri, uri=True)
+                await self._apply_pragmas(conn, PRAGMAS + ("PRAGMA query_only = ON",))
+                self._connections.append(conn)
+
+            self._pool = asyncio.Queue()
+            for conn in self._connections:
+                self._pool.put_nowait(conn)
+
+            self._write_queue = asyncio.Queue()
+            self._writer_task = asyncio.create_task(self._writer_loop())
+            await self._load_settings()
             logging.info("✅ Подключение к SQLite успешно.")
         except Exception as e:
             logging.error(f"Ошибка подключения к SQLite: {e}")
+            await self.close()
             raise
 
-    async def _create_tables(self, db):
-        await db.executescript("""
-            CREATE TABLE IF NOT EXISTS users (
-                id INTEGER PRIMARY KEY,
-                full_name TEXT,
-                role TEXT,
-                points INTEGER DEFAULT 0
-            );
-
-            CREATE TABLE IF NOT EXISTS usage_requests (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                user_id INTEGER,
-                description TEXT,
-                status TEXT DEFAULT 'pending',
-                created_at TEXT DEFAULT CURRENT_TIMESTAMP,
-                usage_date TEXT,
-                FOREIGN KEY(user_id) REFERENCES users(id)
-            );
-
-            CREATE TABLE IF NOT EXISTS history (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                admin_id INTEGER,
-                user_id INTEGER,
-                points INTEGER,
-                reason TEXT,
-                timestamp TEXT DEFAULT CURRENT_TIMESTAMP
-            );
-        """)
+    @staticmethod
+    async def _apply_pragmas(conn, pragmas):
+        conn.row_factory = aiosqlite.Row
+        for pragma in pragmas:
+            await conn.execute(pragma)
+
+    async def close(self):
+        """Остановка писателя и закрытие всех соединений.
+
+        Записи, поставленные до вызова, дописываются; после него _write
+        бросает RuntimeError.
+        """
+        self._closing = True
+        if self._writer_task is not None:
+            # None в очереди - сигнал писателю завершиться после уже поставленных записей
+            self._write_queue.put_nowait(None)
+            try:
+                await self._writer_task
+            except Exception as e:
+                logging.error(f"Ошибка остановки писателя SQLite: {e}")
+            self._writer_task = None
+            # Если писатель упал, оставшиеся в очереди записи иначе ждали бы вечно
+            while not self._write_queue.empty():
+                item = self._write_queue.get_nowait()
+                if item is not None and not item[1].done():
+                    item[1].set_exception(RuntimeError("База данных закрыта до выполнения записи"))
+
+        if self._pool is not None:
+            # Ждём, пока читатели вернут все соединения пула: закрывать или
+            # подменять файл базы под выполняющимся запросом нельзя
+            for _ in self._connections:
+                await self._pool.get()
+        connections, self._connections = self._connections, []
+        if self._writer_conn is not None:
+            connections.append(self._writer_conn)
+            self._writer_conn = None
+        self._pool = None
+        self._user_cache.clear()
+        # Результаты операций по op_key могли относиться к базе до восстановления
+        self._ledger_results.clear()
+        for conn in connections:
+            try:
+                await conn.close()
+            except Exception as e:
+                logging.error(f"Ошибка закрытия соединения SQLite: {e}")
+        self._closing = False
+
+    @asynccontextmanager
+    async def _acquire(self):
+        """Берёт соединение для чтения из пула и возвращает его после использования"""
+        if self._pool is None:
+            raise RuntimeError("База данных не подключена, вызовите connect()")
+        if self._closing:
+            raise RuntimeError("База данных закрывается, чтение не выполнено")
+        pool = self._pool
+        conn = await pool.get()
+        try:
+            yield conn
+        finally:
+            if pool is self._pool:
+                if conn.in_transaction:
+                    await conn.rollback()
+                pool.put_nowait(conn)
+            else:
+                # Пул уже закрыт (например, connect() не удался) - соединение больше не нужно
+                await conn.close()
+
+    # --- Запись ---
+    async def _write(self, op):
+        """Передаёт операцию писателю и ждёт коммита транзакции, в которую она попала.
+
+        op - корутинная функция, принимающая соединение; commit() она не вызывает.
+        Возвращает результат op или пробрасывает её исключение.
+        """
+        if self._writer_task is None:
+            raise RuntimeError("База данных не подключена, вызовите connect()")
+        if self._closing:
+            raise RuntimeError("База данных закрывается, запись не принята")
+        future = asyncio.get_running_loop().create_future()
+        self._write_queue.put_nowait((op, future))
+        return await future
+
+    async def _writer_loop(self):
+        """Единственный писатель: группирует записи, пришедшие за короткое окно, в одну транзакцию"""
+        loop = asyncio.get_running_loop()
+        stopping = False
+        while not stopping:
+            item = await self._write_queue.get()
+            if item is None:
+                break
+            batch = [item]
+            deadline = loop.time() + WRITE_BATCH_WINDOW
+            while len(batch) < WRITE_BATCH_MAX:
+                timeout = deadline - loop.time()
+                try:
+                    if timeout > 0:
+                        item = await asyncio.wait_for(self._write_queue.get(), timeout)
+                    else:
+                        item = self._write_queue.get_nowait()
+                except (asyncio.TimeoutError, asyncio.QueueEmpty):
+                    break
+                if item is None:
+                    stopping = True
+                    break
+                batch.append(item)
+            await self._commit_batch(batch)
+
+    async def _commit_batch(self, batch):
+        conn = self._writer_conn
+        outcomes = []
         try:
-            await db.execute("ALTER TABLE usage_requests ADD COLUMN usage_date TEXT")
-            await db.commit()
-        except aiosqlite.OperationalError:
-            pass
-        await db.commit()
+            await conn.execute("BEGIN IMMEDIATE")
+            for op, future in batch:
+                if future.done():  # Вызывающий уже отменил ожидание
+                    continue
+                # Точка сохранения изолирует ошибку одной операции от остальных в группе
+                await conn.execute("SAVEPOINT write_op")
+                try:
+                    result = await op(conn)
+                except Exception as e:
+                    await conn.execute("ROLLBACK TO write_op")
+                    await conn.execute("RELEASE write_op")
+                    outcomes.append((future, None, e))
+                else:
+                    await conn.execute("RELEASE write_op")
+                    outcomes.append((future, result, None))
+            await conn.execute("COMMIT")
+            if self._outbox_dirty:
+                self.outbox_event.set()
+        except Exception as e:
+            logging.error(f"Ошибка групповой записи в SQLite: {e}")
+            if conn.in_transaction:
+                try:
+                    await conn.execute("ROLLBACK")
+                except Exception as rollback_error:
+                    logging.error(f"Ошибка отката транзакции SQLite: {rollback_error}")
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        finally:
+            self._outbox_dirty = False
+
+        for future, result, error in outcomes:
+            if future.done():
+                continue
+            if error is not None:
+                future.set_exception(error)
+            else:
+                future.set_result(result)
+
+    # --- Кэш пользователей ---
+    def _cache_user(self, user_id, row):
+        """Записывает актуальную строку пользователя в кэш после коммита"""
+        self._user_cache_epoch += 1
+        self._user_cache[user_id] = row
+        self._user_cache.move_to_end(user_id)
+        while len(self._user_cache) > USER_CACHE_SIZE:
+            self._user_cache.popitem(last=False)
+
+    def user_cache_stats(self):
+        return {
+            "hits": self.user_cache_hits,
+            "misses": self.user_cache_misses,
+            "size": len(self._user_cache),
+        }
+
+    @staticmethod
+    async def _fetch_user(db, user_id):
+        cursor = await db.execute("SELECT * FROM users WHERE id = ?", (user_id,))
+        return await cursor.fetchone()
 
     # --- Пользователи ---
     async def get_user(self, user_id):
-        async with aiosqlite.connect(self.db_path) as db:
-            db.row_factory = aiosqlite.Row
-            cursor = await db.execute("SELECT * FROM users WHERE id = ?", (user_id,))
-            return await cursor.fetchone()
+        if user_id in self._user_cache:
+            self.user_cache_hits += 1
+            self._user_cache.move_to_end(user_id)
+            return self._user_cache[user_id]
+
+        self.user_cache_misses += 1
+        epoch = self._user_cache_epoch
+        async with self._acquire() as db:
+            row = await self._fetch_user(db, user_id)
+        # Если за время чтения была запись, прочитанная строка могла устареть
+        if epoch == self._user_cache_epoch:
+            self._cache_user(user_id, row)
+        return row
 
     async def add_user(self, user_id, full_name, role):
-        async with aiosqlite.connect(self.db_path) as db:
-            try:
-                await db.execute("""
-                    INSERT INTO users (id, full_name, role, points)
-                    VALUES (?, ?, ?, 0)
-                """, (user_id, full_name, role))
-                await db.commit()
-            except aiosqlite.IntegrityError:
-                pass  # Пользователь уже существует
+        async def op(db):
+            # OR IGNORE - пользователь уже существует
+            await db.execute("""
+                INSERT OR IGNORE INTO users (id, full_name, role, points)
+                VALUES (?, ?, ?, 0)
+            """, (user_id, full_name, role))
+            return await self._fetch_user(db, user_id)
+        self._cache_user(user_id, await self._write(op))
+        self.users_version += 1
 
     async def get_all_users(self):
-        async with aiosqlite.connect(self.db_path) as db:
-            db.row_factory = aiosqlite.Row
+        async with self._acquire() as db:
             cursor = await db.execute("SELECT * FROM users")
             return await cursor.fetchall()
 
     async def delete_user(self, user_id):
-        async with aiosqlite.connect(self.db_path) as db:
+        async def op(db):
+            await db.execute("""
+                DELETE FROM day_slots
+                WHERE request_id IN (SELECT id FROM usage_requests WHERE user_id = ?)
+            """, (user_id,))
             await db.execute("DELETE FROM users WHERE id = ?", (user_id,))
-            await db.commit()
+        await self._write(op)
+        self.occupancy_version += 1
+        self.users_version += 1
+        self._cache_user(user_id, None)
 
     # --- Баллы ---
-    async def add_points(self, admin_id, user_id, points, reason, silent: bool = False):
-        async with aiosqlite.connect(self.db_path) as db:
-            await db.execute("UPDATE users SET points = points + ? WHERE id = ?", (points, user_id))
+    async def add_points(self, admin_id, user_id, points, reason, silent: bool = False, notify=None,
+                         op_key=None):
+        """Начисляет (или списывает при points < 0) баллы и записывает операцию в журнал.
 
-            if not silent:
-                await db.execute("""
-                    INSERT INTO history (admin_id, user_id, points, reason)
-                    VALUES (?, ?, ?, ?)
-                """, (admin_id, user_id, points, reason))
+        Изменение баланса и запись в history проходят одной транзакцией. silent-операции
+        тоже попадают в журнал, но не показываются в истории.
+        op_key - ключ идемпотентности: повтор с тем же ключом возвращает исходный
+        результат (duplicate=True) и ничего не меняет.
+        notify(user) - необязательная функция, строящая текст уведомления по
+        обновлённой строке пользователя; уведомление попадает в outbox той же транзакцией.
+        Возвращает LedgerEntry.
+        """
+        if op_key is not None and op_key in self._ledger_results:
+            self._ledger_results.move_to_end(op_key)
+            return self._ledger_results[op_key]._replace(duplicate=True)
+
+        async def op(db):
+            if op_key is not None:
+                cursor = await db.execute("SELECT id FROM history WHERE op_key = ?", (op_key,))
+                existing = await cursor.fetchone()
+                if existing:
+                    return LedgerEntry(existing['id'], await self._fetch_user(db, user_id), True)
+
+            cursor = await db.execute("UPDATE users SET points = points + ? WHERE id = ?", (points, user_id))
+            if cursor.rowcount == 0:
+                return LedgerEntry(None, None)
+
+            cursor = await db.execute("""
+                INSERT INTO history (admin_id, user_id, points, reason, op_key, silent)
+                VALUES (?, ?, ?, ?, ?, ?)
+            """, (admin_id, user_id, points, reason, op_key, int(silent)))
+            user = await self._fetch_user(db, user_id)
+            if notify is not None:
+                await self._enqueue_notification(db, user_id, notify(user))
+            return LedgerEntry(cursor.lastrowid, user)
+
+        entry = await self._write(op)
+        self._cache_user(user_id, entry.user)
+        if op_key is not None and entry.entry_id is not None:
+            self._remember_ledger_key(op_key, entry._replace(duplicate=False))
+        return entry
 
-            await db.commit()
+    async def bulk_add_points(self, admin_id, awards, silent: bool = False, notify=None, op_key=None):
+        """Проводит пачку начислений одной транзакцией.
+
+        awards - список (user_id, points, reason); начисления несуществующим
+        пользователям пропускаются. notify(user, items) строит одно уведомление
+        на пользователя по списку его (points, reason); все уведомления попадают
+        в outbox той же транзакцией. op_key защищает от повторного проведения пачки.
+        """
+        async def op(db):
+            if op_key is not None:
+                cursor = await db.execute("SELECT 1 FROM history WHERE op_key = ?", (f"{op_key}:0",))
+                if await cursor.fetchone():
+                    return BulkLedgerResult(0, {}, True)
+
+            user_ids = sorted({user_id for user_id, _, _ in awards})
+            placeholders = ",".join("?" * len(user_ids))
+            cursor = await db.execute(f"SELECT id FROM users WHERE id IN ({placeholders})", user_ids)
+            existing = {row['id'] for row in await cursor.fetchall()}
+            rows = [award for award in awards if award[0] in existing]
+            if not rows:
+                return BulkLedgerResult(0, {})
+
+            await db.executemany(
+                "UPDATE users SET points = points + ? WHERE id = ?",
+                [(points, user_id) for user_id, points, _ in rows],
+            )
+            await db.executemany("""
+                INSERT INTO history (admin_id, user_id, points, reason, op_key, silent)
+                VALUES (?, ?, ?, ?, ?, ?)
+            """, [
+                (admin_id, user_id, points, reason, f"{op_key}:{i}" if op_key is not None else None, int(silent))
+                for i, (user_id, points, reason) in enumerate(rows)
+            ])
+
+            placeholders = ",".join("?" * len(existing))
+            cursor = await db.execute(f"SELECT * FROM users WHERE id IN ({placeholders})", sorted(existing))
+            users = {row['id']: row for row in await cursor.fetchall()}
+            if notify is not None:
+                items = {}
+                for user_id, points, reason in rows:
+                    items.setdefault(user_id, []).append((points, reason))
+                await self._enqueue_notifications(
+                    db, [(user_id, notify(users[user_id], user_items), None) for user_id, user_items in items.items()]
+                )
+            return BulkLedgerResult(len(rows), users)
+
+        result = await self._write(op)
+        for user_id, user in result.users.items():
+            self._cache_user(user_id, user)
+        return result
+
+    def _remember_ledger_key(self, op_key, entry):
+        self._ledger_results[op_key] = entry
+        self._ledger_results.move_to_end(op_key)
+        while len(self._ledger_results) > LEDGER_KEY_CACHE_SIZE:
+            self._ledger_results.popitem(last=False)
 
     async def get_history(self, user_id):
-        async with aiosqlite.connect(self.db_path) as db:
-            db.row_factory = aiosqlite.Row
+        async with self._acquire() as db:
             cursor = await db.execute("""
                 SELECT * FROM history
-                WHERE user_id = ?
-                ORDER BY timestamp DESC
+                WHERE user_id = ? AND silent = 0
+                ORDER BY timestamp DESC, id DESC
             """, (user_id,))
             return await cursor.fetchall()
 
     async def get_employee_history(self, employee_id):
         return await self.get_history(employee_id)
 
+    async def get_history_page(self, user_id, limit, cursor=None, newer=False):
+        """Страница истории от новых записей к старым, по ключу (timestamp, id).
+
+        cursor - (timestamp, id) граничной записи предыдущей страницы: выбираются
+        записи старше неё, либо новее при newer=True. Без cursor - самые новые.
+        Возвращает (строки, есть_ли_ещё_записи_в_этом_направлении).
+        """
+        async with self._acquire() as db:
+            if cursor is None:
+                sql = """
+                    SELECT * FROM history
+                    WHERE user_id = ? AND silent = 0
+                    ORDER BY timestamp DESC, id DESC
+                    LIMIT ?
+                """
+                params = (user_id, limit + 1)
+            elif newer:
+                sql = """
+                    SELECT * FROM history
+                    WHERE user_id = ? AND silent = 0 AND (timestamp, id) > (?, ?)
+                    ORDER BY timestamp ASC, id ASC
+                    LIMIT ?
+                """
+                params = (user_id, *cursor, limit + 1)
+            else:
+                sql = """
+                    SELECT * FROM history
+                    WHERE user_id = ? AND silent = 0 AND (timestamp, id) < (?, ?)
+                    ORDER BY timestamp DESC, id DESC
+                    LIMIT ?
+                """
+                params = (user_id, *cursor, limit + 1)
+            result = await db.execute(sql, params)
+            rows = await result.fetchall()
+
+        has_more = len(rows) > limit
+        rows = rows[:limit]
+        if newer and cursor is not None:
+            rows.reverse()
+        return rows, has_more
+
     # --- Заявки ---
     async def get_user_requests(self, user_id):
-        async with aiosqlite.connect(self.db_path) as db:
-            db.row_factory = aiosqlite.Row
+        async with self._acquire() as db:
             cursor = await db.execute("""
             SELECT id, description, status, created_at, usage_date
             FROM usage_requests
@@ -123,35 +496,70 @@ class Database:
         """, (user_id,))
             return await cursor.fetchall()
         
-    async def delete_request(self, request_id, user_id=None):
+    async def delete_request(self, request_id, user_id=None, notify=None):
+        """Удаляет заявку (только свою, если указан user_id) и снимает её резерв.
+
+        notify(request, user) - необязательная функция, возвращающая уведомления
+        [(chat_id, text, reply_markup), ...]; они попадают в outbox той же транзакцией.
+        """
         request_id = int(request_id)  # Явное преобразование
         if user_id is not None:
             user_id = int(user_id)  # Явное преобразование
-        async with aiosqlite.connect(self.db_path) as db:
-            if user_id:
-                cursor = await db.execute(
-                    "SELECT 1 FROM usage_requests WHERE id = ? AND user_id = ?",
-                    (request_id, user_id)
-                )
-                if not await cursor.fetchone():
-                    return False
+
+        async def op(db):
+            request = await self._fetch_request(db, request_id)
+            if request is None or (user_id and request['user_id'] != user_id):
+                return False, None
+            user = await self._release_hold(db, request)
+            await db.execute("DELETE FROM day_slots WHERE request_id = ?", (request_id,))
             await db.execute("DELETE FROM usage_requests WHERE id = ?",
                              (request_id,))
-            await db.commit()
-            return True
+            if notify is not None:
+                owner = user or await self._fetch_user(db, request['user_id'])
+                await self._enqueue_notifications(db, notify(request, owner))
+            return True, user
+        deleted, user = await self._write(op)
+        if deleted:
+            self.occupancy_version += 1
+        if user is not None:
+            self._cache_user(user['id'], user)
+        return deleted
 
-    async def add_usage_request(self, user_id, description, usage_date=None):
-        async with aiosqlite.connect(self.db_path) as db:
+    async def add_usage_request(self, user_id, description, usage_date=None, kind=REQUEST_KIND_OTHER,
+                                hours=None, cost=None, notify=None):
+        """Создаёт заявку; при указанной cost резервирует баллы той же транзакцией.
+
+        notify(request_id, user) - необязательная функция, возвращающая уведомления
+        [(chat_id, text, reply_markup), ...] по id новой заявки и обновлённой строке
+        пользователя; они попадают в outbox той же транзакцией.
+        Возвращает id заявки или None, если доступных баллов меньше cost.
+        """
+        async def op(db):
+            user = None
+            if cost:
+                cursor = await db.execute(
+                    "UPDATE users SET held = held + ? WHERE id = ? AND points - held >= ?",
+                    (cost, user_id, cost)
+                )
+                if cursor.rowcount == 0:
+                    return None, None
+                user = await self._fetch_user(db, user_id)
             cursor = await db.execute("""
-                INSERT INTO usage_requests (user_id, description, usage_date)
-                VALUES (?, ?, ?)
-            """, (user_id, description, usage_date))
-            await db.commit()
-            return cursor.lastrowid
+                INSERT INTO usage_requests (user_id, description, usage_date, kind, hours, cost)
+                VALUES (?, ?, ?, ?, ?, ?)
+            """, (user_id, description, usage_date, kind, hours, cost))
+            if notify is not None:
+                owner = user or await self._fetch_user(db, user_id)
+                await self._enqueue_notifications(db, notify(cursor.lastrowid, owner))
+            return cursor.lastrowid, user
+
+        request_id, user = await self._write(op)
+        if user is not None:
+            self._cache_user(user_id, user)
+        return request_id
 
     async def get_pending_requests(self):
-        async with aiosqlite.connect(self.db_path) as db:
-            db.row_factory = aiosqlite.Row
+        async with self._acquire() as db:
             cursor = await db.execute("""
                 SELECT r.id, u.full_name, r.description, r.created_at
                 FROM usage_requests r
@@ -162,8 +570,7 @@ class Database:
             return await cursor.fetchall()
 
     async def get_latest_approved_requests(self):
-        async with aiosqlite.connect(self.db_path) as db:
-            db.row_factory = aiosqlite.Row
+        async with self._acquire() as db:
             cursor = await db.execute("""
                 SELECT r.id, u.full_name, r.description, r.created_at
                 FROM usage_requests r
@@ -175,8 +582,7 @@ class Database:
             return await cursor.fetchall()
 
     async def get_request(self, request_id):
-        async with aiosqlite.connect(self.db_path) as db:
-            db.row_factory = aiosqlite.Row
+        async with self._acquire() as db:
             cursor = await db.execute("""
                 SELECT user_id, description, status, created_at
                 FROM usage_requests WHERE id = ?
@@ -185,42 +591,51 @@ class Database:
 
     # В класс Database добавим новый метод
     async def is_date_available(self, date: str, user_id: int = None) -> bool:
-        """Проверяет, доступна ли дата для заявки (не более 3 заявок одного типа)"""
-        async with aiosqlite.connect(self.db_path) as db:
-            # Получаем информацию о пользователе, если user_id передан
-            user_role = None
-            if user_id:
-                user = await self.get_user(user_id)
-                if user:
-                    user_role = user['role']
-            
+        """Проверяет, доступна ли дата для заявки (не более DAY_SLOT_CAPACITY заявок одного типа)"""
+        # Получаем информацию о пользователе, если user_id передан
+        # (до захвата соединения, чтобы не держать два соединения пула сразу)
+        user_role = None
+        if user_id:
+            user = await self.get_user(user_id)
+            if user:
+                user_role = user['role']
+
+        async with self._acquire() as db:
             # Если это заявка на уход раньше и мы знаем роль пользователя
             if user_role in ["Консультант", "УСМ"]:
-                cursor = await db.execute("""
-                    SELECT COUNT(*) 
-                    FROM usage_requests r
-                    JOIN users u ON r.user_id = u.id
-                    WHERE DATE(r.usage_date) = ? 
-                    AND r.status = 'approved'
-                    AND u.role = ?
-                    AND r.description LIKE 'Уйти на%'
-                """, (date, user_role))
+                # Не больше DAY_SLOT_CAPACITY строк по первичному ключу
+                cursor = await db.execute(
+                    "SELECT COUNT(*) FROM day_slots WHERE date = ? AND role = ?",
+                    (date, user_role)
+                )
             else:
                 # Для других типов заявок проверяем все
                 cursor = await db.execute("""
                     SELECT COUNT(*) 
                     FROM usage_requests 
-                    WHERE DATE(usage_date) = ? 
+                    WHERE usage_date = ?
                     AND status = 'approved'
                 """, (date,))
                 
             count = await cursor.fetchone()
-            return count[0] < 3 if count else True
+            return count[0] < DAY_SLOT_CAPACITY if count else True
+
+    async def get_month_occupancy(self, year: int, month: int, role: str):
+        """Число одобренных уходов раньше по дням месяца для роли: {'ГГГГ-ММ-ДД': количество}"""
+        start = f"{year:04d}-{month:02d}-01"
+        end = f"{year + month // 12:04d}-{month % 12 + 1:02d}-01"
+        async with self._acquire() as db:
+            cursor = await db.execute("""
+                SELECT date, COUNT(*)
+                FROM day_slots
+                WHERE date >= ? AND date < ? AND role = ?
+                GROUP BY date
+            """, (start, end, role))
+            return {row[0]: row[1] for row in await cursor.fetchall()}
         
     async def get_approved_requests_for_date(self, date: str, role: str = None):
         """Получает одобренные заявки на конкретную дату использования"""
-        async with aiosqlite.connect(self.db_path) as db:
-            db.row_factory = aiosqlite.Row
+        async with self._acquire() as db:
             query = """
                 SELECT r.id, u.full_name, r.description, r.usage_date, u.role
                 FROM usage_requests r
@@ -244,14 +659,13 @@ class Database:
         - Если нет usage_date: показываем всегда
         """
         today = datetime.now().strftime("%Y-%m-%d")
-        async with aiosqlite.connect(self.db_path) as db:
-            db.row_factory = aiosqlite.Row
+        async with self._acquire() as db:
             cursor = await db.execute("""
                 SELECT r.id, u.full_name, r.description, r.created_at, r.usage_date
                 FROM usage_requests r
                 JOIN users u ON r.user_id = u.id
                 WHERE r.status = 'approved'
-                AND (r.usage_date IS NULL OR date(r.usage_date) >= date(?))
+                AND (r.usage_date IS NULL OR r.usage_date >= ?)
                 ORDER BY 
                     CASE 
                         WHEN r.usage_date IS NULL THEN 0  -- Сначала заявки без даты
@@ -262,92 +676,365 @@ class Database:
             """, (today,))
             return await cursor.fetchall()
 
-    async def approve_request(self, request_id):
-        async with aiosqlite.connect(self.db_path) as db:
+    # --- Места на день (уход раньше) ---
+    @staticmethod
+    async def _reserve_day_slot(db, request_id, date, role):
+        """Занимает свободное место на день одной условной вставкой. False - свободных мест нет."""
+        # CTE внутри подзапроса: у "WITH ... INSERT" sqlite3 не заполняет rowcount
+        cursor = await db.execute("""
+            INSERT INTO day_slots (date, role, slot, request_id)
+            SELECT ?, ?, slot, ?
+            FROM (
+                WITH RECURSIVE slots(slot) AS (
+                    SELECT 0 UNION ALL SELECT slot + 1 FROM slots WHERE slot + 1 < ?
+                )
+                SELECT slot FROM slots
+            )
+            WHERE slot NOT IN (SELECT slot FROM day_slots WHERE date = ? AND role = ?)
+            ORDER BY slot
+            LIMIT 1
+        """, (date, role, request_id, DAY_SLOT_CAPACITY, date, role))
+        return cursor.rowcount == 1
+
+    @staticmethod
+    async def _fetch_request(db, request_id):
+        cursor = await db.execute("""
+            SELECT r.user_id, r.description, r.status, r.usage_date, r.kind, r.cost, u.role
+            FROM usage_requests r
+            LEFT JOIN users u ON r.user_id = u.id
+            WHERE r.id = ?
+        """, (request_id,))
+        return await cursor.fetchone()
+
+    async def _release_hold(self, db, request):
+        """Снимает резерв баллов pending-заявки. Возвращает обновлённую строку пользователя или None."""
+        if request['status'] != 'pending' or not request['cost']:
+            return None
+        await db.execute("UPDATE users SET held = MAX(held - ?, 0) WHERE id = ?",
+                         (request['cost'], request['user_id']))
+        return await self._fetch_user(db, request['user_id'])
+
+    async def approve_request(self, request_id, notify_text=None, admin_id=None):
+        """Одобряет заявку одной транзакцией: место на день для ухода раньше,
+        списание зарезервированных баллов с записью в history.
+
+        Возвращает 'approved', 'full' (на дату нет мест, заявка остаётся pending)
+        или 'processed' (заявка не найдена или уже обработана).
+        """
+        async def op(db):
+            request = await self._fetch_request(db, request_id)
+            if request is None or request['status'] != 'pending':
+                return 'processed', None
+            takes_slot = request['kind'] == REQUEST_KIND_EARLY_LEAVE and request['usage_date'] and request['role']
+            if takes_slot and not await self._reserve_day_slot(db, request_id, request['usage_date'], request['role']):
+                return 'full', None
             await db.execute("UPDATE usage_requests SET status = 'approved' WHERE id = ?", (request_id,))
-            await db.commit()
+            user = None
+            if request['cost']:
+                # Резерв превращается в списание; ключ операции не даст списать дважды
+                cost = request['cost']
+                await db.execute("UPDATE users SET points = points - ?, held = MAX(held - ?, 0) WHERE id = ?",
+                                 (cost, cost, request['user_id']))
+                await db.execute("""
+                    INSERT INTO history (admin_id, user_id, points, reason, op_key)
+                    VALUES (?, ?, ?, ?, ?)
+                """, (admin_id, request['user_id'], -cost, f"Использование баллов: {request['description']}",
+                      f"request:{request_id}"))
+                user = await self._fetch_user(db, request['user_id'])
+            if notify_text:
+                await self._enqueue_notification(db, request['user_id'], notify_text)
+            return 'approved', user
 
-    async def reject_request(self, request_id):
-        async with aiosqlite.connect(self.db_path) as db:
+        result, user = await self._write(op)
+        if result == 'approved':
+            self.occupancy_version += 1
+        if user is not None:
+            self._cache_user(user['id'], user)
+        return result
+
+    async def reject_request(self, request_id, notify_text=None):
+        """Отклоняет pending-заявку и снимает резерв баллов. False - заявка уже обработана."""
+        async def op(db):
+            request = await self._fetch_request(db, request_id)
+            if request is None or request['status'] != 'pending':
+                return False, None
             await db.execute("UPDATE usage_requests SET status = 'rejected' WHERE id = ?", (request_id,))
-            await db.commit()
+            user = await self._release_hold(db, request)
+            if notify_text:
+                await self._enqueue_notification(db, request['user_id'], notify_text)
+            return True, user
+
+        rejected, user = await self._write(op)
+        if user is not None:
+            self._cache_user(user['id'], user)
+        return rejected
 
     async def clear_approved_requests(self):
-        async with aiosqlite.connect(self.db_path) as db:
+        async def op(db):
+            await db.execute("""
+                DELETE FROM day_slots
+                WHERE request_id IN (SELECT id FROM usage_requests WHERE status = 'approved')
+            """)
             await db.execute("DELETE FROM usage_requests WHERE status = 'approved'")
-            await db.commit()
+        await self._write(op)
+        self.occupancy_version += 1
     
-# --- Резервная копия ---
-    async def create_backup(self):
-        """Создает резервную копию базы данных в Excel"""
-        max_backups = 10  # Максимальное количество хранимых бэкапов
-        backups = sorted(glob.glob(os.path.join(backup_dir, "backup_*.xlsx")))
-        if len(backups) >= max_backups:
-            for old_backup in backups[:-max_backups]:
-                try:
-                    os.remove(old_backup)
-                except:
-                    pass
+    # --- Исходящие уведомления (outbox) ---
+    async def _enqueue_notification(self, db, chat_id, text, reply_markup=None):
+        """Добавляет уведомление в outbox внутри текущей операции записи.
+
+        reply_markup - JSON разметки (TelegramObject.to_json()) или None.
+        """
+        await db.execute("""
+            INSERT INTO outbox (chat_id, text, reply_markup, next_attempt_at)
+            VALUES (?, ?, ?, ?)
+        """, (chat_id, text, reply_markup, time.time()))
+        self._outbox_dirty = True
+
+    async def _enqueue_notifications(self, db, messages):
+        """Добавляет пачку уведомлений [(chat_id, text, reply_markup), ...] одним executemany"""
+        if not messages:
+            return
+        now = time.time()
+        await db.executemany(
+            "INSERT INTO outbox (chat_id, text, reply_markup, next_attempt_at) VALUES (?, ?, ?, ?)",
+            [(chat_id, text, reply_markup, now) for chat_id, text, reply_markup in messages],
+        )
+        self._outbox_dirty = True
+
+    async def enqueue_notification(self, chat_id, text, reply_markup=None):
+        async def op(db):
+            await self._enqueue_notification(db, chat_id, text, reply_markup)
+        await self._write(op)
+
+    async def get_due_notifications(self, limit, exclude=()):
+        """Уведомления, срок которых наступил; exclude - id тех, что уже отправляются"""
+        placeholders = ",".join("?" * len(exclude))
+        async with self._acquire() as db:
+            cursor = await db.execute(f"""
+                SELECT id, chat_id, text, reply_markup, attempts
+                FROM outbox
+                WHERE status = 'pending' AND next_attempt_at <= ? AND id NOT IN ({placeholders})
+                ORDER BY id
+                LIMIT ?
+            """, (time.time(), *exclude, limit))
+            return await cursor.fetchall()
+
+    async def get_next_notification_time(self):
+        """Время (unix) ближайшей попытки доставки или None, если очередь пуста"""
+        async with self._acquire() as db:
+            cursor = await db.execute(
+                "SELECT MIN(next_attempt_at) FROM outbox WHERE status = 'pending'"
+            )
+            row = await cursor.fetchone()
+            return row[0]
+
+    async def mark_notifications_delivered(self, notification_ids):
+        async def op(db):
+            await db.executemany("""
+                UPDATE outbox SET status = 'delivered', delivered_at = CURRENT_TIMESTAMP
+                WHERE id = ?
+            """, [(notification_id,) for notification_id in notification_ids])
+        await self._write(op)
+
+    async def reschedule_notifications(self, failures):
+        """failures - список (id, attempts, next_attempt_at или None для окончательной ошибки, текст ошибки)"""
+        async def op(db):
+            await db.executemany("""
+                UPDATE outbox
+                SET attempts = ?,
+                    status = CASE WHEN ? IS NULL THEN 'failed' ELSE 'pending' END,
+                    next_attempt_at = COALESCE(?, next_attempt_at),
+                    last_error = ?
+                WHERE id = ?
+            """, [(attempts, next_at, next_at, error, notification_id)
+                  for notification_id, attempts, next_at, error in failures])
+        await self._write(op)
+
+    async def purge_delivered_notifications(self, older_than_days):
+        async def op(db):
+            await db.execute("""
+                DELETE FROM outbox
+                WHERE status = 'delivered' AND delivered_at < datetime('now', ?)
+            """, (f"-{int(older_than_days)} days",))
+        await self._write(op)
+
+    # --- Планировщик ---
+    async def get_job(self, name):
+        async with self._acquire() as db:
+            cursor = await db.execute("SELECT * FROM jobs WHERE name = ?", (name,))
+            return await cursor.fetchone()
+
+    async def save_job_schedule(self, name, rule, next_run_at):
+        async def op(db):
+            await db.execute("""
+                INSERT INTO jobs (name, rule, next_run_at) VALUES (?, ?, ?)
+                ON CONFLICT(name) DO UPDATE SET rule = excluded.rule, next_run_at = excluded.next_run_at
+            """, (name, rule, next_run_at))
+        await self._write(op)
+
+    async def try_lock_job(self, name, owner, scheduled_at, lease_seconds):
+        """Захватывает запуск задачи, запланированный на scheduled_at.
+
+        Не удаётся, если задачу держит другой владелец или запуск уже выполнен
+        (next_run_at сдвинулся).
+        """
+        async def op(db):
+            now = time.time()
+            cursor = await db.execute("""
+                UPDATE jobs SET locked_until = ?, lock_owner = ?
+                WHERE name = ? AND next_run_at = ?
+                AND (locked_until IS NULL OR locked_until < ?)
+            """, (now + lease_seconds, owner, name, scheduled_at, now))
+            return cursor.rowcount == 1
+        return await self._write(op)
+
+    async def renew_job_lock(self, name, owner, lease_seconds):
+        """Продлевает аренду задачи, пока её держит owner. Возвращает False, если аренду перехватили."""
+        async def op(db):
+            cursor = await db.execute(
+                "UPDATE jobs SET locked_until = ? WHERE name = ? AND lock_owner = ?",
+                (time.time() + lease_seconds, name, owner)
+            )
+            return cursor.rowcount == 1
+        return await self._write(op)
+
+    async def finish_job(self, name, owner, last_run_at, next_run_at):
+        async def op(db):
+            await db.execute("""
+                UPDATE jobs
+                SET last_run_at = ?, next_run_at = ?, locked_until = NULL, lock_owner = NULL
+                WHERE name = ? AND lock_owner = ?
+            """, (last_run_at, next_run_at, name, owner))
+        await self._write(op)
 
+    # --- Настройки ---
+    async def init_settings(self, defaults):
+        """Добавляет недостающие настройки со значениями по умолчанию и загружает все в кэш"""
+        self._settings_defaults = dict(defaults)
+        await self._load_settings()
+
+    async def _load_settings(self):
+        if self._settings_defaults:
+            rows = [(key, json.dumps(value, ensure_ascii=False)) for key, value in self._settings_defaults.items()]
+
+            async def op(db):
+                await db.executemany("INSERT OR IGNORE INTO settings (key, value) VALUES (?, ?)", rows)
+            await self._write(op)
+        async with self._acquire() as db:
+            cursor = await db.execute("SELECT key, value FROM settings")
+            self._settings = {row['key']: json.loads(row['value']) for row in await cursor.fetchall()}
+
+    def get_setting(self, key):
+        """Значение настройки из памяти, без обращения к базе"""
+        return self._settings[key]
+
+    async def set_setting(self, key, value):
+        async def op(db):
+            await self._save_setting(db, key, value)
+        await self._write(op)
+        self._update_setting(key, value)
+
+    async def set_setting_item(self, key, item, value):
+        """Меняет один элемент словаря-настройки (например, баллы за причину).
+
+        Чтение и запись в одной транзакции, поэтому одновременные правки
+        разных пунктов не затирают друг друга. Возвращает новый словарь.
+        """
+        async def op(db):
+            cursor = await db.execute("SELECT value FROM settings WHERE key = ?", (key,))
+            row = await cursor.fetchone()
+            table = json.loads(row['value']) if row else {}
+            table[item] = value
+            await self._save_setting(db, key, table)
+            return table
+        table = await self._write(op)
+        self._update_setting(key, table)
+        return table
+
+    @staticmethod
+    async def _save_setting(db, key, value):
+        await db.execute("""
+            INSERT INTO settings (key, value) VALUES (?, ?)
+            ON CONFLICT(key) DO UPDATE SET
+                value = excluded.value,
+                version = version + 1,
+                updated_at = CURRENT_TIMESTAMP
+        """, (key, json.dumps(value, ensure_ascii=False)))
+
+    def _update_setting(self, key, value):
+        """Обновляет кэш после коммита"""
+        self._settings[key] = value
+
+    # --- Состояние диалогов (persistence) ---
+    async def get_conversations(self, name):
+        async with self._acquire() as db:
+            cursor = await db.execute("SELECT key, state FROM conversations WHERE name = ?", (name,))
+            return await cursor.fetchall()
+
+    async def save_conversation(self, name, key, state):
+        """Сохраняет состояние диалога; state=None - диалог завершён, строка удаляется"""
+        async def op(db):
+            if state is None:
+                await db.execute("DELETE FROM conversations WHERE name = ? AND key = ?", (name, key))
+            else:
+                await db.execute("""
+                    INSERT INTO conversations (name, key, state) VALUES (?, ?, ?)
+                    ON CONFLICT(name, key) DO UPDATE SET state = excluded.state
+                """, (name, key, state))
+        await self._write(op)
+
+    async def get_user_data(self, user_id):
+        """user_data пользователя в виде JSON или None"""
+        async with self._acquire() as db:
+            cursor = await db.execute("SELECT data FROM user_data WHERE user_id = ?", (user_id,))
+            row = await cursor.fetchone()
+        return row['data'] if row else None
+
+    async def save_user_data(self, user_id, data):
+        async def op(db):
+            await db.execute("""
+                INSERT INTO user_data (user_id, data) VALUES (?, ?)
+                ON CONFLICT(user_id) DO UPDATE SET data = excluded.data, updated_at = CURRENT_TIMESTAMP
+            """, (user_id, data))
+        await self._write(op)
+
+    async def delete_user_data(self, user_id):
+        async def op(db):
+            await db.execute("DELETE FROM user_data WHERE user_id = ?", (user_id,))
+        await self._write(op)
+
+# --- Резервная копия ---
+    async def create_backup(self, fmt=BACKUP_FORMAT):
+        """Создает резервную копию базы данных (sqlite, xlsx, csv или jsonl) в рабочем потоке"""
         try:
-            backup_dir = 'backups'
-            os.makedirs(backup_dir, exist_ok=True)
-            
+            os.makedirs(BACKUP_DIR, exist_ok=True)
+
             timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-            backup_path = os.path.join(backup_dir, f"backup_{timestamp}.xlsx")
-            
-            async with aiosqlite.connect(self.db_path) as db:
-                # Получаем только пользовательские таблицы (исключаем системные)
-                cursor = await db.execute("""
-                    SELECT name FROM sqlite_master 
-                    WHERE type='table' 
-                    AND name NOT LIKE 'sqlite_%'
-                """)
-                tables = [row[0] for row in await cursor.fetchall()]
-                
-                if not tables:
-                    raise Exception("В базе нет таблиц для резервирования")
-                
-                # Создаем новый Excel-файл
-                with pd.ExcelWriter(backup_path, engine='openpyxl') as writer:
-                    # Создаем временный лист, который потом удалим
-                    temp_sheet = writer.book.create_sheet("temp")
-                    
-                    for table in tables:
-                        try:
-                            # Получаем данные таблицы
-                            cursor = await db.execute(f"SELECT * FROM {table}")
-                            columns = [desc[0] for desc in cursor.description]
-                            data = await cursor.fetchall()
-                            
-                            if data:  # Создаем лист только если есть данные
-                                df = pd.DataFrame(data, columns=columns)
-                                df.to_excel(
-                                    writer,
-                                    sheet_name=table[:31],  # Максимум 31 символ для имени листа
-                                    index=False
-                                )
-                        except Exception as e:
-                            logging.error(f"Ошибка экспорта таблицы {table}: {e}")
-                            continue
-                    
-                    # Удаляем временный лист
-                    if 'temp' in writer.book.sheetnames:
-                        writer.book.remove(writer.book['temp'])
-                    
-                    # Если не создано ни одного листа, создаем пустой с сообщением
-                    if not writer.book.sheetnames:
-                        ws = writer.book.create_sheet("Информация")
-                        ws['A1'] = "Нет данных для экспорта"
-            
-            return backup_path
-            
+            backup_path = os.path.join(BACKUP_DIR, f"backup_{timestamp}{EXPORT_FORMATS[fmt]}")
+
+            await asyncio.to_thread(make_backup, self.db_path, backup_path, fmt)
         except Exception as e:
-            # Удаляем частично созданный файл при ошибке
-            if os.path.exists(backup_path):
-                os.remove(backup_path)
             raise Exception(f"Ошибка создания резервной копии: {str(e)}")
-    
+
+        await asyncio.to_thread(prune_backups, BACKUP_DIR, BACKUP_KEEP_LAST, BACKUP_KEEP_DAYS)
+        return backup_path
+
+    async def restore_backup(self, snapshot_path):
+        """Восстанавливает базу из снимка sqlite: проверка целостности, замена файла, переподключение.
+
+        close() дожидается начатых чтений и записей; обращения к базе во время
+        восстановления получают RuntimeError.
+        """
+        # Если снимок не пройдёт проверку, файл базы не меняется и мы переподключаемся к прежнему
+        await self.close()
+        try:
+            await asyncio.to_thread(restore_snapshot, snapshot_path, self.db_path, BACKUP_DIR)
+        finally:
+            await self.connect()
+            self.occupancy_version += 1
+            self.users_version += 1
+
 # --- Глобальный экземпляр ---
 db = Database()
 
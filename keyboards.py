@@ -0,0 +1,86 @@
+"""Готовые клавиатуры, общие для всех обработчиков.
+
+Разметки PTB неизменяемы, поэтому один объект можно отправлять сколько угодно
+раз: меню строятся один раз при импорте, список сотрудников - при изменении
+состава пользователей.
+"""
+from telegram import KeyboardButton, ReplyKeyboardMarkup
+
+from config import ADMINS, SUPERADMINS
+from db import db
+
+
+def _menu(*labels):
+    return ReplyKeyboardMarkup([[KeyboardButton(label)] for label in labels], resize_keyboard=True)
+
+
+ADMIN_MENU = _menu(
+    "Начислить/Списать баллы",
+    "Очередь использования баллов",
+    "Заявки на сегодня",
+    "Проверка заявок на использование",
+    "История сотрудника",
+    "Сотрудники",
+    "Создать резервную копию",
+    "Изменения",
+)
+SUPERADMIN_MENU = _menu(
+    "Начислить/Списать баллы",
+    "Начислить/Списать баллы (silent)",
+    "Очередь использования баллов",
+    "Заявки на сегодня",
+    "Проверка заявок на использование",
+    "История сотрудника",
+    "Сотрудники",
+    "Создать резервную копию",
+    "Изменения",
+)
+EMPLOYEE_MENU = _menu(
+    "Мой баланс",
+    "История",
+    "Использовать баллы",
+    "Мои заявки",
+    "Заявки на сегодня",
+    "Сотрудники",
+    "Прайс-лист",
+    "Правила",
+)
+
+
+def main_menu_markup(user_id):
+    """Главное меню для роли пользователя"""
+    if user_id in ADMINS:
+        return ADMIN_MENU
+    if user_id in SUPERADMINS:
+        return SUPERADMIN_MENU
+    return EMPLOYEE_MENU
+
+
+class EmployeePicker:
+    """Клавиатура выбора сотрудника "ФИО (id)"; пересобирается после изменения db.users_version"""
+
+    def __init__(self, database=db):
+        self.db = database
+        self._version = None
+        self._markups = {}
+
+    async def markup(self, with_menu_button=False):
+        version = self.db.users_version
+        if version != self._version:
+            self._markups = {}
+            self._version = version
+        markup = self._markups.get(with_menu_button)
+        if markup is None:
+            users = await self.db.get_all_users()
+            buttons = [[KeyboardButton(f"{u[1]} ({u[0]})")] for u in users]
+            if with_menu_button:
+                buttons.append([KeyboardButton("Главное меню")])
+            markup = ReplyKeyboardMarkup(buttons, resize_keyboard=True, one_time_keyboard=True)
+            # Пока читали пользователей, состав мог измениться - такой результат не кэшируем
+            if version == self.db.users_version:
+                self._markups[with_menu_button] = markup
+        return markup
+
+
+# --- Глобальный экземпляр ---
+employee_picker = EmployeePicker()
@@ -0,0 +1,315 @@
+"""Версионные миграции схемы SQLite.
+
+Текущая версия схемы хранится в PRAGMA user_version. Каждая миграция
+применяется один раз, по порядку. Миграция - это либо SQL-скрипт (выполняется
+одной транзакцией вместе с повышением версии), либо корутина для долгих
+изменений данных, которая сама разбивает работу на короткие транзакции.
+"""
+import asyncio
+import logging
+import re
+from datetime import datetime
+
+BACKFILL_BATCH_SIZE = 500  # Строк в одной транзакции при заполнении данных
+
+
+async def backfill(db, select_sql, update_sql, transform, batch_size=BACKFILL_BATCH_SIZE):
+    """Обновляет строки пачками, каждая пачка - отдельная короткая транзакция.
+
+    select_sql должен выбирать id первым столбцом и принимать параметры
+    (последний_id, размер_пачки): ... WHERE id > ? ... ORDER BY id LIMIT ?
+    transform(row) возвращает параметры для update_sql или None, чтобы пропустить строку.
+    """
+    total = 0
+    last_id = 0
+    while True:
+        cursor = await db.execute(select_sql, (last_id, batch_size))
+        rows = await cursor.fetchall()
+        if not rows:
+            break
+        params = [p for p in map(transform, rows) if p is not None]
+        if params:
+            await db.execute("BEGIN IMMEDIATE")
+            try:
+                await db.executemany(update_sql, params)
+                await db.execute("COMMIT")
+            except Exception:
+                await db.execute("ROLLBACK")
+                raise
+        last_id = rows[-1][0]
+        total += len(params)
+        # Отдаём управление циклу событий между пачками
+        await asyncio.sleep(0)
+    return total
+
+
+async def _column_exists(db, table, column):
+    cursor = await db.execute(f"PRAGMA table_info({table})")
+    return any(row[1] == column for row in await cursor.fetchall())
+
+
+async def _initial_schema(db):
+    """Исходные таблицы users, usage_requests, history"""
+    await db.executescript("""
+        BEGIN;
+        CREATE TABLE IF NOT EXISTS users (
+            id INTEGER PRIMARY KEY,
+            full_name TEXT,
+            role TEXT,
+            points INTEGER DEFAULT 0
+        );
+
+        CREATE TABLE IF NOT EXISTS usage_requests (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER,
+            description TEXT,
+            status TEXT DEFAULT 'pending',
+            created_at TEXT DEFAULT CURRENT_TIMESTAMP,
+            usage_date TEXT,
+            FOREIGN KEY(user_id) REFERENCES users(id)
+        );
+
+        CREATE TABLE IF NOT EXISTS history (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            admin_id INTEGER,
+            user_id INTEGER,
+            points INTEGER,
+            reason TEXT,
+            timestamp TEXT DEFAULT CURRENT_TIMESTAMP
+        );
+        COMMIT;
+    """)
+    # Старые базы были созданы без usage_date
+    if not await _column_exists(db, "usage_requests", "usage_date"):
+        await db.execute("ALTER TABLE usage_requests ADD COLUMN usage_date TEXT")
+
+
+_INDEXES = """
+    CREATE INDEX IF NOT EXISTS idx_history_user_ts ON history(user_id, timestamp);
+    CREATE INDEX IF NOT EXISTS idx_usage_requests_status_date ON usage_requests(status, usage_date);
+    CREATE INDEX IF NOT EXISTS idx_usage_requests_status_created ON usage_requests(status, created_at);
+    CREATE INDEX IF NOT EXISTS idx_usage_requests_user ON usage_requests(user_id, created_at);
+    CREATE INDEX IF NOT EXISTS idx_users_role ON users(role);
+"""
+
+
+async def _normalize_usage_dates(db):
+    """Приводит usage_date к виду ГГГГ-ММ-ДД, чтобы сравнивать даты без DATE() и по индексу"""
+    updated = await backfill(
+        db,
+        """
+            SELECT id FROM usage_requests
+            WHERE id > ? AND usage_date IS NOT NULL AND usage_date != date(usage_date)
+            ORDER BY id LIMIT ?
+        """,
+        "UPDATE usage_requests SET usage_date = date(usage_date) WHERE id = ?",
+        lambda row: (row[0],),
+    )
+    if updated:
+        logging.info(f"Нормализовано дат использования: {updated}")
+
+
+_OUTBOX = """
+    CREATE TABLE IF NOT EXISTS outbox (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        chat_id INTEGER NOT NULL,
+        text TEXT NOT NULL,
+        reply_markup TEXT,
+        status TEXT DEFAULT 'pending',
+        attempts INTEGER DEFAULT 0,
+        next_attempt_at REAL DEFAULT 0,
+        last_error TEXT,
+        created_at TEXT DEFAULT CURRENT_TIMESTAMP,
+        delivered_at TEXT
+    );
+    CREATE INDEX IF NOT EXISTS idx_outbox_status_next ON outbox(status, next_attempt_at);
+"""
+
+
+# Ключ постраничной истории - (timestamp, id)
+_HISTORY_KEYSET_INDEX = """
+    CREATE INDEX IF NOT EXISTS idx_history_user_ts_id ON history(user_id, timestamp, id);
+    DROP INDEX IF EXISTS idx_history_user_ts;
+"""
+
+
+_JOBS = """
+    CREATE TABLE IF NOT EXISTS jobs (
+        name TEXT PRIMARY KEY,
+        rule TEXT NOT NULL,
+        next_run_at TEXT,
+        last_run_at TEXT,
+        locked_until REAL,
+        lock_owner TEXT
+    );
+"""
+
+
+async def _idempotent_ledger(db):
+    """Ключи операций в history и скрытые (silent) записи; сверка балансов с журналом"""
+    if not await _column_exists(db, "history", "op_key"):
+        await db.execute("ALTER TABLE history ADD COLUMN op_key TEXT")
+    if not await _column_exists(db, "history", "silent"):
+        await db.execute("ALTER TABLE history ADD COLUMN silent INTEGER DEFAULT 0")
+    await db.execute(
+        "CREATE UNIQUE INDEX IF NOT EXISTS idx_history_op_key ON history(op_key) WHERE op_key IS NOT NULL"
+    )
+    # Раньше silent-начисления не попадали в history - добавляем скрытую корректировку,
+    # чтобы баланс каждого пользователя совпадал с суммой журнала
+    fixed = await backfill(
+        db,
+        """
+            SELECT u.id, u.points - COALESCE(
+                (SELECT SUM(h.points) FROM history h WHERE h.user_id = u.id), 0
+            ) AS drift
+            FROM users u
+            WHERE u.id > ?
+            ORDER BY u.id
+            LIMIT ?
+        """,
+        """
+            INSERT INTO history (admin_id, user_id, points, reason, silent)
+            VALUES (NULL, ?, ?, 'Сверка баланса с журналом', 1)
+        """,
+        lambda row: (row[0], row[1]) if row[1] else None,
+    )
+    if fixed:
+        logging.info(f"Добавлено корректировок баланса: {fixed}")
+
+
+# Места на день для ухода раньше: уникальность (date, role, slot) не даёт занять
+# больше DAY_SLOT_CAPACITY мест даже при одновременных одобрениях.
+# Уже одобренные заявки получают места по порядку id (перебор прошлых дней сохраняется).
+_DAY_SLOTS = """
+    CREATE TABLE IF NOT EXISTS day_slots (
+        date TEXT NOT NULL,
+        role TEXT NOT NULL,
+        slot INTEGER NOT NULL,
+        request_id INTEGER NOT NULL UNIQUE,
+        PRIMARY KEY (date, role, slot)
+    );
+    INSERT INTO day_slots (date, role, slot, request_id)
+    SELECT r.usage_date, u.role,
+           ROW_NUMBER() OVER (PARTITION BY r.usage_date, u.role ORDER BY r.id) - 1,
+           r.id
+    FROM usage_requests r
+    JOIN users u ON r.user_id = u.id
+    WHERE r.status = 'approved'
+    AND r.usage_date IS NOT NULL
+    AND r.description LIKE 'Уйти на%';
+"""
+
+
+_EARLY_LEAVE = re.compile(r"^Уйти на (\d+) час\S* раньше(?: (\d{2}\.\d{2}\.\d{4}))?")
+_COST = re.compile(r"стоимость: (\d+)")
+
+
+def _parse_request(row):
+    """(kind, hours, cost, usage_date) из текста старой заявки"""
+    request_id, description, usage_date = row
+    match = _EARLY_LEAVE.match(description or "")
+    if not match:
+        return ("other", None, None, usage_date, request_id)
+    hours = int(match.group(1))
+    cost = _COST.search(description)
+    if usage_date is None and match.group(2):
+        usage_date = datetime.strptime(match.group(2), "%d.%m.%Y").strftime("%Y-%m-%d")
+    return ("early_leave", hours, int(cost.group(1)) if cost else None, usage_date, request_id)
+
+
+async def _typed_usage_requests(db):
+    """Тип, часы и стоимость заявки в отдельных столбцах вместо разбора description"""
+    for column, column_type in (("kind", "TEXT"), ("hours", "INTEGER"), ("cost", "INTEGER")):
+        if not await _column_exists(db, "usage_requests", column):
+            await db.execute(f"ALTER TABLE usage_requests ADD COLUMN {column} {column_type}")
+    updated = await backfill(
+        db,
+        """
+            SELECT id, description, usage_date FROM usage_requests
+            WHERE id > ? AND kind IS NULL
+            ORDER BY id LIMIT ?
+        """,
+        "UPDATE usage_requests SET kind = ?, hours = ?, cost = ?, usage_date = ? WHERE id = ?",
+        _parse_request,
+    )
+    await db.execute(
+        "CREATE INDEX IF NOT EXISTS idx_usage_requests_kind_status_date ON usage_requests(kind, status, usage_date)"
+    )
+    if updated:
+        logging.info(f"Заполнены типы заявок: {updated}")
+
+
+# Резерв баллов по pending-заявкам; доступно = points - held
+_BALANCE_HOLDS = """
+    ALTER TABLE users ADD COLUMN held INTEGER NOT NULL DEFAULT 0;
+    UPDATE users SET held = (
+        SELECT COALESCE(SUM(r.cost), 0)
+        FROM usage_requests r
+        WHERE r.user_id = users.id AND r.status = 'pending' AND r.cost IS NOT NULL
+    );
+"""
+
+
+# Редактируемые из бота настройки (таблицы баллов, тексты); value - JSON
+_SETTINGS = """
+    CREATE TABLE IF NOT EXISTS settings (
+        key TEXT PRIMARY KEY,
+        value TEXT NOT NULL,
+        version INTEGER NOT NULL DEFAULT 1,
+        updated_at TEXT DEFAULT CURRENT_TIMESTAMP
+    );
+"""
+
+
+# Состояние диалогов и user_data для SQLitePersistence, по строке на диалог/пользователя
+_PERSISTENCE = """
+    CREATE TABLE IF NOT EXISTS conversations (
+        name TEXT NOT NULL,
+        key TEXT NOT NULL,
+        state INTEGER NOT NULL,
+        PRIMARY KEY (name, key)
+    );
+    CREATE TABLE IF NOT EXISTS user_data (
+        user_id INTEGER PRIMARY KEY,
+        data TEXT NOT NULL,
+        updated_at TEXT DEFAULT CURRENT_TIMESTAMP
+    );
+"""
+
+
+# (версия, миграция) - только добавлять в конец, уже выпущенные не менять
+MIGRATIONS = [
+    (1, _initial_schema),
+    (2, _INDEXES),
+    (3, _normalize_usage_dates),
+    (4, _OUTBOX),
+    (5, _HISTORY_KEYSET_INDEX),
+    (6, _JOBS),
+    (7, _idempotent_ledger),
+    (8, _DAY_SLOTS),
+    (9, _typed_usage_requests),
+    (10, _BALANCE_HOLDS),
+    (11, _SETTINGS),
+    (12, _PERSISTENCE),
+]
+
+
+async def get_schema_version(db):
+    cursor = await db.execute("PRAGMA user_version")
+    return (await cursor.fetchone())[0]
+
+
+async def run_migrations(db):
+    """Применяет недостающие миграции. Соединение должно быть в режиме autocommit."""
+    current = await get_schema_version(db)
+    for version, migration in MIGRATIONS:
+        if version <= current:
+            continue
+        logging.info(f"Миграция схемы SQLite до версии {version}")
+        if isinstance(migration, str):
+            await db.executescript(f"BEGIN; {migration} PRAGMA user_version = {version}; COMMIT;")
+        else:
+            await migration(db)
+            await db.execute(f"PRAGMA user_version = {version}")
+        current = version
+    return current
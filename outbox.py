@@ -0,0 +1,123 @@
+"""Фоновая доставка уведомлений из таблицы outbox."""
+import asyncio
+import json
+import logging
+import time
+
+from telegram import InlineKeyboardMarkup
+from telegram.error import BadRequest, Forbidden, TimedOut
+
+from broadcast import broadcaster
+from db import db
+
+OUTBOX_BATCH = 50  # Сколько уведомлений отправлять за один проход
+OUTBOX_POLL_INTERVAL = 60  # Страховочный опрос таблицы, секунд
+OUTBOX_MAX_ATTEMPTS = 8  # После стольких неудачных попыток уведомление помечается failed
+OUTBOX_BACKOFF_BASE = 5  # Пауза после первой неудачи, дальше удваивается
+OUTBOX_BACKOFF_MAX = 3600
+OUTBOX_RETENTION_DAYS = 7  # Сколько хранить доставленные уведомления
+
+logger = logging.getLogger(__name__)
+
+
+class OutboxWorker:
+    """Отправляет уведомления из outbox, повторяет неудачные и отмечает доставленные"""
+
+    def __init__(self, bot, database=db, sender=broadcaster):
+        self.bot = bot
+        self.db = database
+        self.sender = sender
+        self._task = None
+
+    def start(self):
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is None:
+            return
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        self._task = None
+
+    async def _run(self):
+        try:
+            await self.db.purge_delivered_notifications(OUTBOX_RETENTION_DAYS)
+        except Exception as e:
+            logger.error(f"Ошибка очистки outbox: {e}")
+
+        while True:
+            self.db.outbox_event.clear()
+            try:
+                await self.drain()
+                timeout = await self._seconds_until_next()
+            except Exception as e:
+                logger.error(f"Ошибка доставки уведомлений: {e}", exc_info=True)
+                timeout = OUTBOX_BACKOFF_BASE
+            try:
+                await asyncio.wait_for(self.db.outbox_event.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+
+    async def _seconds_until_next(self):
+        next_at = await self.db.get_next_notification_time()
+        if next_at is None:
+            return OUTBOX_POLL_INTERVAL
+        return min(OUTBOX_POLL_INTERVAL, max(0.0, next_at - time.time()))
+
+    async def drain(self):
+        """Отправляет все уведомления, срок которых наступил. Возвращает число доставленных.
+
+        В отправке одновременно не больше OUTBOX_BATCH уведомлений; как только
+        какие-то завершились, их места занимают следующие. Так сообщения в чаты,
+        упёршиеся в лимит (например, пачка уведомлений админам), не задерживают
+        остальные.
+        """
+        delivered_total = 0
+        in_flight = {}  # задача отправки -> строка outbox
+        try:
+            while True:
+                if len(in_flight) < OUTBOX_BATCH:
+                    rows = await self.db.get_due_notifications(
+                        OUTBOX_BATCH - len(in_flight), exclude=[row['id'] for row in in_flight.values()]
+                    )
+                    for row in rows:
+                        in_flight[asyncio.create_task(self._deliver(row))] = row
+                if not in_flight:
+                    return delivered_total
+
+                done, _ = await asyncio.wait(in_flight, return_when=asyncio.FIRST_COMPLETED)
+                delivered_total += await self._record([(in_flight.pop(task), task.result()) for task in done])
+        finally:
+            for task in in_flight:
+                task.cancel()
+
+    async def _record(self, results):
+        """Отмечает доставленные уведомления и переносит неудачные. Возвращает число доставленных."""
+        delivered, failures = [], []
+        for row, result in results:
+            if result.ok:
+                delivered.append(row['id'])
+                continue
+            attempts = row['attempts'] + 1
+            # После таймаута сообщение могло быть доставлено - не отправляем повторно
+            permanent = isinstance(result.error, (BadRequest, Forbidden, TimedOut))
+            if permanent or attempts >= OUTBOX_MAX_ATTEMPTS:
+                next_at = None
+            else:
+                next_at = time.time() + min(OUTBOX_BACKOFF_MAX, OUTBOX_BACKOFF_BASE * 2 ** (attempts - 1))
+            failures.append((row['id'], attempts, next_at, str(result.error)))
+
+        if delivered:
+            await self.db.mark_notifications_delivered(delivered)
+        if failures:
+            await self.db.reschedule_notifications(failures)
+        return len(delivered)
+
+    async def _deliver(self, row):
+        kwargs = {}
+        if row['reply_markup']:
+            kwargs['reply_markup'] = InlineKeyboardMarkup.de_json(json.loads(row['reply_markup']), self.bot)
+        return await self.sender.send(self.bot, row['chat_id'], row['text'], **kwargs)
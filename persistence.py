@@ -0,0 +1,153 @@
+"""Хранение состояния диалогов и user_data в SQLite.
+
+Каждый диалог и user_data каждого пользователя - отдельная строка таблиц
+conversations и user_data. Раз в update_interval секунд PTB передаёт только
+те записи, которых касались обновления; запись, совпадающая с последней
+сохранённой, в базу не пишется. Все записи идут через писателя Database,
+поэтому изменения одного прохода попадают в одну транзакцию.
+
+user_data пользователя читается из базы при его первом обновлении после
+запуска (refresh_user_data), а не целиком при старте.
+"""
+import json
+import logging
+from datetime import date, datetime
+
+from telegram.ext import BasePersistence, PersistenceInput
+
+from db import db
+
+PERSISTENCE_UPDATE_INTERVAL = 10  # Секунд между сохранениями изменений
+
+logger = logging.getLogger(__name__)
+
+
+def _encode(value):
+    # datetime раньше date: datetime - подкласс date
+    if isinstance(value, datetime):
+        return {"__datetime__": value.isoformat()}
+    if isinstance(value, date):
+        return {"__date__": value.isoformat()}
+    raise TypeError(f"Значение типа {type(value).__name__} нельзя сохранить в user_data")
+
+
+def _decode(obj):
+    if "__datetime__" in obj:
+        return datetime.fromisoformat(obj["__datetime__"])
+    if "__date__" in obj:
+        return date.fromisoformat(obj["__date__"])
+    return obj
+
+
+def dump_data(data) -> str:
+    """JSON для user_data; даты и время сохраняются с пометкой типа (кортежи станут списками)"""
+    return json.dumps(data, default=_encode, ensure_ascii=False)
+
+
+def load_data(text: str):
+    return json.loads(text, object_hook=_decode)
+
+
+class SQLitePersistence(BasePersistence):
+    """Persistence для PTB: состояния ConversationHandler и user_data в базе бота"""
+
+    def __init__(self, database=db, update_interval=PERSISTENCE_UPDATE_INTERVAL):
+        super().__init__(
+            store_data=PersistenceInput(bot_data=False, chat_data=False, callback_data=False),
+            update_interval=update_interval,
+        )
+        self.db = database
+        # JSON последней сохранённой (или загруженной) user_data пользователя;
+        # пользователи, которых здесь нет, ещё не загружались
+        self._user_data_saved = {}
+        # (имя диалога, ключ) -> последнее сохранённое состояние
+        self._conversations_saved = {}
+
+    # --- Состояние диалогов ---
+    async def get_conversations(self, name):
+        conversations = {}
+        for row in await self.db.get_conversations(name):
+            key = tuple(json.loads(row['key']))
+            conversations[key] = row['state']
+            self._conversations_saved[(name, key)] = row['state']
+        logger.info(f"Восстановлено диалогов {name}: {len(conversations)}")
+        return conversations
+
+    async def update_conversation(self, name, key, new_state):
+        if self._conversations_saved.get((name, key)) == new_state:
+            return
+        await self.db.save_conversation(name, json.dumps(list(key)), new_state)
+        if new_state is None:
+            self._conversations_saved.pop((name, key), None)
+        else:
+            self._conversations_saved[(name, key)] = new_state
+
+    # --- user_data ---
+    async def get_user_data(self):
+        # Загружается по пользователю в refresh_user_data
+        return {}
+
+    async def refresh_user_data(self, user_id, user_data):
+        if user_id in self._user_data_saved:
+            return
+        text = await self.db.get_user_data(user_id)
+        self._user_data_saved[user_id] = text
+        if text is None:
+            return
+        try:
+            stored = load_data(text)
+        except ValueError as e:
+            logger.error(f"Повреждённая user_data пользователя {user_id}: {e}")
+            return
+        # Значения, записанные до загрузки, новее сохранённых
+        for key, value in stored.items():
+            user_data.setdefault(key, value)
+
+    async def update_user_data(self, user_id, data):
+        if user_id not in self._user_data_saved:
+            # Обработчики пользователя не запускались - менять в базе нечего
+            return
+        text = dump_data(data) if data else None
+        if text == self._user_data_saved[user_id]:
+            return
+        if text is None:
+            await self.db.delete_user_data(user_id)
+        else:
+            await self.db.save_user_data(user_id, text)
+        self._user_data_saved[user_id] = text
+
+    async def drop_user_data(self, user_id):
+        await self.db.delete_user_data(user_id)
+        self._user_data_saved[user_id] = None
+
+    # --- Не хранятся (см. store_data) ---
+    async def get_chat_data(self):
+        return {}
+
+    async def get_bot_data(self):
+        return {}
+
+    async def get_callback_data(self):
+        return None
+
+    async def update_chat_data(self, chat_id, data):
+        pass
+
+    async def update_bot_data(self, data):
+        pass
+
+    async def update_callback_data(self, data):
+        pass
+
+    async def drop_chat_data(self, chat_id):
+        pass
+
+    async def refresh_chat_data(self, chat_id, chat_data):
+        pass
+
+    async def refresh_bot_data(self, bot_data):
+        pass
+
+    async def flush(self):
+        # Изменения уже записаны в update_*, буфера нет
+        pass
@@ -0,0 +1,73 @@
+"""Маршрутизация кнопок по словарям вместо перебора регулярных выражений.
+
+Стоимость выбора обработчика не зависит от числа кнопок: текст кнопки
+меню ищется в словаре целиком, callback_data - целиком, затем по двум
+и по одному первым словам до "_" (не больше трёх обращений к словарю).
+Остаток callback_data после префикса проверяется регулярным выражением,
+если оно задано для префикса (например, номер заявки - только цифры).
+"""
+import re
+
+from telegram.ext import CallbackQueryHandler, MessageHandler, filters
+
+
+class TextRouter:
+    """Кнопки reply-клавиатуры: точный текст -> обработчик, иначе default"""
+
+    def __init__(self, routes, default):
+        self.routes = routes
+        self.default = default
+
+    async def dispatch(self, update, context):
+        message = update.effective_message
+        callback = self.routes.get(message.text if message else None, self.default)
+        return await callback(update, context)
+
+    def handler(self):
+        return MessageHandler(filters.ALL, self.dispatch)
+
+
+NUMBER = r"\d+"
+
+
+class CallbackRouter:
+    """Inline-кнопки: exact - callback_data целиком, prefixes - первые одно или два слова.
+
+    suffixes - префикс -> регулярное выражение, которому должен целиком
+    соответствовать остаток после "префикс_". Данные, для которых
+    обработчика нет или остаток не подходит (например, кнопки внутри
+    диалога), не перехватываются и достаются следующим обработчикам.
+    """
+
+    def __init__(self, exact, prefixes, suffixes=None):
+        self.exact = exact
+        self.prefixes = prefixes
+        self.suffixes = {prefix: re.compile(pattern) for prefix, pattern in (suffixes or {}).items()}
+
+    def _prefix_callback(self, prefix, rest):
+        callback = self.prefixes.get(prefix)
+        suffix = self.suffixes.get(prefix)
+        if callback is not None and suffix is not None and not suffix.fullmatch(rest):
+            return None
+        return callback
+
+    def resolve(self, data):
+        if not isinstance(data, str):
+            return None
+        callback = self.exact.get(data)
+        if callback is None:
+            parts = data.split("_", 2)
+            if len(parts) == 3:
+                callback = self._prefix_callback(f"{parts[0]}_{parts[1]}", parts[2])
+            if callback is None and len(parts) > 1:
+                callback = self._prefix_callback(parts[0], data[len(parts[0]) + 1:])
+        return callback
+
+    def matches(self, data):
+        return self.resolve(data) is not None
+
+    async def dispatch(self, update, context):
+        return await self.resolve(update.callback_query.data)(update, context)
+
+    def handler(self):
+        return CallbackQueryHandler(self.dispatch, pattern=self.matches)
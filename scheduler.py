@@ -0,0 +1,238 @@
+"""Планировщик периодических задач.
+
+Время следующего запуска каждой задачи хранится в таблице jobs, в памяти -
+куча (heapq) по времени запуска: планировщик спит ровно до ближайшей задачи.
+Запуск захватывает аренду в базе, поэтому задача не выполнится дважды,
+даже если запущено два экземпляра бота. Аренда короткая и продлевается,
+пока задача выполняется: если процесс упал посреди запуска, другой
+экземпляр перехватит задачу после истечения аренды (в пределах grace).
+"""
+import asyncio
+import heapq
+import logging
+import os
+import socket
+from datetime import datetime, time, timedelta
+
+from db import db
+
+CATCHUP_SKIP = "skip"  # Пропущенные за время простоя запуски не выполняются
+CATCHUP_ONCE = "once"  # Один запуск сразу после старта, если что-то было пропущено
+JOB_LOCK_LEASE = 120  # Секунд, на которые захватывается задача (на случай падения процесса)
+JOB_LOCK_RENEW = JOB_LOCK_LEASE / 3  # Как часто выполняющаяся задача продлевает аренду
+MAX_SLEEP = 60  # Планировщик перепроверяет часы не реже, чем раз в столько секунд
+
+logger = logging.getLogger(__name__)
+
+
+class CronRule:
+    """Правило в формате cron: "минута час день_месяца месяц день_недели".
+
+    Поддерживаются *, числа, списки (1,15), диапазоны (1-5) и шаги (*/10).
+    День недели: 0 или 7 - воскресенье.
+    """
+
+    _BOUNDS = ((0, 59), (0, 23), (1, 31), (1, 12), (0, 7))
+
+    def __init__(self, expression):
+        fields = expression.split()
+        if len(fields) != 5:
+            raise ValueError(f"Ожидалось 5 полей cron, получено: {expression!r}")
+        self.expression = expression
+        parsed = [self._parse(field, lo, hi) for field, (lo, hi) in zip(fields, self._BOUNDS)]
+        self.minutes, self.hours, self.days, self.months, weekdays = parsed
+        self.weekdays = {day % 7 for day in weekdays}
+        self._any_day = fields[2] == "*"
+        self._any_weekday = fields[4] == "*"
+
+    @staticmethod
+    def _parse(field, lo, hi):
+        values = set()
+        for part in field.split(","):
+            span, _, step = part.partition("/")
+            step = int(step) if step else 1
+            if span == "*":
+                start, end = lo, hi
+            elif "-" in span:
+                start, end = map(int, span.split("-"))
+            else:
+                start = end = int(span)
+            if not (lo <= start <= end <= hi) or step < 1:
+                raise ValueError(f"Недопустимое значение cron: {part!r}")
+            values.update(range(start, end + 1, step))
+        return sorted(values)
+
+    def _day_matches(self, day):
+        in_month = day.day in self.days
+        in_week = (day.weekday() + 1) % 7 in self.weekdays
+        # Как в cron: если ограничены оба поля, достаточно совпадения любого
+        if self._any_day or self._any_weekday:
+            return in_month and in_week
+        return in_month or in_week
+
+    def next_after(self, moment):
+        """Ближайшее время срабатывания строго позже moment"""
+        start = moment.replace(second=0, microsecond=0) + timedelta(minutes=1)
+        day = start.date()
+        for _ in range(366 * 5):
+            if day.month in self.months and self._day_matches(day):
+                for hour in self.hours:
+                    if day == start.date() and hour < start.hour:
+                        continue
+                    for minute in self.minutes:
+                        candidate = datetime.combine(day, time(hour, minute))
+                        if candidate >= start:
+                            return candidate
+            day += timedelta(days=1)
+        raise ValueError(f"Правило {self.expression!r} никогда не срабатывает")
+
+
+class Job:
+    def __init__(self, name, rule, func, catchup, grace):
+        self.name = name
+        self.rule = rule
+        self.func = func
+        self.catchup = catchup
+        self.grace = grace
+        self.next_run_at = None
+        self.task = None
+
+
+class Scheduler:
+    def __init__(self, database=db):
+        self.db = database
+        self.owner = f"{socket.gethostname()}:{os.getpid()}"
+        self._jobs = {}
+        self._heap = []
+        self._wakeup = asyncio.Event()
+        self._task = None
+
+    def add_job(self, name, rule, func, catchup=CATCHUP_ONCE, grace=None):
+        """Регистрирует задачу.
+
+        rule - строка cron; func - корутинная функция без аргументов;
+        grace - для CATCHUP_ONCE: пропущенный запуск старше grace (timedelta) не догоняется.
+        """
+        self._jobs[name] = Job(name, CronRule(rule), func, catchup, grace)
+
+    async def start(self):
+        now = datetime.now()
+        for job in self._jobs.values():
+            stored = await self.db.get_job(job.name)
+            next_run_at = None
+            if stored and stored['rule'] == job.rule.expression and stored['next_run_at']:
+                next_run_at = datetime.fromisoformat(stored['next_run_at'])
+            if next_run_at is not None and next_run_at < now:
+                missed_for = now - next_run_at
+                if job.catchup == CATCHUP_ONCE and (job.grace is None or missed_for <= job.grace):
+                    logger.info(f"Задача {job.name} пропущена в {next_run_at}, запускаем сейчас")
+                    next_run_at = now
+                else:
+                    next_run_at = None
+            if next_run_at is None:
+                next_run_at = job.rule.next_after(now)
+            await self.db.save_job_schedule(job.name, job.rule.expression, next_run_at.isoformat(sep=" "))
+            self._push(job, next_run_at)
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        running = [job.task for job in self._jobs.values() if job.task and not job.task.done()]
+        for task in running:
+            task.cancel()
+        await asyncio.gather(*running, return_exceptions=True)
+
+    def _push(self, job, next_run_at):
+        job.next_run_at = next_run_at
+        heapq.heappush(self._heap, (next_run_at, job.name))
+        self._wakeup.set()
+
+    async def _run(self):
+        while True:
+            self._wakeup.clear()
+            if not self._heap:
+                await self._wakeup.wait()
+                continue
+            next_run_at, name = self._heap[0]
+            delay = (next_run_at - datetime.now()).total_seconds()
+            if delay > 0:
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), min(delay, MAX_SLEEP))
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            heapq.heappop(self._heap)
+            job = self._jobs[name]
+            if job.next_run_at != next_run_at:
+                continue  # Устаревшая запись кучи
+            job.task = asyncio.create_task(self._run_job(job, next_run_at))
+
+    async def _run_job(self, job, scheduled_at):
+        scheduled = scheduled_at.isoformat(sep=" ")
+        while True:
+            try:
+                locked = await self.db.try_lock_job(job.name, self.owner, scheduled, JOB_LOCK_LEASE)
+                retry_at = None if locked else await self._lease_expiry(job, scheduled, scheduled_at)
+            except Exception as e:
+                logger.error(f"❌ Не удалось захватить задачу {job.name}: {e}")
+                locked, retry_at = False, None
+            if locked or retry_at is None:
+                break
+            logger.info(f"Задача {job.name} занята другим владельцем до {retry_at}, повторим захват")
+            await asyncio.sleep(max(0.0, (retry_at - datetime.now()).total_seconds()))
+
+        if locked:
+            started = datetime.now()
+            keeper = asyncio.create_task(self._keep_lock(job))
+            try:
+                await job.func()
+                logger.info(f"✅ Задача {job.name} выполнена")
+            except Exception as e:
+                logger.error(f"❌ Ошибка задачи {job.name}: {e}", exc_info=True)
+            finally:
+                keeper.cancel()
+            next_run_at = job.rule.next_after(max(started, scheduled_at))
+            try:
+                await self.db.finish_job(job.name, self.owner, started.isoformat(sep=" "),
+                                         next_run_at.isoformat(sep=" "))
+            except Exception as e:
+                logger.error(f"❌ Не удалось сохранить состояние задачи {job.name}: {e}")
+        else:
+            # Задачу выполняет другой экземпляр (или уже выполнил) - берём его расписание
+            stored = await self.db.get_job(job.name)
+            next_run_at = job.rule.next_after(datetime.now())
+            if stored and stored['next_run_at']:
+                next_run_at = max(next_run_at, datetime.fromisoformat(stored['next_run_at']))
+        self._push(job, next_run_at)
+
+    async def _lease_expiry(self, job, scheduled, scheduled_at):
+        """Когда можно снова пытаться захватить незавершённый запуск, или None.
+
+        Запуск не завершён, если next_run_at в базе не сдвинулся: его выполняет
+        другой экземпляр или держит аренда упавшего процесса. После истечения
+        аренды запуск можно перехватить, если не вышли за grace задачи.
+        """
+        stored = await self.db.get_job(job.name)
+        if not stored or stored['next_run_at'] != scheduled or not stored['locked_until']:
+            return None
+        retry_at = datetime.fromtimestamp(stored['locked_until']) + timedelta(seconds=1)
+        if job.grace is not None and retry_at - scheduled_at > job.grace:
+            return None
+        return retry_at
+
+    async def _keep_lock(self, job):
+        """Продлевает аренду, пока задача выполняется"""
+        while True:
+            await asyncio.sleep(JOB_LOCK_RENEW)
+            try:
+                if not await self.db.renew_job_lock(job.name, self.owner, JOB_LOCK_LEASE):
+                    logger.warning(f"Аренду задачи {job.name} перехватил другой экземпляр")
+                    return
+            except Exception as e:
+                logger.error(f"❌ Не удалось продлить аренду задачи {job.name}: {e}")
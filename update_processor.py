@@ -0,0 +1,60 @@
+"""Обработка обновлений: по порядку внутри чата, параллельно между чатами."""
+import asyncio
+
+from telegram import Update
+from telegram.ext import BaseUpdateProcessor
+
+MAX_QUEUED_UPDATES = 1024  # Сколько обновлений может одновременно ждать или выполняться
+
+
+class _ChatQueue:
+    __slots__ = ("lock", "users")
+
+    def __init__(self):
+        self.lock = asyncio.Lock()  # Lock в asyncio выдаётся по порядку ожидания
+        self.users = 0
+
+
+class PerChatUpdateProcessor(BaseUpdateProcessor):
+    """Обновления одного чата выполняются строго по очереди - ConversationHandler
+    видит их в том порядке, в котором они пришли. Обновления разных чатов
+    выполняются параллельно, не больше max_running_updates сразу.
+
+    Семафор базового класса ограничивает все принятые обновления, включая
+    ждущие своей очереди в чате: поэтому длинная очередь одного чата не
+    занимает места, которые нужны остальным чатам.
+    """
+
+    def __init__(self, max_running_updates, max_queued_updates=MAX_QUEUED_UPDATES):
+        super().__init__(max(max_queued_updates, max_running_updates))
+        if max_running_updates < 1:
+            raise ValueError("max_running_updates должно быть положительным")
+        self.max_running_updates = max_running_updates
+        self._running = None
+        self._chats = {}
+
+    async def initialize(self):
+        self._running = asyncio.BoundedSemaphore(self.max_running_updates)
+
+    async def shutdown(self):
+        self._chats.clear()
+
+    async def do_process_update(self, update, coroutine):
+        chat = update.effective_chat if isinstance(update, Update) else None
+        if chat is None:
+            async with self._running:
+                await coroutine
+            return
+
+        queue = self._chats.get(chat.id)
+        if queue is None:
+            queue = self._chats[chat.id] = _ChatQueue()
+        queue.users += 1
+        try:
+            async with queue.lock:
+                async with self._running:
+                    await coroutine
+        finally:
+            queue.users -= 1
+            if queue.users == 0:
+                del self._chats[chat.id]
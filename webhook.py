@@ -0,0 +1,77 @@
+"""Приём обновлений через webhook на встроенном HTTP-сервере (aiohttp).
+
+Telegram присылает каждое обновление POST-запросом. Сервер проверяет
+секретный токен из заголовка, разбирает Update и кладёт его в очередь
+Application - дальше обновления обрабатываются так же, как при polling.
+Ответ 200 отправляется сразу после постановки в очередь, не дожидаясь
+обработки.
+"""
+import hmac
+import logging
+
+from aiohttp import web
+from telegram import Update
+
+SECRET_TOKEN_HEADER = "X-Telegram-Bot-Api-Secret-Token"
+MAX_UPDATE_SIZE = 1024 * 1024  # Максимальный размер тела запроса, байт
+
+logger = logging.getLogger(__name__)
+
+
+class WebhookServer:
+    """HTTP-сервер, передающий обновления из webhook в update_queue"""
+
+    def __init__(self, update_queue, bot, listen, port, path, secret_token):
+        if not secret_token:
+            raise ValueError("Webhook без секретного токена принимал бы поддельные обновления")
+        self.update_queue = update_queue
+        self.bot = bot
+        self.listen = listen
+        self.port = port
+        self.path = path
+        self.secret_token = secret_token
+        self.received = 0
+        self.rejected = 0
+        self._runner = None
+
+    async def start(self, url=None, drop_pending_updates=False):
+        """Запускает сервер; если задан url, регистрирует его в Telegram (setWebhook)"""
+        app = web.Application(client_max_size=MAX_UPDATE_SIZE)
+        app.router.add_post(self.path, self._handle)
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, self.listen, self.port)
+        await site.start()
+        logger.info(f"Webhook слушает {self.listen}:{self.port}{self.path}")
+        if url:
+            await self.bot.set_webhook(
+                url,
+                secret_token=self.secret_token,
+                allowed_updates=Update.ALL_TYPES,
+                drop_pending_updates=drop_pending_updates,
+            )
+            logger.info(f"Webhook зарегистрирован: {url}")
+
+    async def stop(self):
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
+
+    async def _handle(self, request):
+        token = request.headers.get(SECRET_TOKEN_HEADER, "")
+        if not hmac.compare_digest(token.encode(), self.secret_token.encode()):
+            self.rejected += 1
+            logger.warning(f"Webhook: неверный секретный токен от {request.remote}")
+            return web.Response(status=403)
+        try:
+            update = Update.de_json(await request.json(), self.bot)
+        except Exception as e:
+            self.rejected += 1
+            logger.warning(f"Webhook: некорректное обновление: {e}")
+            return web.Response(status=400)
+        if update is None:
+            self.rejected += 1
+            return web.Response(status=400)
+        self.received += 1
+        await self.update_queue.put(update)
+        return web.Response()